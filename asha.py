@@ -0,0 +1,86 @@
+"""asha.py: Asynchronous successive halving (ASHA) for stopping bad sweep trials early.
+
+Rungs are at min_epochs * reduction_factor ** k epochs, for k = 0, 1, 2, ... When a trial reaches a rung,
+it records its validation metric there, and continues only if it is in the top 1 / reduction_factor of all
+trials that have reached that rung so far. Trials never wait for each other, so agents stay busy, and most
+bad trials stop after a few epochs. See Li et al. 2020: https://arxiv.org/abs/1810.05934
+
+The coordinator is a directory on a filesystem shared by all agents, e.g. on the cluster's project storage.
+Each trial writes its result at each rung to its own file, with an atomic rename, so no locking or
+external service is needed. Use a new directory for each sweep, e.g. `<dir>/<sweep id>`.
+"""
+
+import json
+import math
+import os
+
+
+class AshaCoordinator:
+	"""Decides whether trials continue at each rung, based on the results of all trials in root_dir.
+
+	Args:
+		root_dir (str): shared directory for this sweep's results
+		min_epochs (int): epochs at the first rung
+		reduction_factor (int): only the top 1 / reduction_factor of trials continue past each rung
+		mode (str): 'max' if higher metric values are better, 'min' otherwise
+	"""
+	def __init__(self, root_dir, min_epochs=1, reduction_factor=3, mode='max'):
+		if mode not in ['max', 'min']:
+			raise ValueError(f"Invalid mode `{mode}`, expected 'max' or 'min'")
+		if reduction_factor < 2:
+			raise ValueError(f"reduction_factor must be at least 2, got {reduction_factor}")
+		self.root_dir = root_dir
+		self.min_epochs = min_epochs
+		self.reduction_factor = reduction_factor
+		self.mode = mode
+
+	def get_rung(self, epochs):
+		"""Get the index of the rung at this number of completed epochs, or None if it isn't a rung."""
+		if epochs < self.min_epochs or epochs % self.min_epochs != 0:
+			return None
+		rung = round(math.log(epochs // self.min_epochs, self.reduction_factor))
+		return rung if self.min_epochs * self.reduction_factor ** rung == epochs else None
+
+	def report(self, trial_id, epochs, value):
+		"""Record a trial's metric after a number of completed epochs.
+
+		Returns:
+			bool: whether the trial should continue training
+		"""
+		rung = self.get_rung(epochs)
+		if rung is None:
+			return True
+		if value is None or math.isnan(value):
+			return False
+		self._write_result(rung, trial_id, value)
+		values = self._read_results(rung)
+		# Rank among trials at this rung, including this one. If there are fewer than reduction_factor,
+		# then only the best trial so far continues.
+		num_continue = max(1, len(values) // self.reduction_factor)
+		better = sum(v > value if self.mode == 'max' else v < value for v in values)
+		return better < num_continue
+
+	def _get_rung_dir(self, rung):
+		return os.path.join(self.root_dir, f"rung-{rung}")
+
+	def _write_result(self, rung, trial_id, value):
+		rung_dir = self._get_rung_dir(rung)
+		os.makedirs(rung_dir, exist_ok=True)
+		path = os.path.join(rung_dir, f"{trial_id}.json")
+		with open(path + '.tmp', 'w') as f:
+			json.dump({'trial_id': trial_id, 'value': float(value)}, f)
+		os.replace(path + '.tmp', path)
+
+	def _read_results(self, rung):
+		rung_dir = self._get_rung_dir(rung)
+		values = []
+		for fname in os.listdir(rung_dir):
+			if not fname.endswith('.json'):
+				continue
+			try:
+				with open(os.path.join(rung_dir, fname)) as f:
+					values.append(json.load(f)['value'])
+			except (OSError, ValueError):
+				# Skip files that are removed or unreadable, e.g. on a stale network filesystem cache
+				continue
+		return values
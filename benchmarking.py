@@ -0,0 +1,64 @@
+"""benchmarking.py: Measure training and prediction throughput of a model."""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import dataset
+
+
+def get_synthetic_data(num_examples, seq_len, num_classes, seed=0):
+	"""Get random one-hot sequences and targets, for timing a model without real data.
+
+	Args:
+		num_examples (int)
+		seq_len (int)
+		num_classes (int or None): number of classes, or None for regression targets
+
+	Returns:
+		xs (np.ndarray): [num_examples, seq_len, 4], int8 one-hot sequences
+		ys (np.ndarray): [num_examples], int8 class labels or float32 regression targets
+	"""
+	rng = np.random.default_rng(seed)
+	bases = rng.integers(dataset.NUM_BASES, size=(num_examples, seq_len))
+	xs = np.eye(dataset.NUM_BASES, dtype='int8')[bases]
+	if num_classes is None:
+		ys = rng.normal(size=num_examples).astype('float32')
+	else:
+		ys = rng.integers(num_classes, size=num_examples).astype('int8')
+	return xs, ys
+
+def get_synthetic_dataset(num_examples, seq_len, num_classes, batch_size, seed=0):
+	"""Endless tf.data.Dataset of batches of synthetic data, see get_synthetic_data()."""
+	xs, ys = get_synthetic_data(num_examples, seq_len, num_classes, seed=seed)
+	return tf.data.Dataset.from_tensor_slices((xs, ys)).repeat().batch(batch_size).prefetch(2)
+
+def time_train_steps(model, data, num_steps, batch_size, warmup_steps=5):
+	"""Get training throughput of a compiled model, in examples/sec.
+
+	The warmup steps are not timed, so that tracing and XLA compilation are excluded.
+
+	Args:
+		model (keras model): compiled model
+		data (tf.data.Dataset): endless dataset of (xs, ys) batches
+		num_steps (int): number of timed training steps
+		batch_size (int): number of examples per batch of `data`
+		warmup_steps (int)
+	"""
+	model.fit(data, epochs=1, steps_per_epoch=warmup_steps, verbose=0)
+	start = time.perf_counter()
+	model.fit(data, epochs=1, steps_per_epoch=num_steps, verbose=0)
+	elapsed = time.perf_counter() - start
+	return num_steps * batch_size / elapsed
+
+def time_predict(model, xs, batch_size):
+	"""Get prediction throughput of a model on the array xs, in examples/sec.
+
+	One untimed batch is predicted first, so that tracing and XLA compilation are excluded.
+	"""
+	model.predict(xs[:batch_size], batch_size=batch_size, verbose=0)
+	start = time.perf_counter()
+	model.predict(xs, batch_size=batch_size, verbose=0)
+	elapsed = time.perf_counter() - start
+	return len(xs) / elapsed
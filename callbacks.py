@@ -1,10 +1,18 @@
-import os.path
+from collections import deque
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
 
-import numpy as np
 import tensorflow as tf
-import tensorflow.keras.backend as K
 import wandb
 
+import asha
 import constants
 import dataset
 import models
@@ -45,22 +53,161 @@ def get_early_stopping_callbacks(config):
         tf.keras.callbacks.EarlyStopping(**kwargs)
         for kwargs in config.early_stopping_callbacks]
 
+def get_asha_callback(config):
+    """Get an AshaPruning callback if config has `asha`, otherwise None.
+    Results go in a subdirectory of config.asha['dir'] for the current sweep."""
+    if config.get('asha') is None:
+        return None
+    kwargs = dict(config.asha)
+    sweep_id = getattr(wandb.run, 'sweep_id', None) or 'no-sweep'
+    kwargs['root_dir'] = os.path.join(kwargs.pop('dir'), sweep_id)
+    metric = kwargs.pop('metric', 'val_auroc')
+    trial_id = wandb.run.id if wandb.run is not None else None
+    return AshaPruning(asha.AshaCoordinator(**kwargs), metric=metric, trial_id=trial_id)
+
+class AshaPruning(tf.keras.callbacks.Callback):
+    """Stop training when the ASHA coordinator says this trial is not among the best at a rung, see asha.py."""
+    def __init__(self, coordinator, metric='val_auroc', trial_id=None):
+        super(AshaPruning, self).__init__()
+        self.coordinator = coordinator
+        self.metric = metric
+        self.trial_id = trial_id or uuid.uuid4().hex
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.metric)
+        if value is None:
+            raise KeyError(f"ASHA metric `{self.metric}` not found in logs, found {list((logs or {}).keys())}")
+        if not self.coordinator.report(self.trial_id, epoch + 1, value):
+            print(f"ASHA: stopping after epoch {epoch + 1}, {self.metric} = {value:.4}")
+            self.model.stop_training = True
+            if wandb.run is not None:
+                wandb.run.summary['asha_stopped_epoch'] = epoch + 1
+
 class AdditionalValidationLogger(tf.keras.callbacks.Callback):
-    """Log additional validation set metrics after each epoch."""
-    def __init__(self, additional_val):
+    """Log additional validation set metrics after every `every_n_epochs` epochs, and after the last epoch."""
+    def __init__(self, additional_val, every_n_epochs=1):
         super(AdditionalValidationLogger, self).__init__()
         self.additional_val = additional_val
+        self.every_n_epochs = every_n_epochs
 
     def on_epoch_end(self, epoch, logs):
+        if not self._should_evaluate(epoch):
+            return
         results = self.additional_val.evaluate()
         print({k: f"{v:.4}" for k, v in results.items()})
         wandb.log(results)
 
-def get_additional_validation_callback(config, model):
-    additional_val = models.get_additional_validation(config, model)
+    def _should_evaluate(self, epoch):
+        return (epoch + 1) % self.every_n_epochs == 0 or epoch + 1 == self.params.get('epochs')
+
+class AsyncAdditionalValidationLogger(AdditionalValidationLogger):
+    """Evaluate additional validation sets in a background process, while training continues.
+
+    At each evaluated epoch, the model is saved to a temporary file (the whole model the first time, and
+    then only the weights), and a worker process loads it into its own copy of the model and evaluates it,
+    see _additional_validation_worker(). Results are logged with the `epoch` they belong to when they
+    finish. The end of training waits for pending evaluations.
+
+    Args:
+        config (dict): config, used by the worker to load the additional validation sets
+        num_cores (int): (Optional) number of CPU cores for the worker. If None, it shares all cores with training.
+    """
+    def __init__(self, config, every_n_epochs=1, num_cores=None):
+        super(AsyncAdditionalValidationLogger, self).__init__(None, every_n_epochs=every_n_epochs)
+        self.config = {k: v for k, v in config.items() if not k.startswith('_')}
+        self.num_cores = num_cores
+        self.tmp_dir = None
+        self.process = None
+        self.model_saved = False
+        self.num_pending = 0
+
+    def on_train_begin(self, logs=None):
+        self.tmp_dir = tempfile.mkdtemp()
+        # Not fork, since tensorflow is already running in this process
+        ctx = multiprocessing.get_context('spawn')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(
+            target=_additional_validation_worker, args=(self.config, self.num_cores, self.tasks, self.results),
+            daemon=True)
+        self.process.start()
+
+    def on_epoch_end(self, epoch, logs):
+        self._log_finished(block=False)
+        if not self._should_evaluate(epoch):
+            return
+        # The worker evaluates in order, so only the first snapshot needs the whole model
+        if not self.model_saved:
+            path = os.path.join(self.tmp_dir, f'model-{epoch}.h5')
+            self.model.save(path)
+            self.model_saved = True
+        else:
+            path = os.path.join(self.tmp_dir, f'weights-{epoch}.h5')
+            self.model.save_weights(path)
+        self.tasks.put((epoch, path))
+        self.num_pending += 1
+
+    def on_train_end(self, logs=None):
+        if self.num_pending > 0:
+            print(f"Waiting for {self.num_pending} additional validation(s) to finish...")
+        self._log_finished(block=True)
+        self.tasks.put(None)
+        self.process.join()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _log_finished(self, block):
+        """Log the results of finished evaluations. If block is True, wait for all pending evaluations."""
+        while self.num_pending > 0:
+            try:
+                epoch, results = self.results.get(timeout=10 if block else 0.01)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError(f"Additional validation process exited with code {self.process.exitcode}")
+                if block:
+                    continue
+                return
+            self.num_pending -= 1
+            print(f"Additional validation, epoch {epoch + 1}:", {k: f"{v:.4}" for k, v in results.items()})
+            for key in results:
+                wandb.define_metric(key, step_metric='epoch')
+            wandb.log({'epoch': epoch, **results})
+
+def _additional_validation_worker(config, num_cores, tasks, results):
+    """Evaluate each model in `tasks` on the additional validation sets, until None is received.
+    Runs in a separate process, see AsyncAdditionalValidationLogger.
+    """
+    import utils
+    if num_cores is not None:
+        # Run on the last cores only, which also sizes tensorflow's default thread pools to the budget
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, sorted(os.sched_getaffinity(0))[-num_cores:])
+        utils.set_threads(intra_op_threads=num_cores)
+    wandb.init(config=config, mode='disabled')
+    config = wandb.config
+
+    model, additional_val = None, None
+    for epoch, path in iter(tasks.get, None):
+        if model is None:
+            model = models.load_model(path)
+            additional_val = models.get_additional_validation(
+                config, model, num_examples=config.get('additional_val_num_examples'))
+        else:
+            model.load_weights(path)
+        os.remove(path)
+        results.put((epoch, additional_val.evaluate()))
+
+def get_additional_validation_callback(config, model, val_datasets=None):
+    every_n_epochs = config.get('additional_val_every_n_epochs') or 1
+    if config.get('additional_val_async'):
+        if config.get('additional_val_data_paths') is None:
+            return None
+        return AsyncAdditionalValidationLogger(
+            config, every_n_epochs=every_n_epochs, num_cores=config.get('additional_val_num_cores'))
+    additional_val = models.get_additional_validation(
+        config, model, val_datasets=val_datasets, num_examples=config.get('additional_val_num_examples'))
     if additional_val is None:
         return None
-    return AdditionalValidationLogger(additional_val)
+    return AdditionalValidationLogger(additional_val, every_n_epochs=every_n_epochs)
 
 def get_model_checkpoint_callback():
     """Save latest model after each epoch."""
@@ -70,46 +217,181 @@ def get_model_checkpoint_callback():
     filepath = os.path.join(run_dir, 'model-latest.h5')
     return tf.keras.callbacks.ModelCheckpoint(filepath)
 
-def get_momentum_callback(steps_per_epoch, config):
-    if config.momentum_schedule == 'cyclic':
-        cycle_period_epochs = config.num_epochs / config.lr_cyc_num_cycles
-        # Number of iterations in half of a cycle
-        step_size = steps_per_epoch * cycle_period_epochs / 2
-        return CyclicMomentum(step_size, config.momentum_base, config.momentum_max)
-    else:
+class ResumableCheckpoint(tf.keras.callbacks.Callback):
+    """Save everything needed to resume training after each epoch, see restore_checkpoint().
+
+    Each checkpoint is a directory `ckpt-<epoch>` in checkpoint_dir, with:
+        - a tf.train.Checkpoint of the model weights and the optimizer, including its slots
+          and iteration count, which drives the learning rate and momentum schedules
+        - STATE_FILE, a JSON file with the number of completed epochs, the number of steps per epoch,
+          the wandb run id, and the training SequenceCollection sampling state
+    The file LATEST_FILE in checkpoint_dir names the latest complete checkpoint, and older checkpoints are deleted.
+
+    Checkpoints are written to a local staging directory, then copied to checkpoint_dir on a background thread,
+    so that training does not wait on slow network storage. At most one copy is in progress at a time.
+
+    Args:
+        checkpoint_dir (str): directory to save checkpoints in
+        sequence_collection (dataset.SequenceCollection): (Optional) training data to save the sampling state of
+    """
+    STATE_FILE = 'state.json'
+    LATEST_FILE = 'latest'
+
+    def __init__(self, checkpoint_dir, sequence_collection=None):
+        super(ResumableCheckpoint, self).__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.sequence_collection = sequence_collection
+        self.staging_dir = None
+        self.thread = None
+        self.error = None
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        self.staging_dir = tempfile.mkdtemp(prefix='checkpoint-')
+        self.checkpoint = get_checkpoint(self.model)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._wait()
+        name = f"ckpt-{epoch + 1}"
+        state = {
+            'epoch': epoch + 1,
+            # Resumed runs keep the same epoch length, and so the same schedules, see train.get_steps_per_epoch()
+            'steps_per_epoch': self.params.get('steps'),
+            'wandb_run_id': wandb.run.id if wandb.run is not None else None,
+            'sampler': self.sequence_collection.get_state() if self.sequence_collection is not None else None
+        }
+        staging_path = os.path.join(self.staging_dir, name)
+        self.checkpoint.write(os.path.join(staging_path, 'ckpt'))
+        with open(os.path.join(staging_path, self.STATE_FILE), 'w') as f:
+            json.dump(state, f)
+        self.thread = threading.Thread(target=self._copy, args=(name,))
+        self.thread.start()
+
+    def on_train_end(self, logs=None):
+        self._wait()
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def _wait(self):
+        """Wait for the copy in progress, if any."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            print(f"Warning: failed to save checkpoint to {self.checkpoint_dir}: {self.error}")
+            self.error = None
+
+    def _copy(self, name):
+        """Copy a staged checkpoint to checkpoint_dir, then point LATEST_FILE to it and delete older checkpoints."""
+        try:
+            staging_path = os.path.join(self.staging_dir, name)
+            tmp_path = os.path.join(self.checkpoint_dir, name + '.tmp')
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            shutil.copytree(staging_path, tmp_path)
+            shutil.rmtree(os.path.join(self.checkpoint_dir, name), ignore_errors=True)
+            os.replace(tmp_path, os.path.join(self.checkpoint_dir, name))
+            # Write the pointer atomically, so that it always names a complete checkpoint
+            latest_path = os.path.join(self.checkpoint_dir, self.LATEST_FILE)
+            with open(latest_path + '.tmp', 'w') as f:
+                f.write(name)
+            os.replace(latest_path + '.tmp', latest_path)
+            for other in os.listdir(self.checkpoint_dir):
+                if other.startswith('ckpt-') and other != name:
+                    shutil.rmtree(os.path.join(self.checkpoint_dir, other), ignore_errors=True)
+            shutil.rmtree(staging_path, ignore_errors=True)
+        except Exception as e:
+            self.error = e
+
+def get_checkpoint(model):
+    """Get a tf.train.Checkpoint of the model and its optimizer."""
+    return tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+
+def read_checkpoint_state(checkpoint_dir):
+    """Get the state saved with the latest checkpoint in checkpoint_dir, or None if there is no checkpoint."""
+    latest_path = os.path.join(checkpoint_dir, ResumableCheckpoint.LATEST_FILE)
+    if not os.path.exists(latest_path):
         return None
+    with open(latest_path) as f:
+        name = f.read().strip()
+    with open(os.path.join(checkpoint_dir, name, ResumableCheckpoint.STATE_FILE)) as f:
+        state = json.load(f)
+    state['path'] = os.path.join(checkpoint_dir, name, 'ckpt')
+    return state
+
+def restore_checkpoint(state, model, sequence_collection=None):
+    """Restore training from a checkpoint saved by ResumableCheckpoint. Call this before fit().
+
+    Args:
+        state (dict): checkpoint state, from read_checkpoint_state()
+        model (keras model): compiled model with the same architecture and optimizer as the checkpoint
+        sequence_collection (dataset.SequenceCollection): (Optional) training data to restore the sampling state of
+
+    Returns:
+        int: number of completed epochs, to pass to fit() as initial_epoch
+    """
+    # Optimizer slots don't exist until the first update, so they are restored when they are created
+    get_checkpoint(model).restore(state['path']).expect_partial()
+    if sequence_collection is not None and state['sampler'] is not None:
+        sequence_collection.set_state(state['sampler'])
+    print(f"Restored checkpoint {state['path']}, resuming after epoch {state['epoch']}")
+    return state['epoch']
+
+def get_resumable_checkpoint_callback(checkpoint_dir, sequence_collection=None):
+    if checkpoint_dir is None:
+        return None
+    return ResumableCheckpoint(checkpoint_dir, sequence_collection=sequence_collection)
+
+def get_time_budget_callback(config):
+    if not config.get('budget_hours'):
+        return None
+    return TimeBudget(config.budget_hours)
+
+class TimeBudget(tf.keras.callbacks.Callback):
+    """Stop training at the end of an epoch if the next epoch might not finish within the time budget.
+
+    The next epoch is assumed to take as long as the longest epoch so far, including validation.
+    Models and checkpoints are saved at the end of each epoch by the other callbacks, so training
+    stops with everything saved, and can be resumed from the checkpoint, see ResumableCheckpoint.
+
+    Args:
+        budget_hours (float): time budget, from when this callback is created
+    """
+    def __init__(self, budget_hours):
+        super(TimeBudget, self).__init__()
+        self.deadline = time.time() + budget_hours * 3600
+        self.epoch_start = None
+        self.max_epoch_time = 0.
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.max_epoch_time = max(self.max_epoch_time, time.time() - self.epoch_start)
+        if time.time() + self.max_epoch_time > self.deadline:
+            print(f"Time budget: stopping after epoch {epoch + 1}, the next epoch might not finish in time")
+            self.model.stop_training = True
+            if wandb.run is not None:
+                wandb.run.summary['budget_stopped_epoch'] = epoch + 1
+
+def get_momentum_history_callback(config, optimizer):
+    if not config.get('momentum_history_size'):
+        return None
+    return MomentumHistory(optimizer, config.momentum_history_size)
+
+class MomentumHistory(tf.keras.callbacks.Callback):
+    """Record the momentum (SGD) or beta_1 (Adam) at the end of each epoch, keeping only the latest max_len values.
+
+    Momentum schedules are evaluated in the training step, see lr_schedules.set_momentum_schedule(),
+    so this only reads the value once per epoch, and doesn't slow down training steps.
+
+    Attributes:
+        history (dict): {'iterations': deque, 'momentum': deque}
+    """
+    def __init__(self, optimizer, max_len):
+        super(MomentumHistory, self).__init__()
+        self.optimizer = optimizer
+        self.name = 'momentum' if 'momentum' in optimizer._hyper else 'beta_1'
+        self.history = {'iterations': deque(maxlen=max_len), 'momentum': deque(maxlen=max_len)}
 
-class CyclicMomentum(tf.keras.callbacks.Callback):
-    """Adapted from /projects/pfenninggroup/machineLearningForComputationalBiology/retina/scripts/zoonomia/step9c_keras_cnn.py"""
-    def __init__(self, step_size, base_m, max_m):
-      self.base_m = base_m
-      self.max_m = max_m
-      self.step_size = step_size
-      self.clr_iterations = 0.
-      self.cm_iterations = 0.
-      self.trn_iterations = 0.
-      self.history = {}
-
-    def cm(self):
-      # NOTE this might break for num_cycles > 1.
-      cycle = np.floor(1+self.clr_iterations/(2*self.step_size))
-      if cycle == 2:
-        x = np.abs(self.clr_iterations/self.step_size - 2*cycle + 1)
-        return self.max_m
-      else:
-        x = np.abs(self.clr_iterations/self.step_size - 2*cycle + 1)
-        return self.max_m - (self.max_m-self.base_m)*np.maximum(0,(1-x))
-
-    def on_train_begin(self, logs={}):
-      logs = logs or {}
-      K.set_value(self.model.optimizer.momentum, self.cm())
-
-    def on_batch_begin(self, batch, logs=None):
-      logs = logs or {}
-      self.trn_iterations += 1
-      self.clr_iterations += 1
-      self.history.setdefault('iterations', []).append(self.trn_iterations)
-      self.history.setdefault('momentum', []).append(K.get_value(self.model.optimizer.momentum))
-      for k, v in logs.items():
-        self.history.setdefault(k, []).append(v)
-      K.set_value(self.model.optimizer.momentum, self.cm())
+    def on_epoch_end(self, epoch, logs=None):
+        self.history['iterations'].append(int(self.optimizer.iterations))
+        self.history['momentum'].append(float(getattr(self.optimizer, self.name)))
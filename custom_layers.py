@@ -0,0 +1,118 @@
+import tensorflow as tf
+from tensorflow.keras import layers
+
+import dataset
+
+
+class TokenConv1D(layers.Conv1D):
+    """Conv1D over base tokens, equivalent to Conv1D over the one-hot encoding of the same sequence.
+
+    Inputs have shape [batch_size, seq_len], with token values as in dataset.ENCODINGS.
+    The kernel has the same shape as for one-hot inputs, [kernel_size, 4, filters], so weights
+    can be copied to and from a Conv1D layer.
+
+    Instead of multiplying each kernel position by a mostly-zero one-hot vector, the kernel row
+    for the base at that position is gathered, and the rows are summed. N tokens gather a row of
+    zeros, which matches the all-zero one-hot encoding of N.
+
+    Only padding='valid' and dilation_rate=1 are supported.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.input_spec = layers.InputSpec(ndim=2)
+
+    def build(self, input_shape):
+        if self.padding != 'valid' or self.dilation_rate != (1,):
+            raise ValueError(f"{self.__class__.__name__} only supports padding='valid' and dilation_rate=1")
+        super().build(self._onehot_shape(input_shape))
+        self.input_spec = layers.InputSpec(ndim=2)
+
+    def compute_output_shape(self, input_shape):
+        return super().compute_output_shape(self._onehot_shape(input_shape))
+
+    @staticmethod
+    def _onehot_shape(input_shape):
+        """Shape of the one-hot encoding of inputs with shape input_shape."""
+        input_shape = tf.TensorShape(input_shape)
+        if input_shape.rank == 2:
+            input_shape = input_shape.concatenate(dataset.NUM_BASES)
+        return input_shape
+
+    def convolution_op(self, inputs, kernel):
+        return token_convolution(inputs, kernel, self.strides[0])
+
+def token_convolution(tokens, kernel, stride=1):
+    """Valid 1D convolution of base tokens with a one-hot kernel, by gathering kernel rows.
+
+    Args:
+        tokens (tf.Tensor): [batch_size, seq_len], integer base tokens
+        kernel (tf.Tensor): [kernel_size, 4, filters]
+        stride (int)
+
+    Returns:
+        tf.Tensor: [batch_size, (seq_len - kernel_size) // stride + 1, filters]
+    """
+    kernel_size = kernel.shape[0]
+    # Row of zeros for N tokens
+    kernel = tf.pad(kernel, [[0, 0], [0, 1], [0, 0]])
+    tokens = tf.cast(tokens, tf.int32)
+    out_len = (tf.shape(tokens)[1] - kernel_size) // stride + 1
+    outputs = 0.
+    for k in range(kernel_size):
+        window = tokens[:, k:k + (out_len - 1) * stride + 1:stride]
+        outputs += tf.gather(kernel[k], window)
+    return outputs
+
+class RevCompConv1D(layers.Conv1D):
+    """Reverse-complement parameter-shared Conv1D.
+    See Shrikumar et al. 2017: https://doi.org/10.1101/103663
+
+    Each filter is applied along with its reverse complement, so the output has 2 * filters channels:
+    the forward filters, followed by the reverse complement filters in reverse order. With this
+    channel order, reversing the channel axis of the output swaps each filter with its reverse
+    complement, in the same way that reversing the channel axis of a one-hot (A, C, G, T) input
+    complements it. So reverse complementing the input (reversing both the sequence and channel axes)
+    reverse complements the output, and a stack of RevCompConv1D layers stays equivariant.
+    Use RevCompMax after the stack to get features that are invariant to the strand.
+
+    Equivariance is exact when (seq_len - kernel_size) is divisible by the stride, so that
+    the first and last windows line up on both strands.
+    """
+    def call(self, inputs):
+        outputs = tf.concat([
+            self.convolution_op(inputs, self.kernel),
+            self.convolution_op(inputs, revcomp_kernel(self.kernel))[..., ::-1]], axis=-1)
+        if self.use_bias:
+            outputs = tf.nn.bias_add(outputs, tf.concat([self.bias, self.bias[::-1]], axis=0))
+        if self.activation is not None:
+            outputs = self.activation(outputs)
+        return outputs
+
+    def compute_output_shape(self, input_shape):
+        output_shape = super().compute_output_shape(input_shape)
+        return output_shape[:-1].concatenate(2 * self.filters)
+
+class TokenRevCompConv1D(RevCompConv1D, TokenConv1D):
+    """RevCompConv1D over base tokens, see TokenConv1D."""
+    pass
+
+class RevCompMax(layers.Layer):
+    """Merge the strands of a RevCompConv1D output, so that it is invariant to reverse complementing the input.
+
+    Inputs have shape [batch_size, seq_len, 2 * filters], as output by RevCompConv1D.
+    Outputs have shape [batch_size, seq_len, filters], where each value is the max of a forward filter
+    at position i and its reverse complement filter at the mirrored position seq_len - 1 - i.
+    """
+    def call(self, inputs):
+        filters = inputs.shape[-1] // 2
+        forward = inputs[..., :filters]
+        revcomp = inputs[:, ::-1, filters:][..., ::-1]
+        return tf.maximum(forward, revcomp)
+
+    def compute_output_shape(self, input_shape):
+        input_shape = tf.TensorShape(input_shape)
+        return input_shape[:-1].concatenate(input_shape[-1] // 2)
+
+def revcomp_kernel(kernel):
+    """Reverse complement a [kernel_size, channels, filters] kernel, by reversing the position and channel axes."""
+    return kernel[::-1, ::-1, :]
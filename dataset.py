@@ -1,4 +1,7 @@
 from collections import Counter
+import hashlib
+import json
+import os
 
 import numpy as np
 from Bio import SeqIO
@@ -10,11 +13,101 @@ import constants
 # A, C, G, T
 NUM_BASES = 4
 
+# Sequence encodings:
+#   'onehot': int8 array of shape (seq_len, 4)
+#   'tokens': uint8 array of shape (seq_len,) with base indices, and TOKEN_N for any other base
+ENCODINGS = ('onehot', 'tokens')
+TOKEN_N = NUM_BASES
+
+# Maps ASCII codes to base tokens
+BASE_TOKENS = np.full(256, TOKEN_N, dtype='uint8')
+for idx, base in enumerate('ACGT'):
+    BASE_TOKENS[ord(base)] = idx
+    BASE_TOKENS[ord(base.lower())] = idx
+# Maps base tokens to one-hot rows. N is all zeros.
+TOKEN_ONEHOT = np.concatenate([np.eye(NUM_BASES, dtype='int8'), np.zeros((1, NUM_BASES), dtype='int8')])
+
 # random seed for reproducibility
 SEED = 0
 rng = np.random.default_rng(SEED)
 
 
+def encode(seq, encoding='onehot'):
+    """Encode a sequence, e.g. a Bio.Seq.Seq or str, as one-hot or tokens. See ENCODINGS."""
+    tokens = BASE_TOKENS[np.frombuffer(str(seq).encode('ascii'), dtype='uint8')]
+    if encoding == 'tokens':
+        return tokens
+    return TOKEN_ONEHOT[tokens]
+
+def reverse_complement_tokens(tokens):
+    """Reverse complement a sequence of base tokens. Complementing A, C, G, T = 0, 1, 2, 3 is 3 - token, and N stays N."""
+    tokens = np.asarray(tokens)
+    return np.where(tokens == TOKEN_N, TOKEN_N, NUM_BASES - 1 - tokens).astype('uint8')[::-1]
+
+def get_fingerprint(source_files, **kwargs):
+    """Get a short hash that identifies a dataset, e.g. for naming caches of per-example data.
+
+    Args:
+        source_files (list of str or dict): source files, as in SequenceTfDataset.
+            The hash includes the size and modification time of each file, so it changes if a file changes.
+        kwargs: other args that affect the examples, e.g. reverse_complement=True
+    """
+    files = []
+    for source in source_files:
+        paths = [source] if isinstance(source, str) else [source['genome'], source['intervals']]
+        files.append([(path, os.path.getsize(path), os.path.getmtime(path)) for path in paths])
+    spec = json.dumps({'source_files': files, **kwargs}, sort_keys=True, default=str)
+    return hashlib.sha1(spec.encode()).hexdigest()[:16]
+
+def get_file_hash(path):
+    """Short hash of a file's contents, e.g. a model file, for naming caches with get_fingerprint()."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()[:16]
+
+def get_genome_tokens(genome_file, cache_dir='dataset_cache'):
+    """Get the base tokens of each chromosome of a genome .fa, memory mapped, e.g. for scanning windows.
+
+    The genome is encoded once, into `{fingerprint}-genome.tokens` in cache_dir, with an index of each
+    chromosome's offset and length in `{fingerprint}-genome.json`. Later calls only memory map the file.
+
+    Returns:
+        dict: {chrom: uint8 array of tokens, see ENCODINGS}, in the order of the .fa
+    """
+    fingerprint = get_fingerprint([genome_file])
+    path = os.path.join(cache_dir, f"{fingerprint}-genome.tokens")
+    index_path = os.path.join(cache_dir, f"{fingerprint}-genome.json")
+    if not os.path.exists(index_path):
+        # Write to temporary files first, as in MemmapDataset
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        index = []
+        offset = 0
+        with open(tmp_path, 'wb') as f:
+            for record in tqdm(SeqIO.parse(genome_file, "fasta"), desc=f"Encoding {genome_file}"):
+                f.write(encode(record.seq, 'tokens').tobytes())
+                index.append({'chrom': record.id, 'offset': offset, 'len': len(record)})
+                offset += len(record)
+        os.replace(tmp_path, path)
+        with open(f"{index_path}.{os.getpid()}.tmp", 'w') as f:
+            json.dump(index, f)
+        os.replace(f"{index_path}.{os.getpid()}.tmp", index_path)
+
+    with open(index_path) as f:
+        index = json.load(f)
+    tokens = np.memmap(path, dtype='uint8', mode='r') if os.path.getsize(path) > 0 else np.zeros(0, dtype='uint8')
+    return {entry['chrom']: tokens[entry['offset']:entry['offset'] + entry['len']] for entry in index}
+
+def get_seq_shape(seq_len, encoding='onehot'):
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Invalid encoding `{encoding}`, valid encodings are {ENCODINGS}")
+    if encoding == 'tokens':
+        return (seq_len,)
+    return (seq_len, NUM_BASES)
+
+
 class BedSource:
     """Iterator of sequences from a .bed or .narrowPeaks file and corresponding reference genome .fa file.
     Can reload itself once exhausted.
@@ -23,36 +116,43 @@ class BedSource:
         genome_file (str): path to whole-genome reference FASTA file.
         bed_file (str): path to .bed or .narrowPeaks file with intervals.
         endlesss (bool): if True, then restart iterator once exhausted.
+        encoding (str): 'onehot' or 'tokens', see ENCODINGS.
     """
-    base_mapping = {'A':0, 'a':0,
-                    'C':1, 'c':1,
-                    'G':2, 'g':2,
-                    'T':3, 't':3}
-
-    def __init__(self, genome_file: str, bed_file: str, endless: bool=False, bedfile_columns=None, reverse_complement: bool=False):
+    def __init__(self, genome_file: str, bed_file: str, endless: bool=False, bedfile_columns=None, reverse_complement: bool=False,
+        encoding: str='onehot'):
         self.genome_file = genome_file
         self.bed_file = bed_file
         self.endless = endless
         self.bedfile_columns = bedfile_columns
         self.reverse_complement = reverse_complement
+        self.encoding = encoding
         self.intervals = self.get_intervals(self.bed_file, self.genome_file)
         self.len = self._get_len()
         self.seq_len = self._get_seq_len()
         self._load_gen()
-        self.seq_shape = (self.seq_len, NUM_BASES)
+        self.seq_shape = get_seq_shape(self.seq_len, self.encoding)
 
     def __iter__(self):
         return self
 
     def __next__(self):
         try:
-            return next(self.gen)
+            data = next(self.gen)
         except StopIteration as e:
             if self.endless:
                 self._load_gen()
-                return next(self.gen)
+                data = next(self.gen)
             else:
                 raise e
+        self.position += 1
+        return data
+
+    def seek(self, position):
+        """Restart the iterator, then skip the first `position` sequences. See SequenceCollection.set_state()."""
+        self._load_gen()
+        for _ in range(position):
+            next(self.gen)
+        self.position = position
 
     def __len__(self):
         return self.len
@@ -74,11 +174,14 @@ class BedSource:
         return seq_len
 
     def _load_gen(self):
+        # Number of sequences yielded since the last reload
+        self.position = 0
+
         def seq_gen():
             for seq in SeqIO.parse(self.intervals.seqfn, "fasta"):
-                yield self._onehot(seq)
+                yield self._encode(seq)
                 if self.reverse_complement:
-                    yield self._onehot(seq.reverse_complement())
+                    yield self._encode(seq.reverse_complement())
         seq_gen = seq_gen()
 
         if not self.bedfile_columns:
@@ -112,12 +215,8 @@ class BedSource:
 
             self.gen = zip(seq_gen, column_gen)
 
-    def _onehot(self, seq):
-        res = np.zeros(self.seq_shape, dtype='int8')
-        for idx, base in enumerate(seq):
-            if base in self.base_mapping:
-                res[idx, self.base_mapping[base]] = 1
-        return res
+    def _encode(self, seq):
+        return encode(seq.seq, self.encoding)
 
     @staticmethod
     def get_intervals(bed_file, genome_file=None):
@@ -143,33 +242,39 @@ class FastaSource:
     Args:
         fa_file (str): FASTA file to read lines from.
         endlesss (bool): if True, then restart iterator once exhausted.
+        encoding (str): 'onehot' or 'tokens', see ENCODINGS.
     """
-    base_mapping = {'A':0, 'a':0,
-                    'C':1, 'c':1,
-                    'G':2, 'g':2,
-                    'T':3, 't':3}
-
-    def __init__(self, fa_file: str, endless: bool=False, reverse_complement: bool=False):
+    def __init__(self, fa_file: str, endless: bool=False, reverse_complement: bool=False, encoding: str='onehot'):
         self.fa_file = fa_file
         self.endless = endless
         self.reverse_complement = reverse_complement
+        self.encoding = encoding
         self.len = self._get_len()
         self.seq_len = self._get_seq_len()
         self._load_gen()
-        self.seq_shape = (self.seq_len, NUM_BASES)
+        self.seq_shape = get_seq_shape(self.seq_len, self.encoding)
 
     def __iter__(self):
         return self
 
     def __next__(self):
         try:
-            return self._onehot(next(self.fa_gen))
+            seq = next(self.fa_gen)
         except StopIteration as e:
             if self.endless:
                 self._load_gen()
-                return self._onehot(next(self.fa_gen))
+                seq = next(self.fa_gen)
             else:
                 raise e
+        self.position += 1
+        return self._encode(seq)
+
+    def seek(self, position):
+        """Restart the iterator, then skip the first `position` sequences. See SequenceCollection.set_state()."""
+        self._load_gen()
+        for _ in range(position):
+            next(self.fa_gen)
+        self.position = position
 
     def __len__(self):
         return self.len
@@ -193,6 +298,9 @@ class FastaSource:
         return seq_len
 
     def _load_gen(self):
+        # Number of sequences yielded since the last reload
+        self.position = 0
+
         def gen():
             for seq in SeqIO.parse(self.fa_file, "fasta"):
                 yield seq
@@ -200,12 +308,8 @@ class FastaSource:
                     yield seq.reverse_complement()
         self.fa_gen = gen()
 
-    def _onehot(self, seq):
-        res = np.zeros(self.seq_shape, dtype='int8')
-        for idx, base in enumerate(seq.seq):
-            if base in self.base_mapping:
-                res[idx, self.base_mapping[base]] = 1
-        return res
+    def _encode(self, seq):
+        return encode(seq.seq, self.encoding)
 
 class SequenceCollection:
     """Iterable collection of sequences from FASTA, BED, or NarrowPeak files.
@@ -215,9 +319,11 @@ class SequenceCollection:
     """
 
     def __init__(self, source_files, targets, targets_are_classes: bool, endless: bool=True,
-        map_targets: bool=True, reverse_complement: bool=False):
+        map_targets: bool=True, reverse_complement: bool=False, encoding: str='onehot'):
         if len(source_files) != len(targets):
             raise ValueError("Number of source_files and number of targets must be equal")
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Invalid encoding `{encoding}`, valid encodings are {ENCODINGS}")
 
         self.source_files = source_files
         self.targets = targets
@@ -225,6 +331,7 @@ class SequenceCollection:
         self.map_targets = map_targets
         self.endless = endless
         self.reverse_complement = reverse_complement
+        self.encoding = encoding
         self.sources = self._get_sources()
         self.num_sources = len(self.sources)
         self.seq_shape = self._get_seq_shape()
@@ -237,7 +344,8 @@ class SequenceCollection:
         for source, target_spec in zip(self.source_files, self.targets):
             if isinstance(source, str):
                 # path to FASTA file of sequences
-                source_obj = FastaSource(source, endless=self.endless, reverse_complement=self.reverse_complement)
+                source_obj = FastaSource(source, endless=self.endless, reverse_complement=self.reverse_complement,
+                    encoding=self.encoding)
             elif isinstance(source, dict):
                 # genome FA file and interval BED file
                 for key in ['genome', 'intervals']:
@@ -250,7 +358,8 @@ class SequenceCollection:
                     bedfile_columns = (target_spec['column'],)
                 source_obj = BedSource(
                     source['genome'], source['intervals'], endless=self.endless,
-                    bedfile_columns=bedfile_columns, reverse_complement=self.reverse_complement)
+                    bedfile_columns=bedfile_columns, reverse_complement=self.reverse_complement,
+                    encoding=self.encoding)
             else:
                 raise ValueError(f"Invalid source specification: {source}")
             sources.append(source_obj)
@@ -349,18 +458,31 @@ class SequenceCollection:
         return seq, target_val
 
     def __iter__(self):
+        for seq, target_val, _ in self.iter_with_index():
+            yield seq, target_val
+
+    def iter_with_index(self):
+        """Iterate over (seq, target_val, index), where index is the position of the example in non-endless order:
+        all examples of the first source, then all examples of the second source, and so on.
+
+        The index is the same when endless, so per-example data, e.g. distillation targets, can be computed
+        once in non-endless order and looked up while sampling.
+        """
+        offsets = np.cumsum([0] + self.source_freqs['source_lens'][:-1])
         if self.endless:
             while True:
                 source_idx = rng.choice(self.num_sources, p=self.source_freqs['source_freqs'])
                 source, target_spec = self.sources[source_idx], self.targets[source_idx]
                 data = next(source)
                 seq, target_val = self._get_example(data, target_spec)
-                yield seq, target_val
+                yield seq, target_val, offsets[source_idx] + source.position - 1
         else:
-            for source, target_spec in zip(self.sources, self.targets):
+            for source_idx, (source, target_spec) in enumerate(zip(self.sources, self.targets)):
+                # Restart the source, so that the collection can be iterated more than once
+                source.seek(0)
                 for data in source:
                     seq, target_val = self._get_example(data, target_spec)
-                    yield seq, target_val
+                    yield seq, target_val, offsets[source_idx] + source.position - 1
 
     def __call__(self):
         return self
@@ -368,6 +490,29 @@ class SequenceCollection:
     def __len__(self):
         return self.len
 
+    def get_state(self):
+        """Get the sampling state, so that iteration can be resumed later with set_state().
+
+        The state is the random generator state, shared by all collections, and the position within each source.
+        It is JSON serializable.
+        """
+        return {
+            'rng': rng.bit_generator.state,
+            'source_positions': [source.position for source in self.sources]
+        }
+
+    def set_state(self, state):
+        """Resume from a state returned by get_state(). Call this before iterating.
+
+        Note that examples that were sampled but not yet trained on when the state was saved,
+        e.g. in the shuffle buffer of SequenceTfDataset, are skipped.
+        """
+        if len(state['source_positions']) != self.num_sources:
+            raise ValueError(f"State has {len(state['source_positions'])} sources, expected {self.num_sources}")
+        rng.bit_generator.state = state['rng']
+        for source, position in zip(self.sources, state['source_positions']):
+            source.seek(position)
+
 class FastaCollection:
     """DEPRECATED: Use SequenceCollection instead.
 
@@ -521,6 +666,11 @@ class SequenceTfDataset:
                 map_targets == True => yielded value is 0 (because 1 is the 0-th class)
                 map-targets == False => yielded value is 1
         reverse_complement (bool): if True, then add the reverse complement of each sequence.
+        encoding (str): how to encode sequences, see ENCODINGS.
+            if 'onehot', then each sequence is an int8 array of shape (seq_len, 4)
+            if 'tokens', then each sequence is a uint8 array of shape (seq_len,) with base
+                indices A=0, C=1, G=2, T=3, and N (or any other base) = TOKEN_N = 4.
+                This is 4x less data per example than 'onehot'.
 
     Sampling Logic: When endless == True, each example is randomly sampled from the set of
     data sources, proportionally to the size of each source. That is, if we have:
@@ -536,10 +686,10 @@ class SequenceTfDataset:
         ds (tf.data.Dataset): Same collection, as a tf Dataset.
         dataset (tf.data.Dataset or tuple(np.ndarray)): Data to pass to keras fit().
             If endless is True, this is a tf Dataset yielding batches:
-                xs (batch_size, seq_len, 4)
+                xs (batch_size, seq_len, 4), or (batch_size, seq_len) if encoding == 'tokens'
                 ys (batch_size,)
             If endless is False, this is a tuple of numpy arrays:
-                xs (num_sequences, seq_len, 4)
+                xs (num_sequences, seq_len, 4), or (num_sequences, seq_len) if encoding == 'tokens'
                 ys (num_sequences,)
         class_to_idx_mapping (dict): Maps class labels to the integer class output by the model.
             Applicable only when targets_are_classes == True.
@@ -547,7 +697,8 @@ class SequenceTfDataset:
         idx_to_class_mapping (dict): Maps integer classes to class labels.
             Applicable only when targets_are_classes = True.
             e.g. {0: "neg", 1: "pos"} or {0: "chr1", 1: "chr2", 2: "chrX"}
-        seq_shape (tuple of int): Dimensions of each example's input features, e.g. (500, 4)
+        seq_shape (tuple of int): Dimensions of each example's input features, e.g. (500, 4),
+            or (500,) if encoding == 'tokens'
         num_classes (int): If targets_are_classes == True, the number of classes.
             If targets_are_classes == False, None.
 
@@ -561,18 +712,20 @@ class SequenceTfDataset:
     """
     def __init__(self, source_files, targets, targets_are_classes: bool,
                     endless: bool=True, batch_size: int=constants.DEFAULT_BATCH_SIZE,
-                    map_targets: bool=True, reverse_complement: bool=False):
+                    map_targets: bool=True, reverse_complement: bool=False, encoding: str='onehot'):
         import tensorflow as tf
         self.sc = SequenceCollection(source_files, targets, targets_are_classes, endless=endless,
-            map_targets=map_targets, reverse_complement=reverse_complement)
+            map_targets=map_targets, reverse_complement=reverse_complement, encoding=encoding)
         self.targets_are_classes = targets_are_classes
         self.class_to_idx_mapping = self.sc.class_to_idx_mapping
         self.idx_to_class_mapping = self.sc.idx_to_class_mapping
         self.seq_shape = self.sc.seq_shape
         self.num_classes = self.sc.num_classes
+        self.encoding = encoding
+        seq_type = tf.uint8 if encoding == 'tokens' else tf.int8
         target_type = tf.int8 if targets_are_classes else tf.float32
         self.ds = tf.data.Dataset.from_generator(self.sc,
-            output_types=(tf.int8, target_type),
+            output_types=(seq_type, target_type),
             output_shapes=(tf.TensorShape(self.seq_shape), tf.TensorShape(())))
         self.batch_size = batch_size
         self.endless = endless
@@ -592,7 +745,7 @@ class SequenceTfDataset:
             size (int): Number of examples in subset.
 
         Returns:
-            xs (np.ndarray): [size, num_bp, 4], one-hot sequences
+            xs (np.ndarray): [size, num_bp, 4], one-hot sequences, or [size, num_bp] if encoding == 'tokens'
             ys (np.ndarray): [size, num_bp], labels
         """
         if size > len(self):
@@ -616,4 +769,63 @@ class SequenceTfDataset:
             return self.get_subset_as_arrays(len(self))
 
     def __len__(self):
-        return len(self.sc)
\ No newline at end of file
+        return len(self.sc)
+
+
+class MemmapDataset:
+    """Non-endless dataset that is encoded once into .npy files in cache_dir, and memory mapped only while in use.
+
+    Unlike SequenceTfDataset(endless=False), nothing is loaded when this is created. Each time `dataset` is read,
+    the cached arrays are memory mapped, after building the cache by streaming the examples if needed. Pages are
+    read from disk as they are used, and unmapped once the arrays are no longer referenced, so many large sets
+    can be kept for occasional evaluation, e.g. additional validation sets, with little resident memory.
+
+    Args:
+        source_files, targets, targets_are_classes, map_targets, reverse_complement, encoding: as in SequenceTfDataset
+        cache_dir (str): directory for the cached arrays, which are named by get_fingerprint()
+
+    Attributes:
+        dataset (tuple(np.ndarray)): memory mapped (xs, ys), as SequenceTfDataset.dataset when endless == False
+    """
+    def __init__(self, source_files, targets, targets_are_classes: bool, map_targets: bool=True,
+                    reverse_complement: bool=False, encoding: str='onehot', cache_dir: str='dataset_cache'):
+        self.source_files = source_files
+        self.targets = targets
+        self.targets_are_classes = targets_are_classes
+        self.map_targets = map_targets
+        self.reverse_complement = reverse_complement
+        self.encoding = encoding
+        self.cache_dir = cache_dir
+        fingerprint = get_fingerprint(source_files, targets=targets, targets_are_classes=targets_are_classes,
+            map_targets=map_targets, reverse_complement=reverse_complement, encoding=encoding)
+        self.paths = [os.path.join(cache_dir, f"{fingerprint}-{name}.npy") for name in ['xs', 'ys']]
+
+    @property
+    def dataset(self):
+        if not all(os.path.exists(path) for path in self.paths):
+            self._write_cache()
+        return tuple(np.load(path, mmap_mode='r') for path in self.paths)
+
+    def __len__(self):
+        return len(self.dataset[1])
+
+    def _write_cache(self):
+        sc = SequenceCollection(self.source_files, self.targets, self.targets_are_classes, endless=False,
+            map_targets=self.map_targets, reverse_complement=self.reverse_complement, encoding=self.encoding)
+        # Write to temporary files first, so that an interrupted run, or another process writing the same
+        # cache, doesn't leave a partial cache
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_paths = [f"{path}.{os.getpid()}.tmp.npy" for path in self.paths]
+        xs = np.lib.format.open_memmap(tmp_paths[0], mode='w+',
+            dtype='uint8' if self.encoding == 'tokens' else 'int8', shape=(len(sc),) + sc.seq_shape)
+        ys = np.lib.format.open_memmap(tmp_paths[1], mode='w+',
+            dtype='int8' if self.targets_are_classes else 'float32', shape=(len(sc),))
+        print(f"Caching {len(sc)} examples to {self.paths[0]}")
+        for idx, (seq, target_val) in enumerate(tqdm(sc, total=len(sc))):
+            xs[idx] = seq
+            ys[idx] = target_val
+        xs.flush()
+        ys.flush()
+        del xs, ys
+        for tmp_path, path in zip(tmp_paths, self.paths):
+            os.replace(tmp_path, path)
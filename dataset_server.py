@@ -0,0 +1,253 @@
+"""dataset_server.py: Serve datasets from shared memory to training processes on the same node.
+
+When several training processes (e.g. sweep agents) run on one node, each one normally loads and encodes
+its own copy of every dataset. The server loads each dataset in a config once, as arrays in POSIX shared
+memory, and writes a manifest for it to MANIFEST_DIR, named by dataset.get_fingerprint(). Training processes
+with `use_dataset_server: true` find datasets by fingerprint, and read them as numpy views of the shared
+memory, without copying. Datasets that aren't served are loaded as usual.
+
+Usage:
+- Start the server, and leave it running: python dataset_server.py -config config-base.yaml
+- Then start training processes with `use_dataset_server: true` in their config, on the same node.
+The server removes its shared memory and manifests when stopped, e.g. with Ctrl-C or scancel.
+"""
+
+import json
+import os
+import signal
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import constants
+import dataset
+
+
+# Node-local directory for manifests
+MANIFEST_DIR = '/dev/shm/cnn-dataset-server'
+
+
+def get_fingerprint(source_files, targets, targets_are_classes, map_targets=True, reverse_complement=False,
+    encoding='onehot'):
+    """Fingerprint of a dataset, from the SequenceTfDataset args that affect its examples."""
+    return dataset.get_fingerprint(source_files, targets=targets, targets_are_classes=targets_are_classes,
+        map_targets=map_targets, reverse_complement=reverse_complement, encoding=encoding)
+
+def get_dataset_loader(config):
+    """Get load_dataset if config has `use_dataset_server: true`, otherwise dataset.SequenceTfDataset.
+    Both take the same args."""
+    return load_dataset if config.get('use_dataset_server') else dataset.SequenceTfDataset
+
+def load_dataset(source_files, targets, targets_are_classes, endless=True, batch_size=constants.DEFAULT_BATCH_SIZE,
+    map_targets=True, reverse_complement=False, encoding='onehot', manifest_dir=MANIFEST_DIR):
+    """Get a dataset from the server if it is served, otherwise load it as a dataset.SequenceTfDataset.
+    Args are as for SequenceTfDataset.
+    """
+    fingerprint = get_fingerprint(source_files, targets, targets_are_classes, map_targets=map_targets,
+        reverse_complement=reverse_complement, encoding=encoding)
+    manifest_path = os.path.join(manifest_dir, f"{fingerprint}.json")
+    if os.path.exists(manifest_path):
+        try:
+            return SharedTfDataset(manifest_path, endless=endless, batch_size=batch_size)
+        except FileNotFoundError:
+            # The server stopped without removing its manifest
+            print(f"Shared memory for {manifest_path} not found, loading dataset without server")
+    else:
+        print(f"Dataset {fingerprint} is not served, loading dataset without server")
+    return dataset.SequenceTfDataset(source_files, targets, targets_are_classes, endless=endless,
+        batch_size=batch_size, map_targets=map_targets, reverse_complement=reverse_complement, encoding=encoding)
+
+class SharedTfDataset:
+    """Dataset in shared memory from a dataset server, with the same attributes as dataset.SequenceTfDataset.
+
+    Examples are sampled in the same way: when endless, each example is drawn from a random source,
+    proportionally to source size, and each source is read in order. When not endless, dataset is
+    a tuple of numpy arrays that are views of the shared memory.
+
+    Args:
+        manifest_path (str): path to a manifest written by the server
+        endless (bool)
+        batch_size (int)
+    """
+    def __init__(self, manifest_path, endless=True, batch_size=constants.DEFAULT_BATCH_SIZE):
+        import tensorflow as tf
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        self.xs, self._shm_xs = _attach(manifest['xs'])
+        self.ys, self._shm_ys = _attach(manifest['ys'])
+        self.targets_are_classes = manifest['targets_are_classes']
+        self.class_to_idx_mapping = _pairs_to_dict(manifest['class_to_idx_mapping'])
+        self.idx_to_class_mapping = _pairs_to_dict(manifest['idx_to_class_mapping'])
+        self.class_counts = _pairs_to_dict(manifest['class_counts'])
+        self.num_classes = manifest['num_classes']
+        self.seq_shape = tuple(manifest['seq_shape'])
+        self.encoding = manifest['encoding']
+        self.batch_size = batch_size
+        self.endless = endless
+        self.sc = SharedSampler(self.xs, self.ys, manifest['source_lens'])
+        self.ds = tf.data.Dataset.from_generator(self.sc,
+            output_types=(tf.as_dtype(self.xs.dtype), tf.as_dtype(self.ys.dtype)),
+            output_shapes=(tf.TensorShape(self.seq_shape), tf.TensorShape(())))
+        self.dataset = self.ds.shuffle(batch_size * 16).batch(batch_size) if endless else (self.xs, self.ys)
+
+    def get_subset_as_arrays(self, size):
+        """Return a random subset as 2 numpy arrays, see dataset.SequenceTfDataset."""
+        if size > len(self):
+            raise ValueError(f"Requested subset size {size} is too large for dataset of size {len(self)}")
+        idxs = np.sort(dataset.rng.choice(len(self), size=size, replace=False))
+        return self.xs[idxs], self.ys[idxs]
+
+    def __len__(self):
+        return len(self.xs)
+
+class SharedSampler:
+    """Endless sampler over shared arrays, with the same sampling logic and state methods as dataset.SequenceCollection."""
+    def __init__(self, xs, ys, source_lens):
+        self.xs = xs
+        self.ys = ys
+        self.source_lens = source_lens
+        self.offsets = np.cumsum([0] + source_lens[:-1])
+        self.source_freqs = np.array(source_lens) / sum(source_lens)
+        self.positions = [0] * len(source_lens)
+
+    def __call__(self):
+        return self
+
+    def __iter__(self):
+        for seq, target_val, _ in self.iter_with_index():
+            yield seq, target_val
+
+    def iter_with_index(self):
+        while True:
+            source_idx = dataset.rng.choice(len(self.source_lens), p=self.source_freqs)
+            idx = self.offsets[source_idx] + self.positions[source_idx]
+            self.positions[source_idx] = (self.positions[source_idx] + 1) % self.source_lens[source_idx]
+            yield self.xs[idx], self.ys[idx], idx
+
+    def __len__(self):
+        return len(self.xs)
+
+    def get_state(self):
+        return {'rng': dataset.rng.bit_generator.state, 'source_positions': list(self.positions)}
+
+    def set_state(self, state):
+        dataset.rng.bit_generator.state = state['rng']
+        self.positions = list(state['source_positions'])
+
+def _attach(spec):
+    """Attach to a shared array, given its spec from the manifest."""
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    # Only the server should unlink the shared memory, but python < 3.13 unlinks it when any attached process exits
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    array = np.ndarray(spec['shape'], dtype=spec['dtype'], buffer=shm.buf)
+    array.flags.writeable = False
+    return array, shm
+
+def _pairs_to_dict(pairs):
+    """JSON objects only have string keys, so mappings are stored as lists of [key, value] pairs."""
+    return None if pairs is None else {k: v for k, v in pairs}
+
+def _dict_to_pairs(mapping):
+    return None if mapping is None else [[k, v] for k, v in mapping.items()]
+
+class DatasetServer:
+    """Loads datasets into shared memory, and writes a manifest for each one.
+
+    Args:
+        manifest_dir (str): directory to write manifests to
+    """
+    def __init__(self, manifest_dir=MANIFEST_DIR):
+        self.manifest_dir = manifest_dir
+        self.shms = []
+        self.manifest_paths = []
+        os.makedirs(manifest_dir, exist_ok=True)
+
+    def add(self, source_files, targets, targets_are_classes, map_targets=True, reverse_complement=False,
+        encoding='onehot'):
+        """Load a dataset into shared memory. Args are as for dataset.SequenceTfDataset."""
+        fingerprint = get_fingerprint(source_files, targets, targets_are_classes, map_targets=map_targets,
+            reverse_complement=reverse_complement, encoding=encoding)
+        manifest_path = os.path.join(self.manifest_dir, f"{fingerprint}.json")
+        if manifest_path in self.manifest_paths:
+            return
+        print(f"Loading dataset {fingerprint}...")
+        data = dataset.SequenceTfDataset(source_files, targets, targets_are_classes, endless=False,
+            map_targets=map_targets, reverse_complement=reverse_complement, encoding=encoding)
+        xs, ys = data.dataset
+        manifest = {
+            'fingerprint': fingerprint,
+            'xs': self._share(f"cnnds-{fingerprint}-xs", xs),
+            'ys': self._share(f"cnnds-{fingerprint}-ys", ys),
+            'source_lens': data.sc.source_freqs['source_lens'],
+            'targets_are_classes': targets_are_classes,
+            'class_to_idx_mapping': _dict_to_pairs(data.class_to_idx_mapping),
+            'idx_to_class_mapping': _dict_to_pairs(data.idx_to_class_mapping),
+            'class_counts': _dict_to_pairs(data.class_counts),
+            'num_classes': data.num_classes,
+            'seq_shape': list(data.seq_shape),
+            'encoding': encoding
+        }
+        # Write the manifest atomically, after the data is in shared memory
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f, default=int)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        self.manifest_paths.append(manifest_path)
+        print(f"Serving {len(xs)} examples, {(xs.nbytes + ys.nbytes) / 1e9:.2f} GB, manifest {manifest_path}")
+
+    def _share(self, name, array):
+        shm = shared_memory.SharedMemory(name=name, create=True, size=max(array.nbytes, 1))
+        self.shms.append(shm)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        return {'name': name, 'shape': list(array.shape), 'dtype': array.dtype.str}
+
+    def close(self):
+        """Remove manifests first, so that no new process attaches, then free the shared memory.
+        Processes that are already attached keep their views until they exit."""
+        for manifest_path in self.manifest_paths:
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+        self.manifest_paths, self.shms = [], []
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+def serve(config_path, manifest_dir=MANIFEST_DIR):
+    """Serve the training, validation, and additional validation datasets of a config until stopped."""
+    import utils
+    config, _ = utils.get_config(config_path)
+    kwargs = {
+        'targets_are_classes': config['targets_are_classes'],
+        'reverse_complement': config['use_reverse_complement'],
+        'encoding': config.get('input_encoding', 'onehot')}
+    server = DatasetServer(manifest_dir)
+    # Stop cleanly on scancel
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    try:
+        server.add(config['train_data_paths'], config['train_targets'], **kwargs)
+        server.add(config['val_data_paths'], config['val_targets'], **kwargs)
+        for paths, targets in zip(config.get('additional_val_data_paths') or [], config.get('additional_val_targets') or []):
+            # Same map_targets as models.get_additional_val_datasets()
+            server.add(paths, targets, map_targets=False, **kwargs)
+        print("Dataset server ready. Press Ctrl-C to stop.")
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+def get_args():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-config', type=str, required=True)
+    parser.add_argument('-manifest_dir', type=str, default=MANIFEST_DIR)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    serve(args.config, manifest_dir=args.manifest_dir)
@@ -0,0 +1,220 @@
+"""distill.py: Train a small student model to match the outputs of a trained teacher model.
+
+The teacher predicts on every training example once, and its outputs (soft targets) are cached on disk,
+in the non-endless order of the training SequenceCollection. The student is then trained like in train.py,
+on a mix of the soft targets and the true targets, see Distiller. Distilling several students from the
+same teacher and training data reuses the cached soft targets.
+
+Usage:
+- Single distillation run, from interactive session:
+	python distill.py -config <student config .yaml> -teacher <path to teacher model .h5> [-cache_dir <dir>]
+"""
+
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+import callbacks
+import constants
+import dataset
+import models
+import lr_schedules
+import utils
+
+import wandb
+from wandb.keras import WandbCallback
+
+
+DEFAULT_CACHE_DIR = 'distill_cache'
+
+
+def distill(args):
+	# Start `wandb`
+	config, project = utils.get_config(args.config)
+	wandb.init(config=config, project=project, mode=args.wandb_mode)
+	wandb.config.update({'teacher': args.teacher})
+	utils.validate_config(wandb.config)
+
+	# Get teacher outputs
+	soft_targets = get_soft_targets(args.teacher, wandb.config, args.cache_dir)
+
+	# Get datasets
+	train_data = dataset.SequenceTfDataset(
+		wandb.config.train_data_paths, wandb.config.train_targets,
+		targets_are_classes=wandb.config.targets_are_classes, endless=True,
+		batch_size=utils.get_micro_batch_size(wandb.config),
+		reverse_complement=wandb.config.use_reverse_complement,
+		encoding=wandb.config.get('input_encoding', 'onehot'))
+	val_data = dataset.SequenceTfDataset(
+		wandb.config.val_data_paths, wandb.config.val_targets,
+		targets_are_classes=wandb.config.targets_are_classes,
+		endless=not wandb.config.use_exact_val_metrics,
+		batch_size=utils.get_micro_batch_size(wandb.config),
+		reverse_complement=wandb.config.use_reverse_complement,
+		encoding=wandb.config.get('input_encoding', 'onehot'))
+	utils.validate_datasets([train_data, val_data])
+	if len(soft_targets) != len(train_data):
+		raise ValueError(f"Got {len(soft_targets)} soft targets for {len(train_data)} training examples")
+	train_ds = get_distillation_dataset(train_data, soft_targets, utils.get_class_weight(wandb.config, train_data))
+
+	# Get student model
+	steps_per_epoch_train, steps_per_epoch_val = utils.get_step_size(
+		wandb.config, train_data, val_data)
+	lr_schedule = lr_schedules.get_lr_schedule(
+		steps_per_epoch_train // utils.get_accum_steps(wandb.config), wandb.config)
+	momentum_schedule = lr_schedules.get_momentum_schedule(
+		steps_per_epoch_train // utils.get_accum_steps(wandb.config), wandb.config)
+	model = get_student_model(train_data, lr_schedule, wandb.config, momentum_schedule=momentum_schedule)
+
+	# Get callbacks
+	callback_fns = callbacks.get_early_stopping_callbacks(wandb.config) + [
+		WandbCallback(),
+		callbacks.OptimizerLogger(model.optimizer),
+		callbacks.get_additional_validation_callback(wandb.config, model),
+		callbacks.get_model_checkpoint_callback(),
+		callbacks.get_momentum_history_callback(wandb.config, model.optimizer)
+	]
+	callback_fns = [cb for cb in callback_fns if cb is not None]
+
+	# Train. Class weights are applied in train_ds, since keras can't map them from soft targets.
+	model.fit(
+		train_ds,
+		epochs=wandb.config.num_epochs,
+		steps_per_epoch=steps_per_epoch_train,
+		validation_data=val_data.dataset,
+		validation_steps=steps_per_epoch_val,
+		callbacks=callback_fns)
+
+def get_soft_targets(teacher_path, config, cache_dir=DEFAULT_CACHE_DIR, batch_size=constants.DEFAULT_BATCH_SIZE):
+	"""Get the teacher model's outputs on all training examples, in non-endless SequenceCollection order.
+
+	Outputs are cached in cache_dir as a .npy file, named by a hash of the teacher model file and a
+	fingerprint of the training data, and loaded as a memory map.
+
+	Returns:
+		np.ndarray: [num_train_examples, num_outputs], memory mapped
+	"""
+	key = dataset.get_file_hash(teacher_path) + '-' + dataset.get_fingerprint(
+		config.train_data_paths, targets=config.train_targets, reverse_complement=config.use_reverse_complement)
+	cache_path = os.path.join(cache_dir, f"soft-targets-{key}.npy")
+	if os.path.exists(cache_path):
+		print(f"Loading cached teacher outputs from {cache_path}")
+		return np.load(cache_path, mmap_mode='r')
+
+	teacher = models.load_model(teacher_path)
+	sc = dataset.SequenceCollection(
+		config.train_data_paths, config.train_targets, config.targets_are_classes, endless=False,
+		reverse_complement=config.use_reverse_complement, encoding=models.get_input_encoding(teacher))
+	ds = tf.data.Dataset.from_generator(lambda: (seq for seq, _ in sc),
+		output_types=tf.uint8 if models.get_input_encoding(teacher) == 'tokens' else tf.int8,
+		output_shapes=tf.TensorShape(sc.seq_shape)).batch(batch_size).prefetch(2)
+
+	# Write to a temporary file first, so that an interrupted run doesn't leave a partial cache
+	os.makedirs(cache_dir, exist_ok=True)
+	tmp_path = cache_path + '.tmp.npy'
+	soft_targets = np.lib.format.open_memmap(
+		tmp_path, mode='w+', dtype='float32', shape=(len(sc),) + teacher.output_shape[1:])
+	print(f"Predicting teacher outputs on {len(sc)} training examples...")
+	start = 0
+	for xs in ds:
+		preds = teacher.predict_on_batch(xs)
+		soft_targets[start:start + len(preds)] = preds
+		start += len(preds)
+	soft_targets.flush()
+	del soft_targets
+	os.replace(tmp_path, cache_path)
+	return np.load(cache_path, mmap_mode='r')
+
+def get_distillation_dataset(train_data, soft_targets, class_weight=None):
+	"""Get an endless, batched tf.data.Dataset of (xs, ys, sample_weights) for training a Distiller.
+
+	ys has shape [batch_size, 1 + num_outputs]: the true target, followed by the soft target from the teacher.
+	Examples are sampled as in train_data.
+
+	Args:
+		train_data (dataset.SequenceTfDataset): endless training data
+		soft_targets (np.ndarray): [len(train_data), num_outputs], see get_soft_targets()
+		class_weight (dict): (Optional) {class index: weight}, see utils.get_class_weight()
+	"""
+	def gen():
+		for seq, target_val, idx in train_data.sc.iter_with_index():
+			y = np.concatenate([[target_val], soft_targets[idx]]).astype('float32')
+			weight = class_weight[target_val] if class_weight is not None else 1.
+			yield seq, y, weight
+	seq_type = tf.uint8 if train_data.encoding == 'tokens' else tf.int8
+	ds = tf.data.Dataset.from_generator(gen,
+		output_types=(seq_type, tf.float32, tf.float32),
+		output_shapes=(tf.TensorShape(train_data.seq_shape), tf.TensorShape([1 + soft_targets.shape[1]]), tf.TensorShape(())))
+	return ds.shuffle(train_data.batch_size * 16).batch(train_data.batch_size)
+
+def get_student_model(train_data, lr_schedule, config, momentum_schedule=None):
+	arch = models.get_model_architecture(train_data.seq_shape, train_data.num_classes, config)
+	model = Distiller(inputs=arch.inputs, outputs=arch.outputs,
+		alpha=config.get('distill_alpha', 1.),
+		temperature=config.get('distill_temperature', 1.),
+		targets_are_classes=config.targets_are_classes,
+		jit_compile=bool(config.get('use_xla')),
+		accum_steps=utils.get_accum_steps(config))
+	optimizer = models.get_optimizer(lr_schedule, config, momentum_schedule=momentum_schedule)
+	models.compile_model(model, train_data.num_classes, train_data.class_to_idx_mapping, config, optimizer=optimizer)
+	return model
+
+class Distiller(models.CnnModel):
+	"""Student model, trained on targets of shape [batch_size, 1 + num_outputs]: the true target,
+	followed by the teacher's output. See Hinton et al. 2015: https://arxiv.org/abs/1503.02531
+
+	Training loss is:
+		alpha * soft_loss + (1 - alpha) * compiled loss on the true targets + regularization
+	where soft_loss is:
+		- classification: cross-entropy between the teacher and student class probabilities, both
+			softened by the temperature, scaled by temperature ** 2 to keep gradient magnitudes comparable
+		- regression: mean squared error from the teacher output
+	Training metrics use the true targets. Evaluation and prediction are the same as for CnnModel,
+	so the model is validated on the true targets, and can be saved and used like any other model.
+	"""
+	def __init__(self, *args, alpha=1., temperature=1., targets_are_classes=True, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.alpha = alpha
+		self.temperature = temperature
+		self.targets_are_classes = targets_are_classes
+
+	def _compute_loss(self, y, y_pred, sample_weight):
+		y_true, y_soft = self._get_metric_targets(y), y[:, 1:]
+		if self.targets_are_classes:
+			teacher_probs = self._soften(y_soft)
+			student_probs = self._soften(y_pred)
+			soft_loss = keras.losses.categorical_crossentropy(teacher_probs, student_probs) * self.temperature ** 2
+		else:
+			soft_loss = keras.losses.mean_squared_error(y_soft, y_pred)
+		if sample_weight is not None:
+			soft_loss *= sample_weight
+		hard_loss = self.compiled_loss(y_true, y_pred, sample_weight)
+		regularization = tf.add_n(self.losses) if self.losses else 0.
+		return self.alpha * tf.reduce_mean(soft_loss) + (1 - self.alpha) * hard_loss + regularization
+
+	def _get_metric_targets(self, y):
+		y_true = y[:, 0]
+		return tf.cast(y_true, tf.int32) if self.targets_are_classes else y_true
+
+	def _soften(self, probs):
+		"""Apply the temperature to class probabilities, as softmax(log(probs) / temperature)."""
+		if self.temperature == 1.:
+			return probs
+		return tf.nn.softmax(tf.math.log(probs + keras.backend.epsilon()) / self.temperature)
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-config', type=str, required=True, help='Student config .yaml')
+	parser.add_argument('-teacher', type=str, required=True, help='Path to trained teacher model .h5')
+	parser.add_argument('-cache_dir', type=str, default=DEFAULT_CACHE_DIR, help='Directory to cache teacher outputs')
+	parser.add_argument('-wandb-mode', type=str)
+	# parse_known_args() allows hyperparameters to be passed in during sweeps
+	args, _ = parser.parse_known_args()
+	return args
+
+
+if __name__ == '__main__':
+	distill(get_args())
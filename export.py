@@ -0,0 +1,237 @@
+"""export.py: Export a trained model for fast inference, as a SavedModel and TFLite flatbuffers.
+
+Export directory layout:
+	saved_model/        SavedModel with a single 'serving_default' signature
+	model.tflite        float32 TFLite model
+	model_int8.tflite   (Optional) int8 post-training quantized TFLite model
+	export.json         metadata, see METADATA_FILE
+
+Exported models can be loaded with load_exported_model(), and used in models.get_activations().
+"""
+
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+from tqdm import tqdm
+
+import benchmarking
+import constants
+import custom_layers
+import scoring
+
+
+METADATA_FILE = 'export.json'
+SAVED_MODEL_DIR = 'saved_model'
+TFLITE_FILE = 'model.tflite'
+TFLITE_INT8_FILE = 'model_int8.tflite'
+
+
+def strip_model(model):
+	"""Get an inference-only copy of a trained model.
+
+	- Dropout layers are removed, since they are the identity at inference time.
+	- Optimizer, loss, and metrics are dropped, since the copy is not compiled.
+	- ReLU is moved after max-pooling. Since ReLU is monotonic, this gives the same outputs, but the
+		activation is computed on pool_size times fewer values.
+
+	The model must be a chain of layers, as built by models.get_model_architecture().
+	"""
+	chain = [layer for layer in model.layers[1:] if not isinstance(layer, layers.Dropout)]
+	relu_after_pool = _get_relu_after_pool(chain)
+
+	inputs = keras.Input(shape=model.input_shape[1:], dtype=model.inputs[0].dtype)
+	x = inputs
+	for layer in chain:
+		layer_config = layer.get_config()
+		if layer in relu_after_pool.values():
+			layer_config['activation'] = 'linear'
+		new_layer = layer.__class__.from_config(layer_config)
+		x = new_layer(x)
+		new_layer.set_weights(layer.get_weights())
+		if layer in relu_after_pool:
+			x = layers.ReLU()(x)
+	return keras.Model(inputs=inputs, outputs=x)
+
+def _get_relu_after_pool(chain):
+	"""Find max-pooling layers whose input comes from a ReLU conv layer, possibly through max layers in between.
+	Returns a dict of {pooling layer: conv layer}.
+	"""
+	pairs = {}
+	for idx, layer in enumerate(chain):
+		if not isinstance(layer, layers.MaxPooling1D):
+			continue
+		prev_idx = idx - 1
+		# RevCompMax is a max, so it also commutes with ReLU
+		while prev_idx >= 0 and isinstance(chain[prev_idx], custom_layers.RevCompMax):
+			prev_idx -= 1
+		prev = chain[prev_idx] if prev_idx >= 0 else None
+		if isinstance(prev, layers.Conv1D) and prev.get_config()['activation'] == 'relu':
+			pairs[layer] = prev
+	return pairs
+
+def is_rc_invariant(model):
+	"""Whether the model output is invariant to reverse complementing the input, see custom_layers.RevCompMax."""
+	return any(isinstance(layer, custom_layers.RevCompMax) for layer in model.layers)
+
+def export_model(model, out_dir, xs_calibration=None, model_path=None):
+	"""Export a trained model for inference.
+
+	Args:
+		model (keras model): trained model
+		out_dir (str): export directory
+		xs_calibration (np.ndarray): (Optional) example inputs for calibrating int8 quantization,
+			e.g. a random sample of a few hundred validation sequences. If None, then the model is not quantized.
+		model_path (str): (Optional) path of the trained model, to record in the metadata
+
+	Returns:
+		dict: metadata, as saved to METADATA_FILE
+	"""
+	os.makedirs(out_dir, exist_ok=True)
+	stripped = strip_model(model)
+
+	# SavedModel: traced graph with no python layer code, which TF's graph optimizer fuses at load time
+	serve = tf.function(
+		lambda inputs: {'outputs': stripped(inputs, training=False)},
+		input_signature=[tf.TensorSpec((None,) + stripped.input_shape[1:], stripped.inputs[0].dtype, name='inputs')])
+	tf.saved_model.save(stripped, os.path.join(out_dir, SAVED_MODEL_DIR), signatures=serve)
+
+	# TFLite: frozen graph, with conv + bias + ReLU fused into single ops
+	converter = tf.lite.TFLiteConverter.from_keras_model(stripped)
+	_write(os.path.join(out_dir, TFLITE_FILE), converter.convert())
+
+	if xs_calibration is not None:
+		converter = tf.lite.TFLiteConverter.from_keras_model(stripped)
+		converter.optimizations = [tf.lite.Optimize.DEFAULT]
+		converter.representative_dataset = _get_representative_dataset(xs_calibration, stripped.inputs[0].dtype)
+		_write(os.path.join(out_dir, TFLITE_INT8_FILE), converter.convert())
+
+	metadata = {
+		'model_path': model_path,
+		'input_shape': list(stripped.input_shape[1:]),
+		'output_shape': list(stripped.output_shape[1:]),
+		'rc_invariant': is_rc_invariant(stripped),
+		'default_artifact': TFLITE_INT8_FILE if xs_calibration is not None else TFLITE_FILE
+	}
+	write_metadata(out_dir, metadata)
+	return metadata
+
+def _get_representative_dataset(xs, dtype):
+	def representative_dataset():
+		for x in xs:
+			yield [tf.cast(x[np.newaxis], dtype)]
+	return representative_dataset
+
+def _write(path, data):
+	with open(path, 'wb') as f:
+		f.write(data)
+
+def write_metadata(out_dir, metadata):
+	with open(os.path.join(out_dir, METADATA_FILE), 'w') as f:
+		json.dump(metadata, f, indent=4)
+
+def read_metadata(out_dir):
+	with open(os.path.join(out_dir, METADATA_FILE)) as f:
+		return json.load(f)
+
+class ExportedModel:
+	"""Base class for exported models, with the parts of the keras model interface used for prediction.
+
+	Attributes:
+		input_shape (tuple): (None, ...), as in keras models
+		output_shape (tuple): (None, ...), as in keras models
+		rc_invariant (bool): whether outputs are invariant to reverse complementing the input
+	"""
+	def __init__(self, metadata):
+		self.input_shape = (None,) + tuple(metadata['input_shape'])
+		self.output_shape = (None,) + tuple(metadata['output_shape'])
+		self.rc_invariant = metadata['rc_invariant']
+
+	def predict(self, xs, batch_size=constants.DEFAULT_BATCH_SIZE, verbose=0):
+		outputs = []
+		for start in tqdm(range(0, len(xs), batch_size), disable=not verbose):
+			outputs.append(self._predict_batch(xs[start:start + batch_size]))
+		return np.concatenate(outputs)
+
+	def _predict_batch(self, xs):
+		raise NotImplementedError()
+
+class SavedModel(ExportedModel):
+	def __init__(self, path, metadata):
+		super().__init__(metadata)
+		self.serve = tf.saved_model.load(path).signatures['serving_default']
+		self.input_dtype = self.serve.structured_input_signature[1]['inputs'].dtype
+
+	def _predict_batch(self, xs):
+		return self.serve(inputs=tf.cast(xs, self.input_dtype))['outputs'].numpy()
+
+class TfLiteModel(ExportedModel):
+	def __init__(self, path, metadata, num_threads=None):
+		super().__init__(metadata)
+		self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+		self.input_details = self.interpreter.get_input_details()[0]
+		self.output_details = self.interpreter.get_output_details()[0]
+		self.batch_size = None
+
+	def _predict_batch(self, xs):
+		if len(xs) != self.batch_size:
+			self.interpreter.resize_tensor_input(self.input_details['index'], (len(xs),) + self.input_shape[1:])
+			self.interpreter.allocate_tensors()
+			self.batch_size = len(xs)
+		self.interpreter.set_tensor(self.input_details['index'], xs.astype(self.input_details['dtype']))
+		self.interpreter.invoke()
+		return self.interpreter.get_tensor(self.output_details['index'])
+
+def is_exported_model(path):
+	"""Whether path is an export directory or an artifact in one, as opposed to a keras .h5 file."""
+	return os.path.isdir(path) or path.endswith('.tflite')
+
+def load_exported_model(path):
+	"""Load an exported model.
+
+	Args:
+		path (str): one of:
+			export directory: load its default artifact, the int8 model if it was quantized
+			.tflite file in an export directory
+			SavedModel directory in an export directory
+	"""
+	path = os.path.normpath(path)
+	if os.path.exists(os.path.join(path, METADATA_FILE)):
+		metadata = read_metadata(path)
+		path = os.path.join(path, metadata['default_artifact'])
+	else:
+		metadata = read_metadata(os.path.dirname(path))
+	if path.endswith('.tflite'):
+		return TfLiteModel(path, metadata)
+	return SavedModel(path, metadata)
+
+def compare_models(reference, candidates, xs, ys, num_classes, pos_label=None, batch_size=constants.DEFAULT_BATCH_SIZE):
+	"""Compare the accuracy and throughput of exported models with the original model.
+
+	Args:
+		reference (keras model): original model
+		candidates (dict): {name: model}, models with a keras-like predict()
+		xs (np.ndarray): validation inputs
+		ys (np.ndarray): validation targets
+		num_classes (int or None): number of classes, or None for regression
+		pos_label (int): class index of the positive class, for AUROC
+
+	Returns:
+		list of dict: one row per model, with scoring.get_scores() metrics, throughput, and the difference
+			from the reference predictions
+	"""
+	ref_preds = reference.predict(xs, batch_size=batch_size, verbose=0)
+	rows = []
+	for name, model in [('keras', reference)] + list(candidates.items()):
+		preds = ref_preds if model is reference else model.predict(xs, batch_size=batch_size, verbose=0)
+		row = {'model': name}
+		row.update(scoring.get_scores(ys, preds, num_classes, pos_label=pos_label))
+		row['max_abs_diff'] = float(np.max(np.abs(preds - ref_preds)))
+		if num_classes is not None:
+			row['label_agreement'] = float(np.mean(np.argmax(preds, axis=-1) == np.argmax(ref_preds, axis=-1)))
+		row['examples_per_sec'] = benchmarking.time_predict(model, xs, batch_size)
+		rows.append(row)
+	return rows
@@ -59,3 +59,71 @@ def get_exp_lr_schedule(steps_per_epoch, config):
     	decay_steps=steps_per_epoch,
     	decay_rate=config.lr_exp_decay_per_epoch
 	)
+
+def get_momentum_schedule(steps_per_epoch, config):
+	"""Get the momentum schedule, or None if momentum is constant. See set_momentum_schedule().
+
+	Args:
+		steps_per_epoch (int): number of optimizer updates per epoch, as for get_lr_schedule()
+		config (dict): hyperparameter config, containing:
+			momentum_schedule: 'constant' or 'cyclic'
+			momentum_base, momentum_max: see CyclicMomentumSchedule
+	"""
+	if config.momentum_schedule == 'cyclic':
+		cycle_period_epochs = config.num_epochs / config.lr_cyc_num_cycles
+		# Number of updates in half of a cycle
+		step_size = steps_per_epoch * cycle_period_epochs / 2
+		return CyclicMomentumSchedule(step_size, config.momentum_base, config.momentum_max)
+	elif config.momentum_schedule == 'constant':
+		return None
+	else:
+		raise ValueError("Invalid momentum schedule")
+
+class CyclicMomentumSchedule(tf.keras.optimizers.schedules.LearningRateSchedule):
+	"""Cyclic momentum, the mirror image of the cyclic learning rate schedule: momentum is at max_m when
+	the learning rate is at its min, and at base_m when the learning rate is at its max.
+	See Smith, 2018: https://arxiv.org/abs/1803.09820
+
+	Evaluated in the graph from the optimizer's iteration count, see set_momentum_schedule().
+	The momentum for the update at iteration i is the same as the value that the CyclicMomentum callback
+	set before batch i, including its plateau at max_m during the second cycle.
+
+	Args:
+		step_size (float): number of optimizer updates in half of a cycle
+		base_m (float): minimum momentum
+		max_m (float): maximum momentum
+	"""
+	def __init__(self, step_size, base_m, max_m):
+		self.step_size = step_size
+		self.base_m = base_m
+		self.max_m = max_m
+
+	def __call__(self, step):
+		# The callback counted batches from 1
+		iterations = tf.cast(step, tf.float32) + 1
+		cycle = tf.floor(1 + iterations / (2 * self.step_size))
+		x = tf.abs(iterations / self.step_size - 2 * cycle + 1)
+		momentum = self.max_m - (self.max_m - self.base_m) * tf.maximum(0., 1 - x)
+		# NOTE this plateau might break for num_cycles > 1, as in the callback.
+		return tf.where(tf.equal(cycle, 2.), tf.constant(self.max_m, tf.float32), momentum)
+
+	def get_config(self):
+		return {'step_size': self.step_size, 'base_m': self.base_m, 'max_m': self.max_m}
+
+def set_momentum_schedule(optimizer, schedule):
+	"""Make the optimizer's momentum (SGD) or beta_1 (Adam) follow a schedule of its iteration count.
+
+	The schedule is evaluated inside the training step, so there is no per-batch python callback.
+	Call this before training starts.
+	"""
+	name = 'momentum' if 'momentum' in optimizer._hyper else 'beta_1'
+	if name not in optimizer._hyper:
+		raise ValueError(f"Momentum schedules are not supported for optimizer {optimizer.__class__.__name__}")
+	def momentum():
+		value = schedule(optimizer.iterations)
+		# A python value when eager, e.g. in optimizer.get_config(), so that it can be logged and saved
+		return float(value) if tf.executing_eagerly() else value
+	optimizer._set_hyper(name, momentum)
+	if name == 'momentum':
+		# SGD only creates momentum slots if momentum was nonzero at construction
+		optimizer._momentum = True
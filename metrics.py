@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 import tensorflow.keras.metrics
 import tensorflow_addons.metrics
@@ -158,3 +159,224 @@ class MulticlassMetric(tensorflow.keras.metrics.Metric):
         if k_metric is None:
             raise ValueError(f"Could not find keras metric {self.k_metric_name}")
         return k_metric(**kwargs)
+
+class ConfusionHistogram(tensorflow.keras.metrics.Metric):
+    """Classification metrics for several positive labels, computed from one shared set of confusion statistics.
+
+    For each positive label, each batch adds its examples to a histogram of the predicted probability of that
+    label, binned by the AUC thresholds and 0.5, separately for examples with and without that label. The
+    true positive, false positive, true negative and false negative counts at every threshold are cumulative
+    sums of the histogram. So all of the outputs below come from one update per label per batch, instead of
+    one update per metric, and give the same values as the equivalent keras and tensorflow_addons metrics:
+        'acc': accuracy of the argmax class, as SparseCategoricalAccuracy
+        'auroc', 'auprc': as AUC(curve='ROC') and AUC(curve='PR'), with num_thresholds thresholds
+        'precision', 'recall', 'tp', 'fp', 'tn', 'fn': as Precision, Recall, TruePositives, etc., at threshold 0.5
+        'f1': as tensorflow_addons F1Score, with the label predicted if it has the highest probability
+
+    result() is a dict of {output name: value}, which keras logs as separate metrics.
+
+    Args:
+        num_classes (int)
+        outputs (list of (name, stat, label)): metrics to report. stat is one of the outputs above, and label is
+            the positive label, or None for 'acc'. E.g. [('auroc', 'auroc', 1), ('npv', 'precision', 0)]
+        num_thresholds (int): number of thresholds for AUCs, as in keras AUC
+    """
+    STATS = ['acc', 'auroc', 'auprc', 'precision', 'recall', 'f1', 'tp', 'fp', 'tn', 'fn']
+
+    def __init__(self, num_classes, outputs, num_thresholds=200, name='confusion_histogram', **kwargs):
+        super().__init__(name=name, **kwargs)
+        self.num_classes = num_classes
+        self.outputs = [tuple(output) for output in outputs]
+        self.num_thresholds = num_thresholds
+        for _, stat, _ in self.outputs:
+            if stat not in self.STATS:
+                raise ValueError(f"Invalid stat `{stat}`, valid stats are {self.STATS}")
+        self.labels = sorted({label for _, stat, label in self.outputs if stat != 'acc'})
+
+        # Same thresholds as keras AUC, plus 0.5 for the thresholded metrics
+        auc_thresholds = [0. - tensorflow.keras.backend.epsilon()] + [
+            (i + 1) / (num_thresholds - 1) for i in range(num_thresholds - 2)] + [1. + tensorflow.keras.backend.epsilon()]
+        thresholds = np.array(sorted(set(auc_thresholds) | {0.5}), dtype='float32')
+        self.thresholds = tf.constant(thresholds)
+        self.auc_idxs = tf.constant(np.searchsorted(thresholds, np.array(auc_thresholds, dtype='float32')))
+        self.half_idx = int(np.searchsorted(thresholds, np.float32(0.5)))
+
+        # [label, negatives or positives, bucket]. Bucket i has predictions above i thresholds.
+        self.histograms = self.add_weight(
+            'histograms', shape=(len(self.labels), 2, len(thresholds) + 1), initializer='zeros')
+        # [label, (tp, fp, fn)] with the label predicted if it has the highest probability
+        self.argmax_counts = self.add_weight('argmax_counts', shape=(len(self.labels), 3), initializer='zeros')
+        self.num_correct = self.add_weight('num_correct', initializer='zeros')
+        self.num_examples = self.add_weight('num_examples', initializer='zeros')
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = tf.reshape(tf.cast(y_true, tf.int32), [-1])
+        y_pred = tf.cast(y_pred, tf.float32)
+        weights = tf.ones_like(y_true, dtype=tf.float32) if sample_weight is None else tf.reshape(
+            tf.cast(sample_weight, tf.float32), [-1])
+
+        correct = tf.cast(tf.equal(tf.argmax(y_pred, axis=-1, output_type=tf.int32), y_true), tf.float32)
+        self.num_correct.assign_add(tf.reduce_sum(correct * weights))
+        self.num_examples.assign_add(tf.reduce_sum(weights))
+
+        histograms, argmax_counts = [], []
+        is_max = y_pred >= tf.reduce_max(y_pred, axis=-1, keepdims=True)
+        for label in self.labels:
+            is_label = tf.equal(y_true, label)
+            buckets = tf.searchsorted(self.thresholds, y_pred[:, label], side='left')
+            histograms.append(tf.stack([
+                tf.math.unsorted_segment_sum(tf.where(is_label, 0., weights), buckets, len(self.thresholds) + 1),
+                tf.math.unsorted_segment_sum(tf.where(is_label, weights, 0.), buckets, len(self.thresholds) + 1)]))
+            predicted = is_max[:, label]
+            argmax_counts.append(tf.stack([
+                tf.reduce_sum(tf.where(is_label & predicted, weights, 0.)),
+                tf.reduce_sum(tf.where(~is_label & predicted, weights, 0.)),
+                tf.reduce_sum(tf.where(is_label & ~predicted, weights, 0.))]))
+        if self.labels:
+            self.histograms.assign_add(tf.stack(histograms))
+            self.argmax_counts.assign_add(tf.stack(argmax_counts))
+
+    def result(self):
+        results = {}
+        for name, stat, label in self.outputs:
+            if stat == 'acc':
+                results[name] = tf.math.divide_no_nan(self.num_correct, self.num_examples)
+                continue
+            idx = self.labels.index(label)
+            if stat == 'f1':
+                tp, fp, fn = tf.unstack(self.argmax_counts[idx])
+                results[name] = tf.math.divide_no_nan(2 * tp, 2 * tp + fp + fn)
+                continue
+            tp, fp, tn, fn = self._get_confusion(idx)
+            if stat == 'auroc':
+                results[name] = self._roc_auc(*[tf.gather(x, self.auc_idxs) for x in (tp, fp, tn, fn)])
+            elif stat == 'auprc':
+                results[name] = self._pr_auc(*[tf.gather(x, self.auc_idxs) for x in (tp, fp, tn, fn)])
+            else:
+                tp, fp, tn, fn = [x[self.half_idx] for x in (tp, fp, tn, fn)]
+                results[name] = {
+                    'precision': lambda: tf.math.divide_no_nan(tp, tp + fp),
+                    'recall': lambda: tf.math.divide_no_nan(tp, tp + fn),
+                    'tp': lambda: tp, 'fp': lambda: fp, 'tn': lambda: tn, 'fn': lambda: fn}[stat]()
+        return results
+
+    def _get_confusion(self, idx):
+        """Get tp, fp, tn, fn at each threshold, for predictions strictly greater than the threshold."""
+        negatives, positives = self.histograms[idx, 0], self.histograms[idx, 1]
+        # Predictions in buckets above threshold i are positive at threshold i
+        tp = tf.reduce_sum(positives) - tf.cumsum(positives)[:-1]
+        fp = tf.reduce_sum(negatives) - tf.cumsum(negatives)[:-1]
+        return tp, fp, tf.reduce_sum(negatives) - fp, tf.reduce_sum(positives) - tp
+
+    def _roc_auc(self, tp, fp, tn, fn):
+        # As keras AUC, with summation_method='interpolation'
+        tpr = tf.math.divide_no_nan(tp, tp + fn)
+        fpr = tf.math.divide_no_nan(fp, fp + tn)
+        return tf.reduce_sum((fpr[:-1] - fpr[1:]) * (tpr[:-1] + tpr[1:]) / 2.)
+
+    def _pr_auc(self, tp, fp, tn, fn):
+        # As keras AUC.interpolate_pr_auc(), see Davis & Goadrich 2006
+        dtp = tp[:-1] - tp[1:]
+        p = tp + fp
+        dp = p[:-1] - p[1:]
+        prec_slope = tf.math.divide_no_nan(dtp, tf.maximum(dp, 0))
+        intercept = tp[1:] - prec_slope * p[1:]
+        safe_p_ratio = tf.where(
+            tf.logical_and(p[:-1] > 0, p[1:] > 0),
+            tf.math.divide_no_nan(p[:-1], tf.maximum(p[1:], 0)),
+            tf.ones_like(p[1:]))
+        return tf.reduce_sum(tf.math.divide_no_nan(
+            prec_slope * (dtp + intercept * tf.math.log(safe_p_ratio)),
+            tf.maximum(tp[1:] + fn[1:], 0)))
+
+    def reset_state(self):
+        for variable in self.variables:
+            variable.assign(tf.zeros_like(variable))
+
+    def get_config(self):
+        """For model saving and loading"""
+        config = super().get_config()
+        config.update({
+            "num_classes": self.num_classes,
+            "outputs": [list(output) for output in self.outputs],
+            "num_thresholds": self.num_thresholds
+        })
+        return config
+
+class ExactAUC(tensorflow.keras.metrics.Metric):
+    """Exact area under the ROC or PR curve for one positive label, computed from the distinct predicted scores.
+
+    Keras AUC counts examples at a fixed set of thresholds, so it is only approximate. This metric instead keeps
+    every distinct score of the positive label, with the total weight of positive and negative examples at that
+    score. Memory grows with the number of distinct scores rather than the number of examples, and the AUC
+    is computed exactly at result():
+        'ROC': Mann-Whitney U statistic, with tied scores counted as half, as scoring.auroc()
+        'PR': average precision, the sum over distinct scores of precision times the increase in recall,
+            as sklearn.metrics.average_precision_score
+
+    On continuous scores, nearly every example has a distinct score, so the metric is only updated during
+    evaluation, where the number of examples is fixed, and not by training steps, see evaluation_only.
+
+    Args:
+        pos_label (int): label of the positive class
+        curve (str): 'ROC' or 'PR'
+    """
+    # Skipped by training steps, see models.update_training_metrics()
+    evaluation_only = True
+
+    def __init__(self, pos_label, curve='ROC', name=None, **kwargs):
+        super().__init__(name=name, **kwargs)
+        if curve not in ['ROC', 'PR']:
+            raise ValueError(f"Invalid curve `{curve}`, expected 'ROC' or 'PR'")
+        self.pos_label = pos_label
+        self.curve = curve
+        # Distinct scores, and the weight of positive and negative examples with each score, in no particular order
+        self.scores = self._get_variable('scores')
+        self.pos_weights = self._get_variable('pos_weights')
+        self.neg_weights = self._get_variable('neg_weights')
+
+    def _get_variable(self, name):
+        return tf.Variable(tf.zeros([0]), shape=tf.TensorShape([None]), trainable=False, name=name)
+
+    def update_state(self, y_true, y_pred, sample_weight=None):
+        y_true = tf.reshape(tf.cast(y_true, tf.int32), [-1])
+        scores = tf.cast(y_pred[..., self.pos_label], tf.float32)
+        weights = tf.ones_like(scores) if sample_weight is None else tf.reshape(tf.cast(sample_weight, tf.float32), [-1])
+        is_pos = tf.equal(y_true, self.pos_label)
+
+        # Merge this batch's scores into the distinct scores so far
+        unique_scores, idxs = tf.unique(tf.concat([self.scores, scores], axis=0))
+        num_unique = tf.size(unique_scores)
+        self.pos_weights.assign(tf.math.unsorted_segment_sum(
+            tf.concat([self.pos_weights, tf.where(is_pos, weights, 0.)], axis=0), idxs, num_unique))
+        self.neg_weights.assign(tf.math.unsorted_segment_sum(
+            tf.concat([self.neg_weights, tf.where(is_pos, 0., weights)], axis=0), idxs, num_unique))
+        self.scores.assign(unique_scores)
+
+    def result(self):
+        # Highest scores first
+        order = tf.argsort(self.scores, direction='DESCENDING')
+        pos = tf.cast(tf.gather(self.pos_weights, order), tf.float64)
+        neg = tf.cast(tf.gather(self.neg_weights, order), tf.float64)
+        num_pos = tf.reduce_sum(pos)
+        if self.curve == 'ROC':
+            # Negatives with a lower score than each positive, plus half of the tied negatives
+            neg_below = tf.reduce_sum(neg) - tf.cumsum(neg)
+            auc = tf.math.divide_no_nan(tf.reduce_sum(pos * (neg_below + neg / 2)), num_pos * tf.reduce_sum(neg))
+        else:
+            precision = tf.math.divide_no_nan(tf.cumsum(pos), tf.cumsum(pos) + tf.cumsum(neg))
+            auc = tf.math.divide_no_nan(tf.reduce_sum(pos * precision), num_pos)
+        return tf.cast(auc, tf.float32)
+
+    def reset_state(self):
+        for variable in [self.scores, self.pos_weights, self.neg_weights]:
+            variable.assign(tf.zeros([0]))
+
+    def get_config(self):
+        """For model saving and loading"""
+        config = super().get_config()
+        config.update({
+            "pos_label": self.pos_label,
+            "curve": self.curve
+        })
+        return config
@@ -1,3 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import json
+import os
 
 import numpy as np
 import tensorflow as tf
@@ -5,14 +9,16 @@ from tensorflow import keras
 from tensorflow.keras import layers
 from tensorflow.keras.regularizers import l2
 from tensorflow.keras.optimizers import SGD, Adam
-from tensorflow.keras.metrics import SparseCategoricalAccuracy
 from tensorflow.keras.metrics import MeanSquaredError, MeanAbsoluteError, MeanAbsolutePercentageError
-from tqdm import tqdm
 
 import constants
+import custom_layers
 import dataset
-from metrics import MulticlassMetric
+import dataset_server
+import export
+from metrics import ConfusionHistogram, ExactAUC, MulticlassMetric
 import lr_schedules
+import scoring
 
 
 OPTIMIZER_MAPPING = {
@@ -26,23 +32,194 @@ LAYERWISE_PARAMS_CONV = ['conv_filters', 'conv_width', 'conv_stride', 'dropout_r
 LAYERWISE_PARAMS_DENSE = ['dense_filters', 'dropout_rate_dense', 'l2_reg_dense']
 
 
-def get_model(input_shape, num_classes, class_to_idx_mapping, lr_schedule, config):
+def get_model(input_shape, num_classes, class_to_idx_mapping, lr_schedule, config, momentum_schedule=None):
 	model = get_model_architecture(input_shape, num_classes, config)
-	optimizer = get_optimizer(lr_schedule, config)
-	metrics = get_metrics(num_classes, class_to_idx_mapping, config)
+	accum_steps = config.get('grad_accum_steps') or 1
+	# Token models are CnnModels, so that they also take one-hot inputs, see CnnModel.__call__(),
+	# and models with exact AUCs, so that the AUCs are only updated during evaluation, see update_training_metrics()
+	if config.get('use_xla') or accum_steps > 1 or len(input_shape) == 1 or config.get('use_exact_auc'):
+		model = CnnModel(inputs=model.inputs, outputs=model.outputs,
+			jit_compile=bool(config.get('use_xla')), accum_steps=accum_steps)
+	optimizer = get_optimizer(lr_schedule, config, momentum_schedule=momentum_schedule)
+	compile_model(model, num_classes, class_to_idx_mapping, config, optimizer=optimizer)
+	return model
 
-	loss = 'mean_squared_error' if num_classes is None else 'sparse_categorical_crossentropy' 
-	model.compile(loss=loss,
-		optimizer=optimizer,
-		metrics=metrics)
+def compile_model(model, num_classes, class_to_idx_mapping, config, optimizer=None):
+	"""Compile model with the loss and metrics for this problem type.
 
-	return model
+	Args:
+		optimizer (keras optimizer): if None, the keras default is used. This is fine
+			for a model that is only used for evaluation.
+	"""
+	metrics = get_metrics(num_classes, class_to_idx_mapping, config)
+	loss = 'mean_squared_error' if num_classes is None else 'sparse_categorical_crossentropy'
+	kwargs = {} if optimizer is None else {'optimizer': optimizer}
+	model.compile(loss=loss, metrics=metrics, **kwargs)
+
+class CnnModel(keras.Model):
+	"""Functional model with optional XLA compilation and gradient accumulation.
+
+	XLA: Keras 2.7 has no `jit_compile` argument to `Model.compile()`, so the forward and backward
+	passes are wrapped in `tf.function(jit_compile=True)` here instead. Optimizer and metric
+	updates run outside of the compiled function, so metrics with ops that XLA does not support
+	(e.g. tensorflow_addons metrics wrapped by MulticlassMetric) still work.
+
+	Gradient accumulation: if accum_steps > 1, then each training step only adds the gradients of
+	its batch to a running sum, and every accum_steps-th step applies the mean gradient with the
+	optimizer. So each optimizer update sees accum_steps batches, but only one batch is in memory at
+	a time. The optimizer's iteration count, which drives the learning rate schedule, counts
+	updates, not batches. Sample weights (e.g. from class_weight) apply to each batch as usual.
+
+	One-hot inputs: a model that takes base tokens (see dataset.ENCODINGS) also takes one-hot inputs of
+	shape [batch_size, seq_len, 4], which are converted to tokens, so it can be used like a one-hot model,
+	e.g. load_model(path).predict(onehot_xs). The conversion has no gradient, so gradient-based attribution,
+	e.g. DeepSHAP in sketches/explain.py, needs a model trained on one-hot inputs.
+
+	E.g.:
+	arch = get_model_architecture(input_shape, num_classes, config)
+	model = CnnModel(inputs=arch.inputs, outputs=arch.outputs, jit_compile=True, accum_steps=4)
+	"""
+	def __init__(self, *args, jit_compile=False, accum_steps=1, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.jit_compile = jit_compile
+		self.accum_steps = accum_steps
+		if accum_steps > 1:
+			self._accumulator = _GradientAccumulator(self.trainable_variables)
+
+	def get_config(self):
+		# Config of the layer graph, as for a functional model, so that saved models can be loaded with load_model().
+		# Newer keras versions don't give one for functional subclasses with their own __init__.
+		return keras.Model(inputs=self.inputs, outputs=self.outputs, name=self.name).get_config()
+
+	def __call__(self, inputs, *args, **kwargs):
+		return super().__call__(self._onehot_to_tokens(inputs), *args, **kwargs)
+
+	def _onehot_to_tokens(self, inputs):
+		"""Convert one-hot inputs to tokens, if this model takes tokens. All-zero rows, i.e. N, become dataset.TOKEN_N."""
+		shape = getattr(inputs, 'shape', None)
+		if not self.inputs or len(self.inputs[0].shape) != 2 or shape is None or len(shape) != 3:
+			return inputs
+		if shape[-1] != dataset.NUM_BASES:
+			raise ValueError(f"Expected one-hot inputs of shape [batch_size, seq_len, {dataset.NUM_BASES}], got {shape}")
+		inputs = tf.convert_to_tensor(inputs)
+		tokens = tf.argmax(inputs, axis=-1, output_type=tf.int32)
+		tokens = tf.where(tf.reduce_max(inputs, axis=-1) > 0, tokens, dataset.TOKEN_N)
+		return tf.cast(tokens, self.inputs[0].dtype)
+
+	def train_step(self, data):
+		x, y, sample_weight = keras.utils.unpack_x_y_sample_weight(data)
+		forward_backward = self._jit_forward_backward if self.jit_compile else self._forward_backward
+		y_pred, gradients = forward_backward(x, y, sample_weight)
+		if self.accum_steps > 1:
+			self._accumulate_gradients(gradients)
+		else:
+			self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+		update_training_metrics(self, self._get_metric_targets(y), y_pred, sample_weight)
+		return self._get_metric_results(training=True)
+
+	def _compute_loss(self, y, y_pred, sample_weight):
+		"""Training loss. Subclasses can override this and _get_metric_targets() to train on other targets,
+		see distill.Distiller."""
+		return self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
+
+	def _get_metric_targets(self, y):
+		"""Targets to compute training metrics with."""
+		return y
+
+	def _accumulate_gradients(self, gradients):
+		accumulator = self._accumulator
+		for total, gradient in zip(accumulator.gradients, gradients):
+			# convert_to_tensor makes sparse gradients (e.g. from TokenConv1D) dense
+			total.assign_add(tf.convert_to_tensor(gradient))
+		accumulator.count.assign_add(1)
+		tf.cond(accumulator.count >= self.accum_steps, self._apply_accumulated_gradients, lambda: None)
+
+	def _apply_accumulated_gradients(self):
+		accumulator = self._accumulator
+		gradients = [total / self.accum_steps for total in accumulator.gradients]
+		self.optimizer.apply_gradients(zip(gradients, self.trainable_variables))
+		for total in accumulator.gradients:
+			total.assign(tf.zeros_like(total))
+		accumulator.count.assign(0)
+
+	def test_step(self, data):
+		x, y, sample_weight = keras.utils.unpack_x_y_sample_weight(data)
+		y_pred = self._predict(x)
+		self.compiled_loss(y, y_pred, sample_weight, regularization_losses=self.losses)
+		self.compiled_metrics.update_state(y, y_pred, sample_weight)
+		return self._get_metric_results()
+
+	def predict_step(self, data):
+		x, _, _ = keras.utils.unpack_x_y_sample_weight(data)
+		return self._predict(x)
+
+	def _predict(self, x):
+		if self.jit_compile:
+			return self._jit_forward(x)
+		return self(x, training=False)
+
+	def _forward(self, x):
+		return self(x, training=False)
+
+	def _forward_backward(self, x, y, sample_weight):
+		with tf.GradientTape() as tape:
+			y_pred = self(x, training=True)
+			loss = self._compute_loss(y, y_pred, sample_weight)
+		return y_pred, tape.gradient(loss, self.trainable_variables)
+
+	_jit_forward = tf.function(_forward, jit_compile=True)
+	_jit_forward_backward = tf.function(_forward_backward, jit_compile=True)
+
+	def _get_metric_results(self, training=False):
+		results = {}
+		for metric in get_logged_metrics(self.metrics, training=training):
+			result = metric.result()
+			if isinstance(result, dict):
+				results.update(result)
+			else:
+				results[metric.name] = result
+		return results
+
+def update_training_metrics(model, y, y_pred, sample_weight=None):
+	"""Update a compiled model's metrics in a training step, except for metrics with `evaluation_only` set,
+	e.g. metrics.ExactAUC, whose state would grow with every training example."""
+	compiled_metrics = model.compiled_metrics
+	if not compiled_metrics.built:
+		compiled_metrics.build(y_pred, y)
+	training_metrics = get_logged_metrics(compiled_metrics.metrics, training=True)
+	if len(training_metrics) == len(compiled_metrics.metrics):
+		compiled_metrics.update_state(y, y_pred, sample_weight)
+	else:
+		for metric in training_metrics:
+			metric.update_state(y, y_pred, sample_weight=sample_weight)
+
+def get_logged_metrics(metrics, training=False):
+	"""Metrics to report results of. Training steps don't update or report evaluation-only metrics."""
+	if not training:
+		return metrics
+	return [metric for metric in metrics if not getattr(metric, 'evaluation_only', False)]
+
+class _GradientAccumulator:
+	"""Running sum of gradients for CnnModel.
+	This is a plain object, so that keras doesn't track its variables as model weights.
+	"""
+	def __init__(self, variables):
+		self.gradients = [tf.Variable(tf.zeros_like(var), trainable=False) for var in variables]
+		self.count = tf.Variable(0, trainable=False)
 
 def get_model_architecture(input_shape, num_classes, config):
 	"""Get 1-dimensional CNN model architecture.
 	Properties:
-		- Inputs are 1-hot encoded sequences of shape [sequence_len, encoding_dim]
-			- encoding_dim = 4 for DNA sequences (A, C, G, T)
+		- Inputs are either:
+			- 1-hot encoded sequences of shape [sequence_len, encoding_dim]
+				- encoding_dim = 4 for DNA sequences (A, C, G, T)
+			- base tokens of shape [sequence_len], if input_shape has rank 1 (see dataset.ENCODINGS).
+				The first convolutional layer is then a TokenConv1D, which gathers kernel rows
+				instead of convolving with the 1-hot encoding.
+		- If config.use_rc_equivariant_conv, then the convolutional layers share parameters between
+			each filter and its reverse complement (RevCompConv1D), and the strands are merged after
+			the convolutional stack (RevCompMax). The outputs are then invariant to reverse complementing
+			the inputs, so there is no need to train or predict on both strands.
 		- Outputs are either:
 			- float tensor of shape [num_classes], non-negative and summing to 1, if num_classes >= 2 (classification)
 			- float tensor of shape [1], taking values in (-inf, inf), if num_classes is None (regression)
@@ -52,13 +229,14 @@ def get_model_architecture(input_shape, num_classes, config):
 	bias_initializer_cfg = _get_initializer_cfg(config, 'bias_initializer')
 
 	# Inputs
-	inputs = keras.Input(shape=input_shape)
+	use_tokens = len(input_shape) == 1
+	inputs = keras.Input(shape=input_shape, dtype='uint8' if use_tokens else None)
 	x = inputs
 
 	# Convolutional stack
 	for layer_num in range(config['num_conv_layers']):
 		layer_config = _get_layer_config(config, layer_num, LAYERWISE_PARAMS_CONV)
-		x = layers.Conv1D(
+		x = _get_conv_layer_class(config, use_tokens and layer_num == 0)(
 				filters=layer_config['conv_filters'],
 				kernel_size=layer_config['conv_width'],
 				activation='relu',
@@ -67,6 +245,9 @@ def get_model_architecture(input_shape, num_classes, config):
 				kernel_initializer=keras.initializers.get(kernel_initializer_cfg),
 				bias_initializer=keras.initializers.get(bias_initializer_cfg))(x)
 		x = layers.Dropout(rate=layer_config['dropout_rate_conv'])(x)
+	if config.get('use_rc_equivariant_conv'):
+		# Merge strands, so that the rest of the model is invariant to reverse complement
+		x = custom_layers.RevCompMax()(x)
 
 	# Max-pooling layer
 	x = layers.MaxPooling1D(
@@ -101,6 +282,11 @@ def get_model_architecture(input_shape, num_classes, config):
 
 	return keras.Model(inputs=inputs, outputs=outputs)
 
+def _get_conv_layer_class(config, use_tokens):
+	if config.get('use_rc_equivariant_conv'):
+		return custom_layers.TokenRevCompConv1D if use_tokens else custom_layers.RevCompConv1D
+	return custom_layers.TokenConv1D if use_tokens else layers.Conv1D
+
 def _get_layer_config(config, layer_num, keys):
 	"""Get the config values that apply at this layer.
 	If a config value is set as a list, then this returns the element from that list at this layer.
@@ -149,11 +335,19 @@ def _get_initializer_cfg(config, key):
 		init_cfg['config'] = args
 	return init_cfg
 
-def get_optimizer(lr_schedule, config):
+def get_optimizer(lr_schedule, config, momentum_schedule=None):
+	"""
+	Args:
+		lr_schedule (LearningRateSchedule or float): if None, the learning rate in optimizer_args is used
+		config (wandb.config)
+		momentum_schedule (lr_schedules.CyclicMomentumSchedule): (Optional) schedule for momentum (SGD) or beta_1 (Adam)
+	"""
 	args = config.get('optimizer_args') or {}
 	if lr_schedule is not None:
 		args['learning_rate'] = lr_schedule
 	optimizer = OPTIMIZER_MAPPING[config['optimizer'].lower()](**args)
+	if momentum_schedule is not None:
+		lr_schedules.set_momentum_schedule(optimizer, momentum_schedule)
 	return optimizer
 
 def get_metrics(num_classes, class_to_idx_mapping, config):
@@ -161,27 +355,36 @@ def get_metrics(num_classes, class_to_idx_mapping, config):
 		# regression
 		metrics = [MeanSquaredError(), MeanAbsoluteError(), MeanAbsolutePercentageError()]
 	else:
-		# classification
+		# classification. All metrics share one ConfusionHistogram, see metrics.py
 		pos_label = class_to_idx_mapping[config.metric_pos_label]
-		metrics = [SparseCategoricalAccuracy(name='acc'),
-			MulticlassMetric('AUC', name='auroc', pos_label=pos_label, curve='ROC'),
-			MulticlassMetric('AUC', name='auprc', pos_label=pos_label, curve='PR'),
-			MulticlassMetric('Precision',  name='precision', pos_label=pos_label),
-			MulticlassMetric('Recall', name='sensitivity', pos_label=pos_label),
-			MulticlassMetric('F1Score', name='f1', pos_label=pos_label, make_dense=True, num_classes=num_classes)]
+		outputs = [
+			('acc', 'acc', None),
+			('auroc', 'auroc', pos_label),
+			('auprc', 'auprc', pos_label),
+			('precision', 'precision', pos_label),
+			('sensitivity', 'recall', pos_label),
+			('f1', 'f1', pos_label)]
 		if num_classes == 2:
 			# This is a binary classification problem, so "negative" metrics apply
 			neg_label = [idx for idx in class_to_idx_mapping.values() if idx != pos_label][0]
-			metrics.extend([
-				MulticlassMetric('Precision', name='npv', pos_label=neg_label),
-				MulticlassMetric('Recall', name='specificity', pos_label=neg_label),
-				MulticlassMetric('AUC', name='npvsc', pos_label=neg_label, curve='PR')])
+			outputs.extend([
+				('npv', 'precision', neg_label),
+				('specificity', 'recall', neg_label),
+				('npvsc', 'auprc', neg_label)])
 		if USE_CONFUSION_METRICS:
-			metrics.extend([
-				MulticlassMetric('TruePositives', name='conf_TP', pos_label=pos_label),
-				MulticlassMetric('TrueNegatives', name='conf_TN', pos_label=pos_label),
-				MulticlassMetric('FalsePositives', name='conf_FP', pos_label=pos_label),
-				MulticlassMetric('FalseNegatives', name='conf_FN', pos_label=pos_label)])
+			outputs.extend([
+				('conf_TP', 'tp', pos_label),
+				('conf_TN', 'tn', pos_label),
+				('conf_FP', 'fp', pos_label),
+				('conf_FN', 'fn', pos_label)])
+		exact_aucs = []
+		if config.get('use_exact_auc'):
+			# Replace the thresholded AUCs with exact ones, under the same names
+			exact_aucs = [
+				ExactAUC(label, curve='ROC' if stat == 'auroc' else 'PR', name=name)
+				for name, stat, label in outputs if stat in ['auroc', 'auprc']]
+			outputs = [output for output in outputs if output[1] not in ['auroc', 'auprc']]
+		metrics = [ConfusionHistogram(num_classes, outputs)] + exact_aucs
 
 	return metrics
 
@@ -198,49 +401,187 @@ def load_model(model_path):
 	# and construct this dict dynamically before load.
 	custom_objects = {
 		"MulticlassMetric": MulticlassMetric,
+		"ConfusionHistogram": ConfusionHistogram,
+		"ExactAUC": ExactAUC,
+		"CnnModel": CnnModel,
+		# Distilled students (distill.Distiller) only differ from CnnModel in training
+		"Distiller": CnnModel,
+		"TokenConv1D": custom_layers.TokenConv1D,
+		"RevCompConv1D": custom_layers.RevCompConv1D,
+		"TokenRevCompConv1D": custom_layers.TokenRevCompConv1D,
+		"RevCompMax": custom_layers.RevCompMax,
 		"scale_fn": lr_schedules.ClrScaleFn.scale_fn
 	}
 	return tf.keras.models.load_model(model_path, custom_objects=custom_objects)
 
-def validate(config, model):
+def get_input_encoding(model):
+	"""Get the dataset encoding that a model takes as input, see dataset.ENCODINGS."""
+	return 'tokens' if len(model.input_shape) == 2 else 'onehot'
+
+def validate(config, model, cache_dir=None, per_source=False, num_bootstrap=None):
 	"""Evaluate model on main eval set, and any additional eval sets.
 
+	Each set is predicted once, and metrics are computed from the predictions with scoring.get_metrics(),
+	with the same names as in training logs. If model is a path and cache_dir is given, then predictions
+	are cached in cache_dir, named by a hash of the model file and a fingerprint of the set, so later calls,
+	e.g. after adding a metric to scoring.get_metrics(), don't load the model or predict again.
+
 	import models, wandb
 	wandb.init(config='config-base.yaml', mode='disabled')
 	res = models.validate(wandb.config, <path to model .h5>)
+
+	Args:
+		per_source (bool): if True, also get metrics on each source file of each set, named
+			`val_source_{j}_{metric}` for the main set and `val_{i}_source_{j}_{metric}` for additional sets
+		num_bootstrap (int): (Optional) number of bootstrap replicates of each set, for confidence intervals
+
+	Returns:
+		dict: {metric name: value}
+		If num_bootstrap is given, also a dict: {metric name: np.ndarray [num_bootstrap]}, with the values on
+			each replicate of the metrics in scoring.bootstrap_metrics(), and their geometric means over sets
 	"""
-	# Load model from path, if necessary
-	if isinstance(model, str):
-		model = load_model(model)
+	model_hash = dataset.get_file_hash(model) if isinstance(model, str) and cache_dir is not None else None
+	def get_predictions(source_files, targets, map_targets):
+		nonlocal model
+		cache_path = None
+		if model_hash is not None:
+			fingerprint = dataset.get_fingerprint(source_files, targets=targets,
+				targets_are_classes=config.targets_are_classes, map_targets=map_targets,
+				reverse_complement=config.use_reverse_complement)
+			cache_path = os.path.join(cache_dir, f"predictions-{model_hash}-{fingerprint}.npz")
+			if os.path.exists(cache_path):
+				print(f"Loading cached predictions from {cache_path}")
+				with np.load(cache_path) as cached:
+					return dict(cached)
+
+		# Load model from path, if necessary
+		if isinstance(model, str):
+			model = load_model(model)
+			if config.get('use_xla'):
+				model = CnnModel(inputs=model.inputs, outputs=model.outputs, jit_compile=True)
+		predictions = predict_dataset(model, source_files, targets, config.targets_are_classes, map_targets=map_targets,
+			reverse_complement=config.use_reverse_complement, batch_size=config.batch_size)
+
+		if cache_path is not None:
+			# Write to a temporary file first, so that an interrupted run doesn't leave a partial cache
+			os.makedirs(cache_dir, exist_ok=True)
+			tmp_path = cache_path + '.tmp.npz'
+			np.savez(tmp_path, **predictions)
+			os.replace(tmp_path, cache_path)
+		return predictions
+
+	def get_labels(predictions):
+		"""Get num_classes, and pos_label and neg_label kwargs for scoring."""
+		num_classes = predictions['y_pred'].shape[-1] if config.targets_are_classes else None
+		kwargs = {}
+		if num_classes is not None:
+			kwargs['pos_label'] = pos_label
+			if num_classes == 2:
+				kwargs['neg_label'] = 1 - pos_label
+		return num_classes, kwargs
+
+	def get_metrics(predictions, prefix, source_prefix, metric_names=None):
+		num_classes, kwargs = get_labels(predictions)
+		res = {}
+		groups = [(prefix, np.ones(len(predictions['y_true']), dtype=bool))]
+		if per_source:
+			groups += [(f'{source_prefix}source_{j + 1}_', predictions['source_idxs'] == j)
+				for j in np.unique(predictions['source_idxs'])]
+		for group, mask in groups:
+			values = scoring.get_metrics(predictions['y_true'][mask], predictions['y_pred'][mask], num_classes,
+				regularization_loss=float(predictions['regularization_loss']), **kwargs)
+			res.update({f'{group}{k}': v for k, v in values.items() if metric_names is None or k in metric_names})
+		return res
+
+	bootstrap = {}
+	def add_bootstrap(predictions, prefix, seed, metric_names=None):
+		num_classes, kwargs = get_labels(predictions)
+		values = scoring.bootstrap_metrics(predictions['y_true'], predictions['y_pred'], num_classes,
+			num_replicates=num_bootstrap, seed=seed, **kwargs)
+		bootstrap.update({f'{prefix}{k}': v for k, v in values.items() if metric_names is None or k in metric_names})
 
 	# Evaluate on main validation set
-	val_data = dataset.SequenceTfDataset(
-		config.val_data_paths, config.val_targets,
-		targets_are_classes=config.targets_are_classes, endless=False,
-		reverse_complement=config.use_reverse_complement)
-	res = model.evaluate(x=val_data.dataset[0], y=val_data.dataset[1],
-		batch_size=config.batch_size, return_dict=True, verbose=0)
+	val_predictions = get_predictions(config.val_data_paths, config.val_targets, map_targets=True)
+	pos_label = None
+	if config.targets_are_classes:
+		pos_label = list(val_predictions['classes']).index(config.metric_pos_label)
+	# As in training logs, metrics on the whole main set have no prefix
+	res = get_metrics(val_predictions, '', 'val_')
+	if num_bootstrap:
+		add_bootstrap(val_predictions, '', seed=0)
 
 	# Evaluate on additional validation sets
-	additional_val = get_additional_validation(config, model)
-	if additional_val is not None:
-		res.update(additional_val.evaluate())
-
+	if config.get('additional_val_data_paths') is not None:
+		metric_names = get_additional_val_metrics(config)
+		num_sets = len(config.additional_val_data_paths)
+		for idx, (paths, targets) in enumerate(zip(config.additional_val_data_paths, config.additional_val_targets)):
+			# Use map_targets=False in case some datasets have only positive label
+			predictions = get_predictions(paths, targets, map_targets=False)
+			res.update(get_metrics(predictions, f'val_{idx + 1}_', f'val_{idx + 1}_', metric_names))
+			if num_bootstrap:
+				add_bootstrap(predictions, f'val_{idx + 1}_', seed=idx + 1, metric_names=metric_names)
+		# Aggregate metrics with geometric mean
+		for metric in metric_names:
+			values = np.array([res[f'val_{idx + 1}_{metric}'] for idx in range(num_sets)])
+			res[f'val_*_{metric}_gm'] = np.power(np.prod(values), 1 / num_sets)
+			if f'val_1_{metric}' in bootstrap:
+				values = np.stack([bootstrap[f'val_{idx + 1}_{metric}'] for idx in range(num_sets)])
+				bootstrap[f'val_*_{metric}_gm'] = np.power(np.prod(values, axis=0), 1 / num_sets)
+
+	if num_bootstrap:
+		return res, bootstrap
 	return res
 
+def predict_dataset(model, source_files, targets, targets_are_classes, map_targets=True, reverse_complement=False,
+	batch_size=constants.DEFAULT_BATCH_SIZE):
+	"""Predict on every example of a dataset, in non-endless order, in one pass.
+
+	Args:
+		source_files, targets, targets_are_classes, map_targets, reverse_complement: as in dataset.SequenceTfDataset
+
+	Returns:
+		dict of np.ndarray:
+			'y_true': [num_examples], targets
+			'y_pred': [num_examples, num_outputs], model outputs
+			'source_idxs': [num_examples], index of each example's source file
+			'classes': [num_classes], class label of each class index, or empty for regression
+			'regularization_loss': [], the model's regularization loss, which keras adds to the loss
+	"""
+	data = dataset.SequenceTfDataset(
+		source_files, targets, targets_are_classes=targets_are_classes, endless=False, map_targets=map_targets,
+		reverse_complement=reverse_complement, encoding=get_input_encoding(model))
+	xs, ys = data.dataset
+	y_pred = model.predict(xs, batch_size=batch_size, verbose=0)
+	source_lens = data.sc.source_freqs['source_lens']
+	classes = [] if data.idx_to_class_mapping is None else [
+		data.idx_to_class_mapping[idx] for idx in range(len(data.idx_to_class_mapping))]
+	return {
+		'y_true': ys,
+		'y_pred': y_pred,
+		'source_idxs': np.repeat(np.arange(len(source_lens)), source_lens),
+		'classes': np.array(classes),
+		'regularization_loss': np.array(float(tf.add_n(model.losses)) if model.losses else 0.)
+	}
+
 def get_activations(model, in_file, in_genome=None, out_file=None, layer_name=None, use_reverse_complement=True,
-	write_csv=False, score_column=None, batch_size=constants.DEFAULT_BATCH_SIZE):
+	write_csv=False, score_column=None, batch_size=constants.DEFAULT_BATCH_SIZE, jit_compile=False, chunk_size=None):
 	"""Use the model to predict on all sequences, and save the activations.
 
 	Args:
-		model (keras model or str)
+		model (keras model, export.ExportedModel, or str): model, or path to a model .h5 file or an exported model,
+			see export.load_exported_model(). layer_name and jit_compile can't be used with exported models.
 		in_file (str): path to input .fa, .bed, or .narrowPeak
 		in_genome (str): path to input genome .fa, if in_file is .bed or .narrowPeak
-		out_file (str): path to output file, .npy or .csv
-		layer_name (str): layer of model to get activations from. Default is the output layer.
+		out_file (str or list of str): path to output file, .npy or .csv, or one path per layer if layer_name is a list
+		layer_name (str or list of str): layer of model to get activations from. Default is the output layer.
+			If a list, then the activations of all of the layers are computed in one pass over the sequences,
+			and each layer's activations are saved to the corresponding out_file.
 		use_reverse_complement (bool): if True, then evaluate on reverse complement sequences as well.
 			The order of the output predictions is then:
 			pred(example_1), pred(revcomp(example_1)), ..., pred(example_n), pred(revcomp(example_n))
+			If the layer is invariant to reverse complement (see use_rc_equivariant_conv in
+			get_model_architecture), then only the forward strand is predicted, and each prediction
+			is repeated for the reverse strand. With several layers, this needs all of them to be invariant.
 		write_csv (bool): whether to write activations to csv
 			if False, then activations will be saved as a numpy array, dimension [num_examples, dim_1, ..., dim_n]
 			if True, then activations will be saved as rows in a csv. This can only be used with
@@ -250,28 +591,60 @@ def get_activations(model, in_file, in_genome=None, out_file=None, layer_name=No
 			layer_name=None (get activations of output layer) and
 			score_column=1 (get score from output unit for class 1).
 			if score_column is None, then all units of activation will be written as a row.
+		jit_compile (bool): if True, then compile the prediction function with XLA.
+		chunk_size (int): if set, then stream the activations to out_file in chunks of chunk_size sequences,
+			see _stream_activations(), so that memory use doesn't grow with the number of sequences.
+			An interrupted run resumes after the last finished chunk. Returns a read-only memory map of the .npy
+			instead of an in-memory array, or None if write_csv.
+
+	Returns:
+		np.ndarray of activations, or a list with one array per layer if layer_name is a list
 	"""
+	# Several layers are handled as lists, with one entry per layer
+	multiple_layers = isinstance(layer_name, (list, tuple))
+	layer_names = list(layer_name) if multiple_layers else [layer_name]
+	out_files = out_file if isinstance(out_file, (list, tuple)) else [out_file]
+	if out_file is not None and len(out_files) != len(layer_names):
+		raise ValueError(f"Expected one out_file per layer, got {len(out_files)} out_files for {len(layer_names)} layers")
+	if chunk_size is not None and out_file is None:
+		raise ValueError("out_file is required when streaming with chunk_size")
+
 	# Load model from path, if necessary
 	if isinstance(model, str):
-		model = load_model(model)
+		model = export.load_exported_model(model) if export.is_exported_model(model) else load_model(model)
 
-	# Check layer shape
-	if layer_name is None:
-		out_layer = model.layers[-1]
+	# Check layer shapes
+	if isinstance(model, export.ExportedModel):
+		if layer_name is not None or jit_compile:
+			raise ValueError("layer_name and jit_compile can't be used with exported models")
+		out_shapes = [model.output_shape]
+	else:
+		out_layers = [model.layers[-1] if name is None else model.get_layer(name) for name in layer_names]
+		out_shapes = [out_layer.output_shape for out_layer in out_layers]
+	for name, out_shape in zip(layer_names, out_shapes):
+		if write_csv and len(out_shape) != 2:
+			raise ValueError(f"Wrong layer shape for write_csv. Required shape is rank 2, i.e. [None, N], got layer {name} with shape {out_shape}")
+		if (score_column is not None):
+			if not isinstance(score_column, int):
+				raise ValueError(f"Invalid type for score_column, expected int, got {type(score_column)}")
+			if score_column >= out_shape[1]:
+				raise ValueError(f"Invalid score_column, got {score_column} but layer shape is {out_shape}")
+
+	# Skip the reverse strand if its activations are the same as the forward strand
+	if isinstance(model, export.ExportedModel):
+		rc_invariant = model.rc_invariant
 	else:
-		out_layer = model.get_layer(layer_name)
-	out_shape = out_layer.output_shape
-	if write_csv and len(out_shape) != 2:
-		raise ValueError(f"Wrong layer shape for write_csv. Required shape is rank 2, i.e. [None, N], got layer {layer_name} with shape {out_shape}")
-	if (score_column is not None):
-		if not isinstance(score_column, int):
-			raise ValueError(f"Invalid type for score_column, expected int, got {type(score_column)}")
-		if score_column >= out_shape[1]:
-			raise ValueError(f"Invalid score_column, got {score_column} but layer shape is {out_shape}")
+		rc_invariant = all(_is_rc_invariant(model, out_layer) for out_layer in out_layers)
+	repeat_for_reverse_complement = use_reverse_complement and rc_invariant
+	if repeat_for_reverse_complement:
+		print("Layer is invariant to reverse complement, predicting forward strand only.")
+		use_reverse_complement = False
 
 	# Get model to evaluate
-	if layer_name is not None:
-		model = keras.Model(inputs=model.inputs, outputs=out_layer.output)
+	if multiple_layers or layer_name is not None or jit_compile:
+		outputs = [out_layer.output for out_layer in out_layers]
+		# A model with one output predicts an array rather than a list, see _stream_activations()
+		model = CnnModel(inputs=model.inputs, outputs=outputs if len(outputs) > 1 else outputs[0], jit_compile=jit_compile)
 
 	# Get dataset
 	if in_genome is not None:
@@ -279,69 +652,268 @@ def get_activations(model, in_file, in_genome=None, out_file=None, layer_name=No
 	else:
 		# in_file is an .fa file
 		source_files = [in_file]
+	if chunk_size is not None:
+		results = _stream_activations(model, source_files, out_files, chunk_size, use_reverse_complement,
+			repeat_for_reverse_complement, write_csv, score_column, batch_size)
+		return results if multiple_layers else results[0]
 	# Only the input sequences will be used, target is fake
 	data = dataset.SequenceTfDataset(
-		source_files, [0], targets_are_classes=True, endless=False, reverse_complement=use_reverse_complement)
+		source_files, [0], targets_are_classes=True, endless=False, reverse_complement=use_reverse_complement,
+		encoding=get_input_encoding(model))
 
 	# Generate predictions
 	print("Predicting...")
 	predictions = model.predict(data.dataset[0], batch_size=batch_size, verbose=1)
+	if len(layer_names) == 1:
+		predictions = [predictions]
+	if repeat_for_reverse_complement:
+		predictions = [np.repeat(layer_predictions, 2, axis=0) for layer_predictions in predictions]
 
 	# Write to file
 	if out_file is not None:
 		print("Saving...")
-		if write_csv:
-			if score_column is None:
-				# Write entire activation as row
-				lines = predictions
+		for layer_predictions, layer_out_file in zip(predictions, out_files):
+			if write_csv:
+				if score_column is None:
+					# Write entire activation as row
+					lines = layer_predictions
+				else:
+					# Extract single value
+					lines = layer_predictions[:, score_column]
+				np.savetxt(layer_out_file, lines, delimiter='\t', fmt='%.8e')
 			else:
-				# Extract single value
-				lines = predictions[:, score_column]
-			np.savetxt(out_file, lines, delimiter='\t', fmt='%.8e')
+				np.save(layer_out_file, layer_predictions)
+
+	return predictions if multiple_layers else predictions[0]
+
+def _stream_activations(model, source_files, out_files, chunk_size, use_reverse_complement,
+	repeat_for_reverse_complement, write_csv, score_column, batch_size):
+	"""Predict chunk by chunk, writing each chunk's activations to out_files, one per model output, before reading
+	the next, as in get_activations(). The next chunk is encoded in a background thread while the current chunk is
+	predicted.
+
+	A .npy out_file is preallocated with one row per output sequence, and memory mapped, and .csv rows are
+	appended. After each chunk is written, the number of finished sequences is saved to `{out_files[0]}.progress`,
+	which is removed once all sequences are done. If the progress file exists, e.g. after an interrupted run,
+	then finished sequences are skipped without predicting them, and writing resumes after them.
+
+	Returns:
+		list, with a read-only memory map of each .npy out_file, or None for each .csv
+	"""
+	sc = dataset.SequenceCollection(source_files, [0], targets_are_classes=True, endless=False,
+		reverse_complement=use_reverse_complement, encoding=get_input_encoding(model))
+	repeats = 2 if repeat_for_reverse_complement else 1
+	progress_path = f"{out_files[0]}.progress"
+	progress = {'num_done': 0, 'offsets': [0] * len(out_files)}
+	if os.path.exists(progress_path):
+		with open(progress_path) as f:
+			progress = json.load(f)
+		print(f"Resuming after {progress['num_done']} of {len(sc)} sequences")
+
+	def save_progress(num_done, offsets):
+		tmp_path = f"{progress_path}.tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump({'num_done': num_done, 'offsets': offsets}, f)
+		os.replace(tmp_path, progress_path)
+
+	def read_chunks():
+		seqs = itertools.islice((seq for seq, _ in sc), progress['num_done'], None)
+		while True:
+			chunk = list(itertools.islice(seqs, chunk_size))
+			if not chunk:
+				return
+			yield np.stack(chunk)
+
+	num_done = progress['num_done']
+	outs = [None] * len(out_files)
+	for idx, out_file in enumerate(out_files):
+		if write_csv:
+			# Drop any rows written after the last saved progress
+			outs[idx] = open(out_file, 'r+' if num_done > 0 else 'w')
+			outs[idx].truncate(progress['offsets'][idx])
+			outs[idx].seek(progress['offsets'][idx])
+		elif num_done > 0:
+			outs[idx] = np.lib.format.open_memmap(out_file, mode='r+')
+
+	print(f"Predicting in chunks of {chunk_size}...")
+	chunks = read_chunks()
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		next_chunk = executor.submit(next, chunks, None)
+		while True:
+			xs = next_chunk.result()
+			if xs is None:
+				break
+			next_chunk = executor.submit(next, chunks, None)
+			predictions = model.predict(xs, batch_size=batch_size, verbose=0)
+			if len(out_files) == 1:
+				predictions = [predictions]
+
+			for idx, (layer_predictions, out_file) in enumerate(zip(predictions, out_files)):
+				if repeat_for_reverse_complement:
+					layer_predictions = np.repeat(layer_predictions, 2, axis=0)
+				if write_csv:
+					lines = layer_predictions if score_column is None else layer_predictions[:, score_column]
+					np.savetxt(outs[idx], lines, delimiter='\t', fmt='%.8e')
+					outs[idx].flush()
+					os.fsync(outs[idx].fileno())
+				else:
+					if outs[idx] is None:
+						outs[idx] = np.lib.format.open_memmap(out_file, mode='w+', dtype=layer_predictions.dtype,
+							shape=(len(sc) * repeats,) + layer_predictions.shape[1:])
+					outs[idx][num_done * repeats:num_done * repeats + len(layer_predictions)] = layer_predictions
+					outs[idx].flush()
+			num_done += len(xs)
+			save_progress(num_done, [out.tell() for out in outs] if write_csv else [0] * len(outs))
+			print(f"{num_done} / {len(sc)} sequences")
+
+	results = []
+	for out, out_file in zip(outs, out_files):
+		if write_csv:
+			out.close()
+			results.append(None)
 		else:
-			np.save(out_file, predictions)
+			results.append(np.load(out_file, mmap_mode='r'))
+	os.remove(progress_path)
+	return results
 
-	return predictions
+def _is_rc_invariant(model, layer):
+	"""Whether the output of this layer is invariant to reverse complementing the model input,
+	because it comes after a RevCompMax layer."""
+	merge_idxs = [idx for idx, l in enumerate(model.layers) if isinstance(l, custom_layers.RevCompMax)]
+	return len(merge_idxs) > 0 and model.layers.index(layer) >= merge_idxs[0]
 
 class AdditionalValidation:
     """Validate on additional validation sets.
     Adapted from https://stackoverflow.com/a/62902854
+
+    All sets are predicted in one pass, as if they were concatenated, and then each set's metrics are
+    computed from its segment of the predictions, with fresh copies of the model's compiled metrics.
+    This gives the same results as calling model.evaluate() on each set, without a separate evaluation
+    loop and mostly-empty last batch per set.
+
+    Each set's arrays are only read from val_data.dataset during evaluate(), so sets that are opened
+    lazily, e.g. dataset.MemmapDataset, take no memory between evaluations.
     """
-    def __init__(self, model, val_datasets, metrics=None, batch_size=constants.DEFAULT_BATCH_SIZE):
+    def __init__(self, model, val_datasets, metrics=None, batch_size=constants.DEFAULT_BATCH_SIZE, num_examples=None):
+        """
+        Args:
+            num_examples (int): (Optional) evaluate on a fixed random subsample of at most this many examples
+                from each set, instead of the whole set
+        """
         self.model = model
         self.val_datasets = val_datasets
         self.metrics = metrics or ['acc']
         self.batch_size = batch_size
+        self.num_examples = num_examples
+        # Indices of the subsample of each set, chosen at the first evaluation
+        self.subsample_idxs = None
 
     def evaluate(self):
+        xs, ys = self._get_arrays()
+        # Boundaries of each set in the concatenated examples
+        boundaries = np.concatenate([[0], np.cumsum([len(set_ys) for set_ys in ys])])
+        y_pred = self.model.predict(self._get_batches(xs, boundaries), verbose=0)
+        metric_objs = self._get_metric_objs(y_pred, ys[0])
         results = {}
-        for idx, val_data in tqdm(enumerate(self.val_datasets), total=len(self.val_datasets)):
-            values = self.model.evaluate(
-                x=val_data.dataset[0], y=val_data.dataset[1],
-                batch_size=self.batch_size, return_dict=True, verbose=0)
+        for idx, set_ys in enumerate(ys):
+            start, end = boundaries[idx], boundaries[idx + 1]
+            values = {}
+            for metric_obj in metric_objs:
+                metric_obj.reset_state()
+                metric_obj.update_state(set_ys, y_pred[start:end])
+                result = metric_obj.result()
+                values.update(result if isinstance(result, dict) else {metric_obj.name: result})
             for metric in self.metrics:
-                results[f'val_{idx + 1}_{metric}'] = values[metric]
+                results[f'val_{idx + 1}_{metric}'] = float(values[metric])
         # Aggregate metrics with geometric mean
+        num_values = len(self.val_datasets)
         for metric in self.metrics:
-            num_values = len(self.val_datasets)
-            values = [results[f'val_{idx + 1}_{metric}'] for idx in range(num_values)]
+            values = np.array([results[f'val_{idx + 1}_{metric}'] for idx in range(num_values)])
             # https://en.wikipedia.org/wiki/Geometric_mean
-            results[f'val_*_{metric}_gm'] = np.power(np.product(values), 1 / num_values)
+            results[f'val_*_{metric}_gm'] = np.power(np.prod(values), 1 / num_values)
         return results
 
-def get_additional_validation(config, model):
-    """Get AdditionalValidation with datasets and metrics based on config."""
+    def _get_arrays(self):
+        """Get (xs, ys), lists of each set's sequences and targets, subsampled if num_examples is set."""
+        xs, ys = [], []
+        for val_data in self.val_datasets:
+            set_xs, set_ys = val_data.dataset
+            xs.append(set_xs)
+            ys.append(set_ys)
+        if self.num_examples is not None:
+            if self.subsample_idxs is None:
+                rng = np.random.default_rng(0)
+                self.subsample_idxs = [
+                    np.sort(rng.choice(len(set_ys), size=self.num_examples, replace=False))
+                    if self.num_examples < len(set_ys) else None
+                    for set_ys in ys]
+            for idx, subsample_idxs in enumerate(self.subsample_idxs):
+                if subsample_idxs is not None:
+                    xs[idx], ys[idx] = xs[idx][subsample_idxs], ys[idx][subsample_idxs]
+        return xs, ys
+
+    def _get_batches(self, xs, boundaries):
+        """Batches of sequences from all sets, in order. Batches can span the end of one set and the start of the next."""
+        def gen():
+            for start in range(0, boundaries[-1], self.batch_size):
+                end = min(start + self.batch_size, boundaries[-1])
+                # Sets that overlap this batch
+                first = np.searchsorted(boundaries, start, side='right') - 1
+                last = np.searchsorted(boundaries, end, side='left')
+                yield np.concatenate([
+                    xs[idx][max(start, boundaries[idx]) - boundaries[idx]:min(end, boundaries[idx + 1]) - boundaries[idx]]
+                    for idx in range(first, last)])
+        return tf.data.Dataset.from_generator(gen, output_signature=tf.TensorSpec(
+            shape=(None,) + xs[0].shape[1:], dtype=xs[0].dtype)).prefetch(1)
+
+    def _get_metric_objs(self, y_pred, y_true):
+        """Fresh copies of the model's compiled metrics, so that the model's own metric states are unchanged."""
+        compiled_metrics = self.model.compiled_metrics
+        if not compiled_metrics.built:
+            compiled_metrics.build(tf.convert_to_tensor(y_pred), tf.convert_to_tensor(y_true))
+        return [type(metric).from_config(metric.get_config()) for metric in compiled_metrics.metrics]
+
+def get_additional_val_datasets(config, encoding='onehot'):
+    """Get the additional validation datasets in config, or None if there are none.
+
+    If config.additional_val_cache_dir is set, then the datasets are dataset.MemmapDataset, which are only
+    loaded while evaluating.
+    """
     if config.get('additional_val_data_paths') is None:
         return None
-
-    val_datasets = [
-        dataset.SequenceTfDataset(paths, targets, targets_are_classes=config.targets_are_classes,
+    if config.get('additional_val_cache_dir') is not None:
+        return [
+            dataset.MemmapDataset(paths, targets, targets_are_classes=config.targets_are_classes,
+                map_targets=False, reverse_complement=config.use_reverse_complement, encoding=encoding,
+                cache_dir=config.additional_val_cache_dir)
+            for paths, targets in zip(config.additional_val_data_paths, config.additional_val_targets)
+        ]
+    load_dataset = dataset_server.get_dataset_loader(config)
+    return [
+        load_dataset(paths, targets, targets_are_classes=config.targets_are_classes,
             # Use map_targets=False in case some datasets have only positive label
-            endless=False, map_targets=False, reverse_complement=config.use_reverse_complement)
+            endless=False, map_targets=False, reverse_complement=config.use_reverse_complement,
+            encoding=encoding)
         for paths, targets in zip(config.additional_val_data_paths, config.additional_val_targets)
     ]
+
+def get_additional_val_metrics(config):
+    """Names of the metrics to report on additional validation sets."""
     if config.targets_are_classes:
-    	metrics = ['acc', 'auroc', 'auprc', 'precision', 'sensitivity', 'f1', 'npv', 'specificity', 'npvsc']
-    else:
-    	metrics = ['mean_squared_error']
-    return AdditionalValidation(model, val_datasets, metrics=metrics, batch_size=config.batch_size)
+        return ['acc', 'auroc', 'auprc', 'precision', 'sensitivity', 'f1', 'npv', 'specificity', 'npvsc']
+    return ['mean_squared_error']
+
+def get_additional_validation(config, model, val_datasets=None, num_examples=None):
+    """Get AdditionalValidation with datasets and metrics based on config.
+
+    Args:
+        val_datasets (list of dataset.SequenceTfDataset): (Optional) prebuilt datasets, see get_additional_val_datasets()
+        num_examples (int): (Optional) number of examples to subsample from each set, see AdditionalValidation
+    """
+    if val_datasets is None:
+        val_datasets = get_additional_val_datasets(config, encoding=get_input_encoding(model))
+    if val_datasets is None:
+        return None
+
+    return AdditionalValidation(model, val_datasets, metrics=get_additional_val_metrics(config), batch_size=config.batch_size,
+        num_examples=num_examples)
@@ -0,0 +1,155 @@
+"""pruning.py: Structured filter pruning of trained convolutional models.
+
+Filters are scored by their mean activation over a sample of sequences. In each convolutional layer,
+the lowest scoring filters are removed, along with the matching input weights of the next layer.
+Filters that are never active, or rarely active, have little effect on the output, so the pruned
+model is close to the original, and can be fine-tuned to recover the rest.
+"""
+
+import numpy as np
+from tensorflow import keras
+from tensorflow.keras import layers
+
+import benchmarking
+import constants
+import custom_layers
+import scoring
+
+
+def get_conv_layers(model):
+	return [layer for layer in model.layers if isinstance(layer, layers.Conv1D)]
+
+def get_filter_scores(model, xs, batch_size=constants.DEFAULT_BATCH_SIZE):
+	"""Score the filters of each convolutional layer by mean activation.
+
+	Args:
+		model (keras model)
+		xs (np.ndarray): sample of input sequences, e.g. from the validation set
+		batch_size (int)
+
+	Returns:
+		dict: {layer name: np.ndarray of shape [filters]}. For RevCompConv1D layers, the score of
+			each filter is the mean over the filter and its reverse complement.
+	"""
+	conv_layers = get_conv_layers(model)
+	outputs = [layers.GlobalAveragePooling1D()(layer.output) for layer in conv_layers]
+	means = keras.Model(inputs=model.inputs, outputs=outputs).predict(xs, batch_size=batch_size, verbose=0)
+	if len(conv_layers) == 1:
+		means = [means]
+
+	scores = {}
+	for layer, layer_means in zip(conv_layers, means):
+		layer_scores = layer_means.mean(axis=0)
+		if isinstance(layer, custom_layers.RevCompConv1D):
+			# Reverse complement filters are in reverse order, see RevCompConv1D
+			layer_scores = (layer_scores[:layer.filters] + layer_scores[layer.filters:][::-1]) / 2
+		scores[layer.name] = layer_scores
+	return scores
+
+def get_filters_to_keep(scores, prune_fraction):
+	"""Get the indices of the highest scoring filters in each layer.
+
+	Args:
+		scores (dict): {layer name: filter scores}, see get_filter_scores()
+		prune_fraction (float or list of float): fraction of filters to remove from each layer.
+			If a list, then one fraction per convolutional layer.
+
+	Returns:
+		dict: {layer name: sorted np.ndarray of filter indices to keep}
+	"""
+	if not isinstance(prune_fraction, list):
+		prune_fraction = [prune_fraction] * len(scores)
+	if len(prune_fraction) != len(scores):
+		raise ValueError(f"Expected {len(scores)} prune fractions, one per conv layer, got {prune_fraction}")
+
+	keep = {}
+	for (name, layer_scores), fraction in zip(scores.items(), prune_fraction):
+		num_keep = max(1, int(round(len(layer_scores) * (1 - fraction))))
+		keep[name] = np.sort(np.argsort(-layer_scores, kind='stable')[:num_keep])
+	return keep
+
+def prune_model(model, keep):
+	"""Get a copy of the model with only the given filters in each convolutional layer.
+
+	The model must be a chain of layers, as built by models.get_model_architecture().
+
+	Args:
+		model (keras model)
+		keep (dict): {layer name: filter indices to keep}, see get_filters_to_keep()
+
+	Returns:
+		keras model, not compiled
+	"""
+	inputs = keras.Input(shape=model.input_shape[1:], dtype=model.inputs[0].dtype)
+	x = inputs
+	# Indices of the original channels of x that are kept, or None if all channels are kept
+	channels = None
+	for layer in model.layers[1:]:
+		layer_config = layer.get_config()
+		weights = layer.get_weights()
+
+		if isinstance(layer, layers.Conv1D):
+			kernel, *bias = weights
+			if channels is not None:
+				kernel = kernel[:, channels]
+			if layer.name in keep:
+				filters = keep[layer.name]
+				layer_config['filters'] = len(filters)
+				kernel = kernel[..., filters]
+				bias = [b[filters] for b in bias]
+				channels = _get_output_channels(layer, filters)
+			else:
+				channels = None
+			weights = [kernel] + bias
+		elif isinstance(layer, layers.Dense):
+			kernel, *bias = weights
+			if channels is not None:
+				kernel = kernel[channels]
+			weights = [kernel] + bias
+			channels = None
+		elif isinstance(layer, custom_layers.RevCompMax) and channels is not None:
+			# Forward filters are the first half of the channels
+			channels = channels[:len(channels) // 2]
+		elif isinstance(layer, layers.Flatten) and channels is not None:
+			seq_len, num_channels = layer.input_shape[1:]
+			channels = (np.arange(seq_len)[:, np.newaxis] * num_channels + channels).reshape(-1)
+		# Other layers, e.g. dropout and pooling, act on each channel separately
+
+		new_layer = layer.__class__.from_config(layer_config)
+		x = new_layer(x)
+		new_layer.set_weights(weights)
+	return keras.Model(inputs=inputs, outputs=x)
+
+def _get_output_channels(layer, filters):
+	"""Get the output channels of a conv layer that correspond to the given filters."""
+	if isinstance(layer, custom_layers.RevCompConv1D):
+		# Forward filters, then reverse complement filters in reverse order
+		return np.concatenate([filters, 2 * layer.filters - 1 - filters[::-1]])
+	return filters
+
+def count_flops(model):
+	"""Count floating point operations per example in the conv and dense layers, as 2 * multiply-adds.
+	TokenConv1D layers are counted as the equivalent one-hot convolution.
+	"""
+	flops = 0
+	for layer in model.layers:
+		if isinstance(layer, layers.Conv1D):
+			# Output channels include reverse complement filters for RevCompConv1D
+			out_len, out_channels = layer.output_shape[1:]
+			kernel_size, in_channels = layer.kernel.shape[:2]
+			flops += 2 * out_len * kernel_size * in_channels * out_channels
+		elif isinstance(layer, layers.Dense):
+			flops += 2 * np.prod(layer.kernel.shape)
+	return int(flops)
+
+def get_report_row(name, model, xs, ys, num_classes, pos_label=None, batch_size=constants.DEFAULT_BATCH_SIZE):
+	"""Get size, speed and accuracy of a model, for comparing pruned models."""
+	preds = model.predict(xs, batch_size=batch_size, verbose=0)
+	row = {
+		'model': name,
+		'params': model.count_params(),
+		'flops': count_flops(model),
+		'conv_filters': [layer.filters for layer in get_conv_layers(model)]}
+	row.update(scoring.get_scores(ys, preds, num_classes, pos_label=pos_label))
+	row['examples_per_sec'] = benchmarking.time_predict(model, xs, batch_size)
+	return row
@@ -0,0 +1,210 @@
+"""scoring.py: Numpy metrics on arrays of predictions, for comparing models outside of keras."""
+
+import numpy as np
+
+# As keras.backend.epsilon(), for clipping probabilities and denominators
+EPSILON = 1e-7
+
+
+def auroc(y_true, y_score):
+	"""Exact area under the ROC curve, via the Mann-Whitney U statistic. Tied scores count as half.
+
+	Args:
+		y_true (np.ndarray): [num_examples], bool or 0/1 labels, True for the positive class
+		y_score (np.ndarray): [num_examples], scores for the positive class
+	"""
+	y_true = np.asarray(y_true).astype(bool)
+	num_pos = y_true.sum()
+	num_neg = len(y_true) - num_pos
+	if num_pos == 0 or num_neg == 0:
+		raise ValueError(f"AUROC needs both classes, got {num_pos} positive and {num_neg} negative examples")
+	ranks = _average_ranks(np.asarray(y_score))
+	return (ranks[y_true].sum() - num_pos * (num_pos + 1) / 2) / (num_pos * num_neg)
+
+def _average_ranks(x):
+	"""1-based ranks of x, where tied values get the average of their ranks."""
+	order = np.argsort(x, kind='mergesort')
+	sorted_x = x[order]
+	# Start and end indices of each run of tied values
+	starts = np.flatnonzero(np.r_[True, sorted_x[1:] != sorted_x[:-1]])
+	ends = np.r_[starts[1:], len(x)]
+	ranks = np.empty(len(x))
+	ranks[order] = np.repeat((starts + 1 + ends) / 2, ends - starts)
+	return ranks
+
+def auprc(y_true, y_score):
+	"""Exact area under the precision-recall curve, as average precision: the sum over distinct scores of
+	precision times the increase in recall, as sklearn.metrics.average_precision_score.
+
+	Args:
+		y_true (np.ndarray): [num_examples], bool or 0/1 labels, True for the positive class
+		y_score (np.ndarray): [num_examples], scores for the positive class
+	"""
+	y_true = np.asarray(y_true).astype(bool)
+	y_score = np.asarray(y_score)
+	num_pos = y_true.sum()
+	if num_pos == 0:
+		raise ValueError("AUPRC needs positive examples, got none")
+	order = np.argsort(-y_score, kind='mergesort')
+	sorted_score = y_score[order]
+	# Last index of each run of tied scores, from highest to lowest
+	ends = np.r_[np.flatnonzero(sorted_score[1:] != sorted_score[:-1]), len(y_score) - 1]
+	tp = np.cumsum(y_true[order])[ends]
+	precision = tp / (ends + 1)
+	return np.sum(np.diff(np.r_[0, tp]) * precision) / num_pos
+
+def get_metrics(y_true, y_pred, num_classes, pos_label=None, neg_label=None, regularization_loss=0.):
+	"""Get the metrics that models.get_metrics() logs during training, from predictions.
+
+	Metrics are as in metrics.ConfusionHistogram, except that AUCs are exact, as with metrics.ExactAUC.
+	Metrics that are undefined, e.g. AUROC on a set with one class, are 0, as in training logs.
+
+	Args:
+		y_true (np.ndarray): [num_examples], class indices or regression targets
+		y_pred (np.ndarray): [num_examples, num_outputs], model outputs
+		num_classes (int or None): number of classes, or None for regression
+		pos_label (int): class index of the positive class. Required if num_classes is not None.
+		neg_label (int): (Optional) class index of the negative class, for 'npv', 'specificity' and 'npvsc'
+		regularization_loss (float): model's regularization loss, which keras adds to 'loss'
+
+	Returns:
+		dict: {metric name: value}
+	"""
+	if num_classes is None:
+		y_pred = y_pred.reshape(-1)
+		errors = y_pred - y_true
+		mse = float(np.mean(errors ** 2))
+		return {
+			'loss': mse + regularization_loss,
+			'mean_squared_error': mse,
+			'mean_absolute_error': float(np.mean(np.abs(errors))),
+			'mean_absolute_percentage_error': float(100 * np.mean(np.abs(errors) / np.maximum(np.abs(y_true), EPSILON)))}
+
+	y_true = y_true.astype(int)
+	probs = np.clip(y_pred[np.arange(len(y_true)), y_true], EPSILON, 1 - EPSILON)
+	pred_label = np.argmax(y_pred, axis=-1)
+	results = {
+		'loss': float(-np.mean(np.log(probs))) + regularization_loss,
+		'acc': float(np.mean(pred_label == y_true))}
+	for label, names in [
+		(pos_label, {'auroc': 'auroc', 'auprc': 'auprc', 'precision': 'precision', 'recall': 'sensitivity', 'f1': 'f1'}),
+		(neg_label, {'precision': 'npv', 'recall': 'specificity', 'auprc': 'npvsc'})]:
+		if label is None:
+			continue
+		label_true = y_true == label
+		num_pos = label_true.sum()
+		# Precision and recall at threshold 0.5, and F1 of the argmax class, as in ConfusionHistogram
+		label_pred = y_pred[:, label] > 0.5
+		tp = np.sum(label_pred & label_true)
+		argmax_tp = np.sum((pred_label == label) & label_true)
+		stats = {
+			'auroc': lambda: auroc(label_true, y_pred[:, label]) if 0 < num_pos < len(y_true) else 0.,
+			'auprc': lambda: auprc(label_true, y_pred[:, label]) if num_pos > 0 else 0.,
+			'precision': lambda: _divide(tp, label_pred.sum()),
+			'recall': lambda: _divide(tp, num_pos),
+			'f1': lambda: _divide(2 * argmax_tp, np.sum(pred_label == label) + num_pos)}
+		results.update({name: float(stats[stat]()) for stat, name in names.items()})
+	return results
+
+def bootstrap_metrics(y_true, y_pred, num_classes, pos_label=None, neg_label=None, num_replicates=1000, seed=0,
+	max_chunk_elements=int(1e5)):
+	"""Get metrics on bootstrap replicates of a set of predictions, for confidence intervals.
+
+	Each replicate resamples the examples with replacement, which is the same as weighting each example by
+	the number of times it was drawn. So the examples are sorted by score once, and each replicate's AUCs
+	are computed from cumulative sums of its weights in that order, with ties as in auroc() and auprc().
+	Replicates are computed in chunks of at most max_chunk_elements resampled examples at once, e.g. 1000
+	replicates of 100K examples take ~10s. Chunks that fit in the CPU cache are fastest.
+
+	Args:
+		y_true, y_pred, num_classes, pos_label, neg_label: as in get_metrics()
+
+	Returns:
+		dict of {metric name: np.ndarray [num_replicates]}: 'acc', 'auroc', 'auprc', and 'npvsc' if neg_label
+			is given, or 'mean_squared_error' for regression. Undefined AUCs are 0, as in get_metrics().
+	"""
+	rng = np.random.default_rng(seed)
+	num_examples = len(y_true)
+	if num_classes is None:
+		per_example = {'mean_squared_error': (y_pred.reshape(-1) - y_true) ** 2}
+		curves = []
+	else:
+		y_true = y_true.astype(int)
+		per_example = {'acc': (np.argmax(y_pred, axis=-1) == y_true).astype(float)}
+		curves = [(pos_label, ['auroc', 'auprc'])] + ([(neg_label, ['npvsc'])] if neg_label is not None else [])
+		curves = [(_sort_by_score(y_true == label, y_pred[:, label]), names) for label, names in curves]
+
+	results = {name: [] for name in per_example}
+	results.update({name: [] for _, names in curves for name in names})
+	chunk_size = max(1, max_chunk_elements // num_examples)
+	for start in range(0, num_replicates, chunk_size):
+		size = min(chunk_size, num_replicates - start)
+		# Number of times each example is drawn in each replicate: [size, num_examples]
+		idxs = rng.integers(num_examples, size=(size, num_examples))
+		counts = np.bincount((idxs + num_examples * np.arange(size)[:, np.newaxis]).reshape(-1),
+			minlength=size * num_examples).reshape(size, num_examples).astype(float)
+		for name, values in per_example.items():
+			results[name].append(counts @ values / num_examples)
+		for (order, is_pos, ends), names in curves:
+			aucs = _weighted_aucs(counts[:, order], is_pos, ends)
+			for name in names:
+				results[name].append(aucs['auroc' if name == 'auroc' else 'auprc'])
+	return {name: np.concatenate(values) for name, values in results.items()}
+
+def _sort_by_score(y_true, y_score):
+	"""Get the order of examples by decreasing score, their labels in that order, and the last index of each run of tied scores."""
+	order = np.argsort(-y_score, kind='mergesort')
+	sorted_score = y_score[order]
+	ends = np.r_[np.flatnonzero(sorted_score[1:] != sorted_score[:-1]), len(y_score) - 1]
+	return order, y_true[order], ends
+
+def _weighted_aucs(weights, is_pos, ends):
+	"""AUROC and AUPRC for each row of example weights, with examples sorted by decreasing score, see _sort_by_score().
+
+	Args:
+		weights (np.ndarray): [num_rows, num_examples]
+
+	Returns:
+		dict of {'auroc', 'auprc': np.ndarray [num_rows]}
+	"""
+	# True positives, and all examples, with a score of at least each distinct score
+	tp = np.cumsum(weights * is_pos, axis=1)
+	total = np.cumsum(weights, axis=1)
+	if len(ends) < weights.shape[1]:
+		tp, total = tp[:, ends], total[:, ends]
+	fp = total - tp
+	num_pos, num_neg = tp[:, -1], fp[:, -1]
+	# Positives and negatives with each distinct score
+	pos = np.diff(tp, axis=1, prepend=0)
+	neg = np.diff(fp, axis=1, prepend=0)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		# Negatives with a lower score than each positive, plus half of the tied negatives
+		auroc = (num_pos * num_neg - np.sum(pos * (fp - neg / 2), axis=1)) / (num_pos * num_neg)
+		precision = np.divide(tp, total, out=np.zeros_like(tp), where=total > 0)
+		auprc = np.sum(pos * precision, axis=1) / num_pos
+	return {'auroc': np.nan_to_num(auroc), 'auprc': np.nan_to_num(auprc)}
+
+def _divide(numerator, denominator):
+	"""numerator / denominator, or 0 if denominator is 0, as tf.math.divide_no_nan."""
+	return numerator / denominator if denominator else 0.
+
+def get_scores(y_true, y_pred, num_classes, pos_label=None):
+	"""Get summary metrics of predictions.
+
+	Args:
+		y_true (np.ndarray): [num_examples], class indices or regression targets
+		y_pred (np.ndarray): [num_examples, num_outputs], model outputs
+		num_classes (int or None): number of classes, or None for regression
+		pos_label (int): class index of the positive class, for AUROC. Required if num_classes is not None.
+
+	Returns:
+		dict: 'acc' and 'auroc' for classification, or 'mse' and 'pearson' for regression
+	"""
+	if num_classes is None:
+		y_pred = y_pred.reshape(-1)
+		return {
+			'mse': float(np.mean((y_pred - y_true) ** 2)),
+			'pearson': float(np.corrcoef(y_pred, y_true)[0, 1])}
+	return {
+		'acc': float(np.mean(np.argmax(y_pred, axis=-1) == y_true)),
+		'auroc': float(auroc(y_true == pos_label, y_pred[:, pos_label]))}
@@ -0,0 +1,151 @@
+"""autotune.py: Find the fastest batch size and tensorflow thread settings for training and prediction on this node.
+
+Each trial runs in a new process, since tensorflow's thread pools can't be changed once it has started.
+A trial builds the model in the config with models.get_model(), then times training steps on the real
+training data pipeline, and prediction (as in models.get_activations()) on real training sequences.
+Trials whose peak memory use (RSS) is over -max_memory_gb are excluded, and larger batch sizes with the
+same thread settings are skipped.
+
+The best settings are written to -out_config, a copy of the config with:
+- batch_size, intra_op_threads, inter_op_threads: fastest training, used by train.py
+- predict_batch_size, predict_intra_op_threads, predict_inter_op_threads: fastest prediction, used by
+	scripts/get_activations.py -config <out_config>
+Note that changing batch_size changes training, e.g. you may want to scale the learning rate with it.
+
+Usage: python scripts/autotune.py \
+	-config <path to config .yaml> \
+	-out_config <path to save config with the best settings> \
+	[-batch_sizes <batch sizes to try>. default 256 512 1024 2048] \
+	[-intra_op_threads <intra-op thread counts to try, 0 is tensorflow's default>. default 0, cores / 2, cores / 4] \
+	[-inter_op_threads <inter-op thread counts to try, 0 is tensorflow's default>. default 0 2] \
+	[-max_memory_gb <memory ceiling per trial>. default no ceiling] \
+	[-num_steps <number of timed training steps per trial>. default 50] \
+	[-csv <path to save results of all trials as a .csv file>]
+"""
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+import multiprocessing
+import os
+import resource
+
+import pandas as pd
+import yaml
+
+import utils
+
+
+def autotune(config_path, out_config, batch_sizes, intra_op_threads, inter_op_threads, max_memory_gb=None,
+	num_steps=50, out_csv=None):
+	rows = []
+	for intra in intra_op_threads:
+		for inter in inter_op_threads:
+			for batch_size in sorted(batch_sizes):
+				row = {'batch_size': batch_size, 'intra_op_threads': intra, 'inter_op_threads': inter}
+				row.update(run_trial_process(config_path, batch_size, intra, inter, num_steps))
+				row['within_memory'] = row['ok'] and (max_memory_gb is None or row['peak_rss_gb'] <= max_memory_gb)
+				rows.append(row)
+				print(row)
+				if not row['within_memory']:
+					# Larger batches use more memory
+					break
+
+	df = pd.DataFrame(rows)
+	print(df.to_string(index=False))
+	if out_csv is not None:
+		df.to_csv(out_csv, index=False)
+	valid = df[df['within_memory']]
+	if len(valid) == 0:
+		raise RuntimeError("No settings fit within the memory ceiling")
+
+	best_train = valid.loc[valid['train_examples_per_sec'].idxmax()]
+	best_predict = valid.loc[valid['predict_examples_per_sec'].idxmax()]
+	print(f"Best training settings:\n{best_train}\nBest prediction settings:\n{best_predict}")
+	write_config(config_path, out_config, {
+		'batch_size': int(best_train['batch_size']),
+		'intra_op_threads': int(best_train['intra_op_threads']),
+		'inter_op_threads': int(best_train['inter_op_threads']),
+		'predict_batch_size': int(best_predict['batch_size']),
+		'predict_intra_op_threads': int(best_predict['intra_op_threads']),
+		'predict_inter_op_threads': int(best_predict['inter_op_threads'])
+	})
+	return df
+
+def run_trial_process(config_path, batch_size, intra, inter, num_steps):
+	"""Run run_trial() in a new process, and get its results. If the process fails, e.g. out of memory, then ok is False."""
+	ctx = multiprocessing.get_context('spawn')
+	queue = ctx.Queue()
+	process = ctx.Process(target=run_trial, args=(config_path, batch_size, intra, inter, num_steps, queue))
+	process.start()
+	process.join()
+	if process.exitcode != 0 or queue.empty():
+		return {'ok': False, 'train_examples_per_sec': None, 'predict_examples_per_sec': None, 'peak_rss_gb': None}
+	return {'ok': True, **queue.get()}
+
+def run_trial(config_path, batch_size, intra, inter, num_steps, queue):
+	utils.set_threads(intra, inter)
+	import numpy as np
+	import wandb
+
+	import benchmarking
+	import dataset_server
+	import models
+
+	wandb.init(config=config_path, mode='disabled')
+	config = wandb.config
+	config.update({'batch_size': batch_size}, allow_val_change=True)
+	utils.validate_config(config)
+
+	# Training data, as in train.get_datasets()
+	train_data = dataset_server.get_dataset_loader(config)(
+		config.train_data_paths, config.train_targets,
+		targets_are_classes=config.targets_are_classes, endless=True,
+		batch_size=utils.get_micro_batch_size(config),
+		reverse_complement=config.use_reverse_complement,
+		encoding=config.get('input_encoding', 'onehot'))
+	model = models.get_model(
+		train_data.seq_shape, train_data.num_classes, train_data.class_to_idx_mapping, config.lr_init, config)
+	train_examples_per_sec = benchmarking.time_train_steps(
+		model, train_data.dataset, num_steps, utils.get_micro_batch_size(config))
+
+	# Prediction on real sequences, as in models.get_activations()
+	num_predict = min(len(train_data), batch_size * num_steps)
+	xs = next(train_data.ds.take(num_predict).batch(num_predict).as_numpy_iterator())[0]
+	predict_examples_per_sec = benchmarking.time_predict(model, np.asarray(xs), batch_size)
+
+	queue.put({
+		'train_examples_per_sec': train_examples_per_sec,
+		'predict_examples_per_sec': predict_examples_per_sec,
+		# ru_maxrss is in KB on Linux
+		'peak_rss_gb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6
+	})
+
+def write_config(config_path, out_config, values):
+	"""Copy the config at config_path to out_config, with new values for some keys."""
+	with open(config_path) as f:
+		config = yaml.safe_load(f)
+	for key, value in values.items():
+		config.setdefault(key, {'desc': 'Set by scripts/autotune.py'})['value'] = value
+	with open(out_config, 'w') as f:
+		yaml.safe_dump(config, f, sort_keys=False)
+	print(f"Saved config with best settings to {out_config}")
+
+def get_args():
+	import argparse
+	num_cores = os.cpu_count()
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-config', type=str, required=True, help='Path to config .yaml file')
+	parser.add_argument('-out_config', type=str, required=True, help='Path to save config with the best settings')
+	parser.add_argument('-batch_sizes', type=int, nargs='+', default=[256, 512, 1024, 2048])
+	parser.add_argument('-intra_op_threads', type=int, nargs='+', default=sorted({0, num_cores // 2, num_cores // 4}))
+	parser.add_argument('-inter_op_threads', type=int, nargs='+', default=[0, 2])
+	parser.add_argument('-max_memory_gb', type=float, help='(Optional) Memory ceiling per trial')
+	parser.add_argument('-num_steps', type=int, default=50)
+	parser.add_argument('-csv', type=str, help='(Optional) Path to save results as a .csv file')
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = get_args()
+	autotune(args.config, args.out_config, args.batch_sizes, args.intra_op_threads, args.inter_op_threads,
+		max_memory_gb=args.max_memory_gb, num_steps=args.num_steps, out_csv=args.csv)
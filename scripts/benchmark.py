@@ -0,0 +1,68 @@
+"""benchmark.py: Measure training and prediction throughput with and without XLA compilation.
+
+Synthetic data is used, so only the architecture and optimization settings of each config matter.
+
+Usage: python scripts/benchmark.py \
+	[-configs <paths to config .yaml files>. default is all configs in example_configs/] \
+	[-seq_len <input sequence length>. default 500] \
+	[-num_steps <number of timed training steps>. default 50] \
+	[-csv <path to save results as a .csv file>]
+"""
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+import glob
+
+import pandas as pd
+import tensorflow as tf
+import wandb
+
+import benchmarking
+import lr_schedules
+import models
+
+
+def benchmark(config_paths, seq_len, num_steps, out_csv=None):
+	rows = []
+	for config_path in config_paths:
+		wandb.init(config=config_path, mode='disabled')
+		config = wandb.config
+		num_classes = 2 if config.targets_are_classes else None
+		class_to_idx_mapping = {0: 0, 1: 1} if config.targets_are_classes else None
+		batch_size = config.batch_size
+		data = benchmarking.get_synthetic_dataset(batch_size * 4, seq_len, num_classes, batch_size)
+		xs, _ = benchmarking.get_synthetic_data(batch_size * num_steps // 4, seq_len, num_classes)
+
+		for use_xla in [False, True]:
+			tf.keras.backend.clear_session()
+			config.update({'use_xla': use_xla}, allow_val_change=True)
+			lr_schedule = lr_schedules.get_lr_schedule(num_steps, config)
+			model = models.get_model(
+				(seq_len, 4), num_classes, class_to_idx_mapping, lr_schedule, config)
+			rows.append({
+				'config': config_path,
+				'use_xla': use_xla,
+				'train_examples_per_sec': benchmarking.time_train_steps(model, data, num_steps, batch_size),
+				'predict_examples_per_sec': benchmarking.time_predict(model, xs, batch_size)
+			})
+			print(rows[-1])
+
+	df = pd.DataFrame(rows)
+	print(df.to_string(index=False))
+	if out_csv is not None:
+		df.to_csv(out_csv, index=False)
+	return df
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-configs', type=str, nargs='+', default=sorted(glob.glob('../example_configs/*.yaml')))
+	parser.add_argument('-seq_len', type=int, default=500)
+	parser.add_argument('-num_steps', type=int, default=50)
+	parser.add_argument('-csv', type=str, help='(Optional) Path to save results as a .csv file')
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = get_args()
+	benchmark(args.configs, args.seq_len, args.num_steps, out_csv=args.csv)
@@ -0,0 +1,83 @@
+"""export_model.py: Export a trained model for fast inference, and report the accuracy change.
+
+Dropout is stripped, the graph is frozen and fused, and the model is saved as a SavedModel and a TFLite model.
+With --quantize, an int8 TFLite model is also saved, calibrated on a random sample of the validation set.
+All exported models are compared with the original model on the validation set.
+See export.py for the export directory layout.
+
+Usage: python scripts/export_model.py \
+	-config <path to config .yaml, for the validation set> \
+	-model <path to trained model .h5> \
+	-out_dir <path to export directory> \
+	[--quantize, also save an int8 quantized model] \
+	[-num_calibration <number of validation sequences for quantization calibration>. default 500] \
+	[-csv <path to save the accuracy report as a .csv file>]
+
+To use the exported model:
+	python scripts/get_activations.py -model <out_dir> ...
+"""
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+import os.path
+
+import numpy as np
+import pandas as pd
+import wandb
+
+import dataset
+import export
+import models
+
+
+def export_model(config_path, model_path, out_dir, quantize=False, num_calibration=500, out_csv=None):
+	wandb.init(config=config_path, mode='disabled')
+	config = wandb.config
+	model = models.load_model(model_path)
+
+	val_data = dataset.SequenceTfDataset(
+		config.val_data_paths, config.val_targets,
+		targets_are_classes=config.targets_are_classes, endless=False,
+		reverse_complement=config.use_reverse_complement, encoding=models.get_input_encoding(model))
+	xs, ys = val_data.dataset
+
+	xs_calibration = None
+	if quantize:
+		idxs = np.random.default_rng(dataset.SEED).choice(len(xs), size=min(num_calibration, len(xs)), replace=False)
+		xs_calibration = xs[idxs]
+	metadata = export.export_model(model, out_dir, xs_calibration=xs_calibration, model_path=model_path)
+
+	# Compare exported models with the original
+	candidates = {
+		export.SAVED_MODEL_DIR: export.load_exported_model(os.path.join(out_dir, export.SAVED_MODEL_DIR)),
+		export.TFLITE_FILE: export.load_exported_model(os.path.join(out_dir, export.TFLITE_FILE))}
+	if quantize:
+		candidates[export.TFLITE_INT8_FILE] = export.load_exported_model(os.path.join(out_dir, export.TFLITE_INT8_FILE))
+	pos_label = val_data.class_to_idx_mapping[config.metric_pos_label] if config.targets_are_classes else None
+	report = export.compare_models(model, candidates, xs, ys, val_data.num_classes, pos_label=pos_label,
+		batch_size=config.batch_size)
+
+	metadata['report'] = report
+	export.write_metadata(out_dir, metadata)
+	df = pd.DataFrame(report)
+	print(df.to_string(index=False))
+	if out_csv is not None:
+		df.to_csv(out_csv, index=False)
+	return df
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-config', type=str, required=True, help='Path to config .yaml file')
+	parser.add_argument('-model', type=str, required=True, help='Path to trained model .h5 file')
+	parser.add_argument('-out_dir', type=str, required=True, help='Path to export directory')
+	parser.add_argument('--quantize', action='store_true')
+	parser.add_argument('-num_calibration', type=int, default=500)
+	parser.add_argument('-csv', type=str, help='(Optional) Path to save the accuracy report as a .csv file')
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = get_args()
+	export_model(args.config, args.model, args.out_dir, quantize=args.quantize,
+		num_calibration=args.num_calibration, out_csv=args.csv)
@@ -1,23 +1,34 @@
 """get_activations.py: Get activations from a trained model's intermediate or output layers.
 
 Usage: python scripts/get_activations.py \
-	-model <path to model .h5>
+	-model <path to model .h5, or exported model from export_model.py> \
 	-in_file <path to input .fa, .bed, or .narrowPeak file> \
 	[-in_genome <path to genome .fa file, if in_file is .bed or .narrowPeak>] \
-	-out_file <path to output file, .npy or .csv> \
-	[-layer_name <layer name to get activations from, e.g. 'flatten'>. default is output layer] \
+	-out_file <path to output file, .npy or .csv, or one path per layer if several layers are given> \
+	[-layer_name <layer name(s) to get activations from, e.g. 'flatten'>. default is output layer] \
 	[--no_reverse_complement, don't evaluate on reverse complement sequences] \
 	[--write_csv, write activations as .csv file instead of .npy] \
-	[-score_column <output unit to extract score in the csv, e.g. 1>. default writes whole activation as a row]
+	[-score_column <output unit to extract score in the csv, e.g. 1>. default writes whole activation as a row] \
+	[-batch_size <prediction batch size>. default 512] \
+	[-chunk_size <stream activations to out_file in chunks of this many sequences, resuming if interrupted>] \
+	[-config <config .yaml with predict_batch_size, predict_intra_op_threads, predict_inter_op_threads, e.g. from autotune.py>]
 
 To get a numpy array of activations from an intermediate layer:
 	-layer_name <layer_name>
 	[don't pass --write_csv]
 
+To get the activations of several layers in one pass over the sequences, saving each layer to its own file:
+	-layer_name conv1d flatten dense_1
+	-out_file conv1d.npy flatten.npy dense_1.npy
+
 To get a csv of probabilities for the positive class from a binary classifier:
 	[don't pass -layer_name]
 	--write_csv
 	-score_column 1
+
+For genome-scale inputs that don't fit in memory, pass e.g. -chunk_size 100000. Peak memory then depends on
+the chunk size rather than the number of sequences. If the run is interrupted, rerun the same command to resume
+after the last finished chunk.
 """
 # allow importing from one directory up
 import sys
@@ -26,7 +37,9 @@ import os.path
 
 import argparse
 
+import constants
 from models import get_activations
+import utils
 
 def get_args():
 	import argparse
@@ -34,20 +47,33 @@ def get_args():
 	parser.add_argument('-model', type=str, required=True)
 	parser.add_argument('-in_file', type=str, required=True)
 	parser.add_argument('-in_genome', type=str, required=False)
-	parser.add_argument('-out_file', type=str, required=True)
-	parser.add_argument('-layer_name', type=str, required=False)
+	parser.add_argument('-out_file', type=str, nargs='+', required=True)
+	parser.add_argument('-layer_name', type=str, nargs='+', required=False)
 	parser.add_argument('--no_reverse_complement', action='store_true')
 	parser.add_argument('--write_csv', action='store_true')
 	parser.add_argument('-score_column', type=int, required=False)
+	parser.add_argument('--xla', action='store_true')
+	parser.add_argument('-batch_size', type=int, help='Default is predict_batch_size in -config, or 512')
+	parser.add_argument('-chunk_size', type=int, help='(Optional) Stream activations to out_file in chunks of this many sequences')
+	parser.add_argument('-config', type=str, help='(Optional) Config with prediction settings, see scripts/autotune.py')
 	return parser.parse_args()
 
 
 if __name__ == '__main__':
 	args = get_args()
+	config = utils.get_config(args.config)[0] if args.config is not None else {}
+	utils.set_threads(config.get('predict_intra_op_threads'), config.get('predict_inter_op_threads'))
+	batch_size = args.batch_size or config.get('predict_batch_size') or constants.DEFAULT_BATCH_SIZE
+	# A single layer is passed as a str, and several layers as a list
+	layer_name = args.layer_name[0] if args.layer_name is not None and len(args.layer_name) == 1 else args.layer_name
+	out_file = args.out_file if isinstance(layer_name, list) or len(args.out_file) > 1 else args.out_file[0]
 	get_activations(args.model, args.in_file,
 		in_genome=args.in_genome,
-		out_file=args.out_file,
-		layer_name=args.layer_name,
+		out_file=out_file,
+		layer_name=layer_name,
 		use_reverse_complement=not args.no_reverse_complement,
 		write_csv=args.write_csv,
-		score_column=args.score_column)
\ No newline at end of file
+		score_column=args.score_column,
+		batch_size=batch_size,
+		jit_compile=args.xla,
+		chunk_size=args.chunk_size)
\ No newline at end of file
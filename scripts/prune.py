@@ -0,0 +1,96 @@
+"""prune.py: Remove the least active convolutional filters from a trained model.
+
+Filters are scored by mean activation on a random sample of the validation set. The lowest scoring
+filters in each convolutional layer are removed, and the pruned model is optionally fine-tuned
+on the training set. The report compares FLOPs, parameter count, prediction throughput, and
+accuracy on the validation set before and after pruning.
+
+Usage: python scripts/prune.py \
+	-config <path to config .yaml, for the training and validation sets> \
+	-model <path to trained model .h5> \
+	-out_model <path to save pruned model .h5> \
+	[-prune_fraction <fraction of filters to remove, either one value or one per conv layer>. default 0.5] \
+	[-num_score_examples <number of validation sequences to score filters on>. default 2000] \
+	[-finetune_epochs <number of epochs to fine-tune the pruned model>. default 0] \
+	[-csv <path to save the report as a .csv file>]
+"""
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+
+import numpy as np
+import pandas as pd
+import wandb
+
+import dataset
+import models
+import pruning
+import utils
+
+
+def prune(config_path, model_path, out_model, prune_fraction=0.5, num_score_examples=2000, finetune_epochs=0,
+	out_csv=None):
+	wandb.init(config=config_path, mode='disabled')
+	config = wandb.config
+	model = models.load_model(model_path)
+	encoding = models.get_input_encoding(model)
+
+	val_data = dataset.SequenceTfDataset(
+		config.val_data_paths, config.val_targets,
+		targets_are_classes=config.targets_are_classes, endless=False,
+		reverse_complement=config.use_reverse_complement, encoding=encoding)
+	xs, ys = val_data.dataset
+	pos_label = val_data.class_to_idx_mapping[config.metric_pos_label] if config.targets_are_classes else None
+	def report_row(name, m):
+		return pruning.get_report_row(name, m, xs, ys, val_data.num_classes, pos_label=pos_label,
+			batch_size=config.batch_size)
+	report = [report_row('original', model)]
+
+	# Prune
+	idxs = np.random.default_rng(dataset.SEED).choice(len(xs), size=min(num_score_examples, len(xs)), replace=False)
+	scores = pruning.get_filter_scores(model, xs[idxs], batch_size=config.batch_size)
+	keep = pruning.get_filters_to_keep(scores, prune_fraction)
+	pruned = pruning.prune_model(model, keep)
+	report.append(report_row('pruned', pruned))
+
+	if finetune_epochs > 0:
+		train_data = dataset.SequenceTfDataset(
+			config.train_data_paths, config.train_targets,
+			targets_are_classes=config.targets_are_classes, endless=True,
+			batch_size=config.batch_size, reverse_complement=config.use_reverse_complement, encoding=encoding)
+		# Fine-tuning uses full batches, without gradient accumulation
+		steps_per_epoch_train = len(train_data) // config.batch_size
+		# Constant learning rate, at the low end of the training schedule
+		optimizer = models.get_optimizer(config.lr_init, config)
+		models.compile_model(pruned, val_data.num_classes, val_data.class_to_idx_mapping, config, optimizer=optimizer)
+		pruned.fit(train_data.dataset, epochs=finetune_epochs, steps_per_epoch=steps_per_epoch_train,
+			class_weight=utils.get_class_weight(config, train_data))
+		report.append(report_row('pruned+finetuned', pruned))
+	else:
+		models.compile_model(pruned, val_data.num_classes, val_data.class_to_idx_mapping, config)
+
+	pruned.save(out_model)
+	df = pd.DataFrame(report)
+	print(df.to_string(index=False))
+	if out_csv is not None:
+		df.to_csv(out_csv, index=False)
+	return df
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-config', type=str, required=True, help='Path to config .yaml file')
+	parser.add_argument('-model', type=str, required=True, help='Path to trained model .h5 file')
+	parser.add_argument('-out_model', type=str, required=True, help='Path to save pruned model .h5 file')
+	parser.add_argument('-prune_fraction', type=float, nargs='+', default=[0.5])
+	parser.add_argument('-num_score_examples', type=int, default=2000)
+	parser.add_argument('-finetune_epochs', type=int, default=0)
+	parser.add_argument('-csv', type=str, help='(Optional) Path to save the report as a .csv file')
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = get_args()
+	prune_fraction = args.prune_fraction[0] if len(args.prune_fraction) == 1 else args.prune_fraction
+	prune(args.config, args.model, args.out_model, prune_fraction=prune_fraction,
+		num_score_examples=args.num_score_examples, finetune_epochs=args.finetune_epochs, out_csv=args.csv)
@@ -0,0 +1,235 @@
+"""scan.py: Scan a genome with a trained model, and write the score of one output unit along the genome as a bedGraph or bigWig track.
+
+Windows of the model's input length are tiled along each chromosome, or each region in -regions, starting every
+-stride bases. Each window's score is written for the -stride bases at the center of the window, or the whole window
+if -stride is at least the window length, so that the track has no overlapping intervals. Windows that are all N,
+e.g. assembly gaps, are skipped, as are the last bases of a region that don't fill a window.
+
+The genome is encoded as base tokens once, and memory mapped, see dataset.get_genome_tokens(), so windows are
+strided views of the genome, and are not parsed from text.
+
+For .h5 models, the leading convolutional layers are run once over each segment of consecutive windows, and the
+rest of the model on each window's slice of their output. So bases shared by overlapping windows are only
+convolved once. This needs -stride to be a multiple of the total stride of those layers. Otherwise, and for
+exported models, each window is predicted separately.
+
+Usage: python scripts/scan.py \
+	-model <path to model .h5, or exported model from export_model.py> \
+	-genome <path to genome .fa file> \
+	-out_file <path to output .bedGraph, or .bw / .bigWig, which needs pyBigWig> \
+	[-regions <path to .bed file of regions to scan>. default scans whole chromosomes] \
+	[-chroms <chromosomes to scan, e.g. chr1 chr2>. default all] \
+	[-stride <bases between the starts of consecutive windows>. default is the window length] \
+	[-score_column <output unit to write, e.g. 1>. default 1, or 0 for regression models] \
+	[--rc_average, average each window's score with the score of its reverse complement] \
+	[-batch_size <prediction batch size>. default 512] \
+	[-cache_dir <directory for the encoded genome>. default dataset_cache] \
+	[-config <config .yaml with predict_batch_size, predict_intra_op_threads, predict_inter_op_threads, e.g. from autotune.py>]
+"""
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+from tqdm import tqdm
+
+import constants
+import dataset
+import export
+import models
+import utils
+
+# Number of batches of windows read from the genome at a time
+CHUNK_BATCHES = 16
+
+
+def scan(model, genome_file, out_file, regions_file=None, chroms=None, stride=None, score_column=None,
+	rc_average=False, batch_size=constants.DEFAULT_BATCH_SIZE, cache_dir='dataset_cache'):
+	# Load model from path, if necessary
+	if isinstance(model, str):
+		model = export.load_exported_model(model) if export.is_exported_model(model) else models.load_model(model)
+	window_len = model.input_shape[1]
+	stride = stride or window_len
+	num_units = model.output_shape[-1]
+	if score_column is None:
+		score_column = 1 if num_units > 1 else 0
+	if score_column >= num_units:
+		raise ValueError(f"Invalid score_column, got {score_column} but the model has {num_units} output units")
+	if rc_average:
+		rc_invariant = model.rc_invariant if isinstance(model, export.ExportedModel) else export.is_rc_invariant(model)
+		if rc_invariant:
+			print("Model is invariant to reverse complement, predicting forward strand only.")
+			rc_average = False
+
+	genome = dataset.get_genome_tokens(genome_file, cache_dir)
+	regions = get_regions(genome, regions_file, chroms)
+	predict = get_predict_fn(model, window_len, stride, batch_size)
+
+	# Bases that each window's score is written for, relative to the window start
+	bin_len = min(stride, window_len)
+	bin_offset = (window_len - bin_len) // 2
+	chunk_windows = batch_size * CHUNK_BATCHES
+	writer = TrackWriter(out_file, genome)
+	for chrom, start, end in tqdm(regions, desc="Scanning regions"):
+		tokens = genome[chrom][start:end]
+		num_windows = (len(tokens) - window_len) // stride + 1 if len(tokens) >= window_len else 0
+		for chunk_start in range(0, num_windows, chunk_windows):
+			chunk_end = min(chunk_start + chunk_windows, num_windows)
+			segment = np.asarray(tokens[chunk_start * stride:(chunk_end - 1) * stride + window_len])
+			# Skip windows that are all N
+			num_bases = np.concatenate([[0], np.cumsum(segment != dataset.TOKEN_N)])
+			window_starts = np.arange(chunk_end - chunk_start) * stride
+			keep = num_bases[window_starts + window_len] > num_bases[window_starts]
+			if not keep.any():
+				continue
+
+			scores = predict(segment)[:, score_column]
+			if rc_average:
+				# The windows of the reverse complement segment are the reverse complements of the windows, in reverse order
+				scores = (scores + predict(dataset.reverse_complement_tokens(segment))[::-1, score_column]) / 2
+			bin_starts = start + chunk_start * stride + window_starts[keep] + bin_offset
+			writer.write(chrom, bin_starts, bin_starts + bin_len, scores[keep])
+	writer.close()
+	print(f"Saved scores to {out_file}")
+
+def get_regions(genome, regions_file=None, chroms=None):
+	"""Get a list of (chrom, start, end) to scan, in genome order."""
+	if regions_file is None:
+		regions = [(chrom, 0, len(tokens)) for chrom, tokens in genome.items()]
+	else:
+		regions = []
+		for interval in dataset.BedSource.get_intervals(regions_file):
+			if interval.chrom not in genome:
+				raise ValueError(f"Region {interval.chrom}:{interval.start}-{interval.end} is not on a chromosome of the genome")
+			regions.append((interval.chrom, interval.start, min(interval.end, len(genome[interval.chrom]))))
+	if chroms is not None:
+		regions = [region for region in regions if region[0] in chroms]
+	chrom_order = {chrom: idx for idx, chrom in enumerate(genome)}
+	return sorted(regions, key=lambda region: (chrom_order[region[0]], region[1]))
+
+def get_predict_fn(model, window_len, stride, batch_size):
+	"""Get a function that takes a segment of base tokens, and returns predictions of the windows starting every stride bases."""
+	use_tokens = models.get_input_encoding(model) == 'tokens'
+
+	def encode(tokens):
+		return tokens if use_tokens else dataset.TOKEN_ONEHOT[tokens]
+
+	split = None if isinstance(model, export.ExportedModel) else split_conv_trunk(model)
+	if split is None or stride % split[2] != 0:
+		def predict(tokens):
+			windows = np.lib.stride_tricks.sliding_window_view(tokens, window_len)[::stride]
+			return model.predict(encode(windows), batch_size=batch_size, verbose=0)
+		return predict
+
+	print("Sharing convolutions between overlapping windows")
+	trunk, head, trunk_stride = split
+	step = stride // trunk_stride
+	out_len = head.input_shape[1]
+
+	@tf.function(input_signature=[tf.TensorSpec((None,) + model.input_shape[2:], 'uint8' if use_tokens else 'int8')])
+	def predict_segment(segment):
+		features = trunk(tf.cast(segment, trunk.inputs[0].dtype)[tf.newaxis], training=False)[0]
+		num_windows = (tf.shape(features)[0] - out_len) // step + 1
+		idxs = tf.range(num_windows)[:, tf.newaxis] * step + tf.range(out_len)[tf.newaxis]
+		return head(tf.gather(features, idxs), training=False)
+
+	def predict(tokens):
+		num_windows = (len(tokens) - window_len) // stride + 1
+		predictions = []
+		for start in range(0, num_windows, batch_size):
+			end = min(start + batch_size, num_windows)
+			predictions.append(predict_segment(encode(tokens[start * stride:(end - 1) * stride + window_len])).numpy())
+		return np.concatenate(predictions)
+	return predict
+
+def split_conv_trunk(model):
+	"""Split a model built by models.get_model_architecture() after its leading convolutional layers.
+
+	Returns:
+		(trunk, head, trunk_stride), or None if the model doesn't start with 'valid' convolutions
+		trunk (keras model): the leading convolutional layers, taking inputs of any length
+		head (keras model): the rest of the model, taking the trunk output for one window
+		trunk_stride (int): number of input bases per trunk output position
+	"""
+	chain = model.layers[1:]
+	num_trunk = 0
+	trunk_stride = 1
+	for layer in chain:
+		if isinstance(layer, layers.Conv1D) and layer.padding == 'valid' and layer.dilation_rate == (1,):
+			trunk_stride *= layer.strides[0]
+		elif not isinstance(layer, layers.Dropout):
+			break
+		num_trunk += 1
+	if not any(isinstance(layer, layers.Conv1D) for layer in chain[:num_trunk]):
+		return None
+
+	inputs = keras.Input(shape=(None,) + model.input_shape[2:], dtype=model.inputs[0].dtype)
+	x = inputs
+	for layer in chain[:num_trunk]:
+		x = layer(x)
+	trunk = keras.Model(inputs=inputs, outputs=x)
+
+	# Output shape in the original model, i.e. for one window
+	head_inputs = keras.Input(shape=chain[num_trunk - 1].get_output_shape_at(0)[1:])
+	x = head_inputs
+	for layer in chain[num_trunk:]:
+		x = layer(x)
+	head = keras.Model(inputs=head_inputs, outputs=x)
+	return trunk, head, trunk_stride
+
+class TrackWriter:
+	"""Write scores of genome intervals, in genome order, as a bedGraph, or as a bigWig if out_file ends with .bw or .bigWig."""
+	def __init__(self, out_file, genome):
+		self.is_bigwig = out_file.lower().endswith(('.bw', '.bigwig'))
+		if self.is_bigwig:
+			try:
+				import pyBigWig
+			except ImportError:
+				raise ImportError("pyBigWig is required for bigWig output, e.g. conda install -c bioconda pybigwig")
+			self.out = pyBigWig.open(out_file, 'w')
+			self.out.addHeader([(chrom, len(tokens)) for chrom, tokens in genome.items()])
+		else:
+			self.out = open(out_file, 'w')
+
+	def write(self, chrom, starts, ends, values):
+		if self.is_bigwig:
+			self.out.addEntries([chrom] * len(starts), starts.tolist(), ends=ends.tolist(), values=values.astype(float).tolist())
+		else:
+			self.out.writelines(f"{chrom}\t{start}\t{end}\t{value:.6g}\n" for start, end, value in zip(starts, ends, values))
+
+	def close(self):
+		self.out.close()
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-model', type=str, required=True)
+	parser.add_argument('-genome', type=str, required=True)
+	parser.add_argument('-out_file', type=str, required=True)
+	parser.add_argument('-regions', type=str, help='(Optional) .bed file of regions to scan')
+	parser.add_argument('-chroms', type=str, nargs='+', help='(Optional) Chromosomes to scan')
+	parser.add_argument('-stride', type=int, help='Default is the window length')
+	parser.add_argument('-score_column', type=int, help='Default is 1, or 0 for regression models')
+	parser.add_argument('--rc_average', action='store_true')
+	parser.add_argument('-batch_size', type=int, help='Default is predict_batch_size in -config, or 512')
+	parser.add_argument('-cache_dir', type=str, default='dataset_cache')
+	parser.add_argument('-config', type=str, help='(Optional) Config with prediction settings, see scripts/autotune.py')
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = get_args()
+	config = utils.get_config(args.config)[0] if args.config is not None else {}
+	utils.set_threads(config.get('predict_intra_op_threads'), config.get('predict_inter_op_threads'))
+	batch_size = args.batch_size or config.get('predict_batch_size') or constants.DEFAULT_BATCH_SIZE
+	scan(args.model, args.genome, args.out_file,
+		regions_file=args.regions,
+		chroms=args.chroms,
+		stride=args.stride,
+		score_column=args.score_column,
+		rc_average=args.rc_average,
+		batch_size=batch_size,
+		cache_dir=args.cache_dir)
@@ -1,23 +1,47 @@
 """validate.py: Evaluate a trained model on a collection of validation sets.
 
-Usage: python scripts/validate.py -config <path to config .yaml> -model <path to model .h5>
+Predictions on each validation set are cached in -cache_dir, so running again, e.g. after adding a metric
+to scoring.get_metrics(), only computes the metrics.
+
+Usage: python scripts/validate.py -config <path to config .yaml> -model <path to model .h5> \
+	[-csv <path to save results as a .csv file>] \
+	[-cache_dir <directory to cache predictions>. default validate_cache] \
+	[-per_source <if set, also report metrics on each source file of each set>] \
+	[-bootstrap <number of bootstrap replicates of each set, for confidence intervals of acc, auroc, auprc, npvsc,
+		and their geometric means>] \
+	[-ci <confidence level of the intervals>. default 0.95]
 """
 import pprint
 
+import numpy as np
 import wandb
 import pandas as pd
 
 import models
 
-def validate(config_path, model_path, out_csv):
+DEFAULT_CACHE_DIR = 'validate_cache'
+
+def validate(config_path, model_path, out_csv, cache_dir=DEFAULT_CACHE_DIR, per_source=False, num_bootstrap=None,
+	ci=0.95):
 	wandb.init(config=config_path, mode='disabled')
-	res = models.validate(wandb.config, model_path)
+	if num_bootstrap:
+		res, bootstrap = models.validate(wandb.config, model_path, cache_dir=cache_dir, per_source=per_source,
+			num_bootstrap=num_bootstrap)
+		# Percentile intervals of the replicates
+		intervals = {k: (np.mean(v), *np.quantile(v, [(1 - ci) / 2, (1 + ci) / 2])) for k, v in bootstrap.items()}
+	else:
+		res = models.validate(wandb.config, model_path, cache_dir=cache_dir, per_source=per_source)
+		intervals = {}
 	if out_csv is not None:
 		# 2 columns: metric_name, metric_value
-		df = pd.DataFrame({k: [v] for k, v in res.items()}).transpose()
+		# With -bootstrap, 3 more columns: bootstrap_mean, ci_low, ci_high, which are empty for metrics without replicates
+		num_interval_columns = 3 if num_bootstrap else 0
+		rows = {k: [v, *intervals.get(k, [None] * num_interval_columns)] for k, v in res.items()}
+		df = pd.DataFrame(rows).transpose()
 		df.to_csv(out_csv, header=False)
 	pp = pprint.PrettyPrinter(indent=4)
-	pp.pprint({k: f"{v:0.4}" for k, v in res.items()})
+	pp.pprint({k: f"{v:0.4}" + (f" [{intervals[k][1]:0.4}, {intervals[k][2]:0.4}]" if k in intervals else "")
+		for k, v in res.items()})
 	return res
 
 def get_args():
@@ -26,9 +50,14 @@ def get_args():
 	parser.add_argument('-config', type=str, required=True, help='Path to config .yaml file')
 	parser.add_argument('-model', type=str, required=True, help='Path to trained model .h5 file')
 	parser.add_argument('-csv', type=str, help='(Optional) Path to save results as a .csv file')
+	parser.add_argument('-cache_dir', type=str, default=DEFAULT_CACHE_DIR, help='Directory to cache predictions')
+	parser.add_argument('-per_source', action='store_true', help='Also report metrics on each source file of each set')
+	parser.add_argument('-bootstrap', type=int, help='(Optional) Number of bootstrap replicates, for confidence intervals')
+	parser.add_argument('-ci', type=float, default=0.95, help='Confidence level of the intervals')
 	return parser.parse_args()
 
 
 if __name__ == '__main__':
 	args = get_args()
-	validate(args.config, args.model, args.csv)
\ No newline at end of file
+	validate(args.config, args.model, args.csv, cache_dir=args.cache_dir, per_source=args.per_source,
+		num_bootstrap=args.bootstrap, ci=args.ci)
\ No newline at end of file
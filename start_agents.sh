@@ -1,6 +1,9 @@
 #!/bin/bash
 #
-# Usage: bash start_agents.sh <num_agents> <throttle> <sweep_id>
+# Usage: bash start_agents.sh <num_agents> <throttle> <sweep_id> [<trials_per_agent>]
+#
+# If trials_per_agent is given, each agent runs that many trials in one process, reusing datasets (see sweep_agent.py).
+# Otherwise, each agent runs 1 trial.
 
 # Activate environment
 source activate /ocean/projects/bio200034p/csestili/02319-hw-cnn/env/keras2-tf27
@@ -16,13 +19,14 @@ fi
 num_agents=$1
 throttle=$2
 sweep_id=$3
+trials_per_agent=$4
 
 if [ -z $num_agents ] || [ -z $throttle ] || [ -z $sweep_id ];
 then
     echo "Error: Missing arguments"
-    echo "Usage: bash start_agents.sh <num_agents> <throttle> <sweep_id>"
+    echo "Usage: bash start_agents.sh <num_agents> <throttle> <sweep_id> [<trials_per_agent>]"
     exit 1
 fi
 
 # Launch sweep
-sbatch -p $PARTITION_GPU -t 08:00:00 --array=1-${num_agents}%${throttle} scripts/start_agent_main.sb ${sweep_id}
+sbatch -p $PARTITION_GPU -t 08:00:00 --array=1-${num_agents}%${throttle} scripts/start_agent_main.sb ${sweep_id} ${trials_per_agent}
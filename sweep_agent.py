@@ -0,0 +1,80 @@
+"""sweep_agent.py: Run many trials of a wandb sweep in one process, reusing datasets between trials.
+
+`wandb agent` (see start_agents.sh) starts a new process for each trial, which builds all datasets from scratch.
+This agent builds the datasets once, and only rebuilds the model, optimizer, and callbacks for each trial.
+Datasets are rebuilt only if a trial changes a data-related config value, see DATA_CONFIG_KEYS.
+
+The sweep's `command` is not used, so the base config is passed here instead.
+
+Usage:
+- From interactive session: python sweep_agent.py -sweep_id <sweep id> [-config config-base.yaml] [-count <number of trials>]
+- On slurm: bash start_agents.sh <num_agents> <throttle> <sweep_id> <trials per agent>
+"""
+
+import gc
+import json
+
+import tensorflow as tf
+import wandb
+
+import models
+import train
+import utils
+
+
+# Config values that the datasets depend on. Add any new config value that changes how datasets are built.
+DATA_CONFIG_KEYS = [
+	'train_data_paths', 'train_targets', 'val_data_paths', 'val_targets',
+	'additional_val_data_paths', 'additional_val_targets', 'additional_val_cache_dir',
+	'targets_are_classes', 'use_exact_val_metrics', 'use_reverse_complement', 'input_encoding',
+	'batch_size', 'grad_accum_steps', 'use_dataset_server']
+
+
+class DatasetCache:
+	"""Datasets for the most recent data config. Only one set of datasets is kept in memory."""
+	def __init__(self):
+		self.key = None
+		self.datasets = None
+
+	def get(self, config):
+		"""Get (train_data, val_data, additional_val_datasets) for this config."""
+		key = json.dumps({k: config.get(k) for k in DATA_CONFIG_KEYS}, sort_keys=True, default=str)
+		if key != self.key:
+			# Free the previous datasets before building new ones
+			self.key, self.datasets = None, None
+			gc.collect()
+			train_data, val_data = train.get_datasets(config)
+			additional_val_datasets = models.get_additional_val_datasets(config, encoding=train_data.encoding)
+			self.key, self.datasets = key, (train_data, val_data, additional_val_datasets)
+		else:
+			print("Reusing datasets from previous trial")
+		return self.datasets
+
+def run_trial(config_path, cache):
+	config, project = utils.get_config(config_path)
+	# Sweep parameters override the base config
+	wandb.init(config=config, project=project)
+	try:
+		utils.validate_config(wandb.config)
+		utils.set_threads(wandb.config.get('intra_op_threads'), wandb.config.get('inter_op_threads'))
+		train_data, val_data, additional_val_datasets = cache.get(wandb.config)
+		train.train_model(wandb.config, train_data, val_data, additional_val_datasets=additional_val_datasets)
+	finally:
+		wandb.finish()
+		# Free this trial's model and optimizer
+		tf.keras.backend.clear_session()
+		gc.collect()
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-sweep_id', type=str, required=True)
+	parser.add_argument('-config', type=str, default='config-base.yaml', help='Base config for the sweep')
+	parser.add_argument('-count', type=int, help='Number of trials to run. Default is to run until the sweep ends.')
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = get_args()
+	cache = DatasetCache()
+	wandb.agent(args.sweep_id, function=lambda: run_trial(args.config, cache), count=args.count)
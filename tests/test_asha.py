@@ -0,0 +1,38 @@
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+
+import tempfile
+
+from asha import AshaCoordinator
+
+
+def test_get_rung():
+    coordinator = AshaCoordinator(tempfile.mkdtemp(), min_epochs=2, reduction_factor=3)
+    rungs = {epochs: coordinator.get_rung(epochs) for epochs in range(1, 20)}
+    assert {epochs: rung for epochs, rung in rungs.items() if rung is not None} == {2: 0, 6: 1, 18: 2}
+
+
+def test_report():
+    coordinator = AshaCoordinator(tempfile.mkdtemp(), min_epochs=1, reduction_factor=3)
+    # Not a rung
+    assert coordinator.report('a', 2, 0.)
+    # First trial at a rung is the best so far
+    assert coordinator.report('a', 1, 0.6)
+    assert not coordinator.report('b', 1, 0.5)
+    assert coordinator.report('c', 1, 0.7)
+    # With 6 trials at the rung, the top 2 continue
+    assert not coordinator.report('d', 1, 0.55)
+    assert not coordinator.report('e', 1, 0.65)
+    assert coordinator.report('f', 1, 0.8)
+    assert not coordinator.report('g', 1, float('nan'))
+
+    coordinator = AshaCoordinator(tempfile.mkdtemp(), mode='min')
+    assert coordinator.report('a', 1, 0.6)
+    assert coordinator.report('b', 1, 0.5)
+    assert not coordinator.report('c', 1, 0.7)
+
+
+if __name__ == '__main__':
+    test_get_rung()
+    test_report()
@@ -0,0 +1,54 @@
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+
+import numpy as np
+from tensorflow import keras
+
+from custom_layers import TokenConv1D, RevCompConv1D, TokenRevCompConv1D, RevCompMax
+from dataset import TOKEN_ONEHOT
+
+
+def test_token_conv1d():
+    rng = np.random.default_rng(0)
+    tokens = rng.integers(5, size=(3, 40)).astype('uint8')
+    onehot = TOKEN_ONEHOT[tokens].astype('float32')
+
+    for stride in [1, 3]:
+        conv = keras.layers.Conv1D(6, 7, strides=stride, activation='relu')
+        expected = conv(onehot).numpy()
+        token_conv = TokenConv1D(6, 7, strides=stride, activation='relu')
+        token_conv.build((None, 40))
+        token_conv.set_weights(conv.get_weights())
+        assert np.allclose(token_conv(tokens).numpy(), expected, atol=1e-5)
+
+def test_rc_invariance():
+    rng = np.random.default_rng(0)
+    tokens = rng.integers(5, size=(3, 40)).astype('uint8')
+    # Reverse complement of tokens: A <-> T, C <-> G, N stays N
+    revcomp_tokens = np.where(tokens == 4, 4, 3 - tokens)[:, ::-1]
+    onehot = TOKEN_ONEHOT[tokens].astype('float32')
+    revcomp_onehot = TOKEN_ONEHOT[revcomp_tokens].astype('float32')
+    # One-hot reverse complement is reversal along both axes
+    assert np.all(revcomp_onehot == onehot[:, ::-1, ::-1])
+
+    for inputs, revcomp_inputs, first_layer in [
+        (onehot, revcomp_onehot, RevCompConv1D),
+        (tokens, revcomp_tokens, TokenRevCompConv1D)]:
+        model = keras.Sequential([
+            first_layer(5, 7, activation='relu', bias_initializer='random_normal'),
+            RevCompConv1D(4, 5, activation='relu', bias_initializer='random_normal')])
+        outputs = model(inputs).numpy()
+        revcomp_outputs = model(revcomp_inputs).numpy()
+        assert outputs.shape == (3, 30, 8)
+        # Equivariance
+        assert np.allclose(revcomp_outputs, outputs[:, ::-1, ::-1], atol=1e-5)
+        # Invariance after merging strands
+        merge = RevCompMax()
+        assert merge(outputs).shape == (3, 30, 4)
+        assert np.allclose(merge(outputs).numpy(), merge(revcomp_outputs).numpy(), atol=1e-5)
+
+
+if __name__ == '__main__':
+    test_token_conv1d()
+    test_rc_invariance()
@@ -6,7 +6,7 @@ from itertools import islice
 
 import numpy as np
 
-from dataset import FastaSource, BedSource, SequenceCollection
+from dataset import FastaSource, BedSource, SequenceCollection, encode, reverse_complement_tokens, TOKEN_N, TOKEN_ONEHOT
 
 def test_bedsource():
     # No bed columns
@@ -266,6 +266,44 @@ def test_sequence_collection():
     assert np.all(seqs_b[0] == _revcomp_onehot(seqs_b[1]))
     assert np.all(seqs_b[2] == _revcomp_onehot(seqs_b[3]))
 
+def test_encode():
+    seq = "ACGTNacgtn"
+    tokens = encode(seq, 'tokens')
+    assert tokens.dtype == np.uint8
+    assert np.all(tokens == [0, 1, 2, 3, TOKEN_N, 0, 1, 2, 3, TOKEN_N])
+
+    onehot = encode(seq, 'onehot')
+    assert onehot.dtype == np.int8
+    assert onehot.shape == (10, 4)
+    expected = np.zeros((10, 4), dtype='int8')
+    for idx, base in enumerate(seq):
+        if base.upper() in 'ACGT':
+            expected[idx, 'ACGT'.index(base.upper())] = 1
+    assert np.all(onehot == expected)
+
+def test_reverse_complement_tokens():
+    tokens = encode("AACGTNg", 'tokens')
+    assert np.all(reverse_complement_tokens(tokens) == encode("cNACGTT", 'tokens'))
+    # Same as reverse complementing the one-hot encoding
+    onehot = encode("AACGTNg", 'onehot')
+    assert np.all(TOKEN_ONEHOT[reverse_complement_tokens(tokens)] == _revcomp_onehot(onehot))
+
+def test_sequence_collection_state():
+    fa_path_pos = "/projects/pfenninggroup/mouseCxStr/NeuronSubtypeATAC/Zoonomia_CNN/mouse_SST/FinalModelData/mouse_SST_pos_VAL.fa"
+    fa_path_neg = "/projects/pfenninggroup/mouseCxStr/NeuronSubtypeATAC/Zoonomia_CNN/mouse_SST/FinalModelData/mouse_SST_neg_VAL.fa"
+    sc = SequenceCollection([fa_path_pos, fa_path_neg], [1, 0], targets_are_classes=True, endless=True)
+    it = iter(sc)
+    list(islice(it, 100))
+    state = sc.get_state()
+    expected = list(islice(it, 100))
+
+    # Resuming in a new collection yields the same examples
+    sc_resumed = SequenceCollection([fa_path_pos, fa_path_neg], [1, 0], targets_are_classes=True, endless=True)
+    sc_resumed.set_state(state)
+    for (seq_a, target_a), (seq_b, target_b) in zip(expected, islice(iter(sc_resumed), 100)):
+        assert np.all(seq_a == seq_b)
+        assert target_a == target_b
+
 def _revcomp_onehot(seq_onehot):
     # ::-1 means "reverse"
     # ::-1 in the first coordinate reverses the base order
@@ -275,4 +313,7 @@ def _revcomp_onehot(seq_onehot):
 if __name__ == '__main__':
     test_bedsource()
     test_sequence_collection()
+    test_encode()
+    test_reverse_complement_tokens()
+    test_sequence_collection_state()
     
\ No newline at end of file
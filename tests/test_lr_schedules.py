@@ -0,0 +1,27 @@
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+
+import numpy as np
+
+from lr_schedules import CyclicMomentumSchedule
+
+
+def test_cyclic_momentum_schedule():
+    step_size, base_m, max_m = 7.5, 0.85, 0.95
+    schedule = CyclicMomentumSchedule(step_size, base_m, max_m)
+
+    def expected(iterations):
+        # Momentum set by the former CyclicMomentum callback after `iterations` batches
+        cycle = np.floor(1 + iterations / (2 * step_size))
+        if cycle == 2:
+            return max_m
+        x = np.abs(iterations / step_size - 2 * cycle + 1)
+        return max_m - (max_m - base_m) * np.maximum(0, (1 - x))
+
+    for step in range(60):
+        assert np.isclose(float(schedule(step)), expected(step + 1))
+
+
+if __name__ == '__main__':
+    test_cyclic_momentum_schedule()
@@ -0,0 +1,70 @@
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+
+import numpy as np
+import tensorflow as tf
+
+from metrics import ConfusionHistogram, ExactAUC
+from scoring import auroc
+
+
+def test_confusion_histogram():
+    rng = np.random.default_rng(0)
+    outputs = [
+        ('acc', 'acc', None), ('auroc', 'auroc', 1), ('auprc', 'auprc', 1), ('precision', 'precision', 1),
+        ('sensitivity', 'recall', 1), ('npv', 'precision', 0), ('specificity', 'recall', 0), ('npvsc', 'auprc', 0)]
+    metric = ConfusionHistogram(2, outputs)
+    expected = {
+        'acc': tf.keras.metrics.SparseCategoricalAccuracy(),
+        'auroc': tf.keras.metrics.AUC(curve='ROC'), 'auprc': tf.keras.metrics.AUC(curve='PR'),
+        'precision': tf.keras.metrics.Precision(), 'sensitivity': tf.keras.metrics.Recall(),
+        'npv': tf.keras.metrics.Precision(), 'specificity': tf.keras.metrics.Recall(),
+        'npvsc': tf.keras.metrics.AUC(curve='PR')}
+    labels = {name: label for name, _, label in outputs}
+
+    for _ in range(5):
+        y_true = rng.integers(2, size=64).astype('int8')
+        y_pred = tf.nn.softmax(rng.normal(size=(64, 2)) + np.eye(2)[y_true]).numpy().astype('float32')
+        sample_weight = rng.random(64).astype('float32')
+        metric.update_state(y_true, y_pred, sample_weight=sample_weight)
+        for name, expected_metric in expected.items():
+            if name == 'acc':
+                expected_metric.update_state(y_true, y_pred, sample_weight=sample_weight)
+            else:
+                label = labels[name]
+                expected_metric.update_state(y_true == label, y_pred[:, label], sample_weight=sample_weight)
+
+    results = metric.result()
+    for name, expected_metric in expected.items():
+        assert np.isclose(float(results[name]), float(expected_metric.result()), atol=1e-5), name
+
+
+def test_exact_auc():
+    rng = np.random.default_rng(0)
+    metric = ExactAUC(1, curve='ROC')
+    y_true, y_pred = [], []
+    for _ in range(5):
+        y = rng.integers(3, size=64).astype('int8')
+        # Rounded, so that there are tied scores
+        p = np.round(tf.nn.softmax(rng.normal(size=(64, 3)) + np.eye(3)[y]).numpy(), 2).astype('float32')
+        metric.update_state(y, p)
+        y_true.append(y)
+        y_pred.append(p)
+    y_true = np.concatenate(y_true)
+    y_pred = np.concatenate(y_pred)
+    assert int(tf.size(metric.scores)) == len(np.unique(y_pred[:, 1]))
+    assert np.isclose(float(metric.result()), auroc(y_true == 1, y_pred[:, 1]), atol=1e-6)
+
+    # Average precision, with ties
+    metric = ExactAUC(1, curve='PR')
+    metric.update_state(np.array([1, 0, 1, 0]), np.array([[0, .9], [0, .9], [0, .5], [0, .1]]))
+    assert np.isclose(float(metric.result()), 0.5 * 0.5 + 0.5 * 2 / 3)
+
+    metric.reset_state()
+    assert int(tf.size(metric.scores)) == 0
+
+
+if __name__ == '__main__':
+    test_confusion_histogram()
+    test_exact_auc()
@@ -0,0 +1,87 @@
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from custom_layers import TokenConv1D
+from dataset import TOKEN_N, TOKEN_ONEHOT
+from metrics import ExactAUC
+from models import CnnModel, get_activations, load_model
+from scoring import auroc
+
+
+def _get_model():
+    inputs = keras.Input(shape=(20, 4))
+    x = keras.layers.Conv1D(3, 5, activation='relu', name='conv1d')(inputs)
+    x = keras.layers.Flatten(name='flatten')(x)
+    outputs = keras.layers.Dense(2, activation='softmax', name='dense')(x)
+    return keras.Model(inputs=inputs, outputs=outputs)
+
+def test_get_activations_layer_lists():
+    rng = np.random.default_rng(0)
+    model = _get_model()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fa_path = os.path.join(tmp_dir, 'seqs.fa')
+        with open(fa_path, 'w') as f:
+            for idx in range(37):
+                f.write(f">seq{idx}\n{''.join(rng.choice(list('ACGT'), 20))}\n")
+        expected = {name: get_activations(model, fa_path, layer_name=name) for name in ['flatten', 'dense']}
+        # Forward and reverse complement strand of each sequence
+        assert expected['dense'].shape == (74, 2)
+
+        for chunk_size in [None, 10]:
+            for layer_names in [['dense'], ['flatten', 'dense']]:
+                out_files = [os.path.join(tmp_dir, f"{name}-{chunk_size}.npy") for name in layer_names]
+                results = get_activations(model, fa_path, layer_name=layer_names, out_file=out_files, chunk_size=chunk_size)
+                assert isinstance(results, list) and len(results) == len(layer_names)
+                for name, result, out_file in zip(layer_names, results, out_files):
+                    assert np.allclose(result, expected[name], atol=1e-6)
+                    assert np.allclose(np.load(out_file), expected[name], atol=1e-6)
+
+def test_token_model_onehot_inputs():
+    inputs = keras.Input(shape=(20,), dtype='uint8')
+    x = TokenConv1D(3, 5, activation='relu')(inputs)
+    x = keras.layers.Flatten()(x)
+    outputs = keras.layers.Dense(2, activation='softmax')(x)
+    model = CnnModel(inputs=inputs, outputs=outputs)
+    model.compile(loss='sparse_categorical_crossentropy')
+
+    tokens = np.random.default_rng(0).integers(TOKEN_N + 1, size=(8, 20)).astype('uint8')
+    onehot = TOKEN_ONEHOT[tokens]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_path = os.path.join(tmp_dir, 'model.h5')
+        model.save(model_path)
+        loaded = load_model(model_path)
+    expected = loaded.predict(tokens, verbose=0)
+    assert np.allclose(loaded.predict(onehot, verbose=0), expected, atol=1e-6)
+    assert np.allclose(loaded(onehot.astype('float32')).numpy(), expected, atol=1e-6)
+
+def test_exact_auc_evaluation_only():
+    rng = np.random.default_rng(0)
+    xs = TOKEN_ONEHOT[rng.integers(4, size=(64, 20))].astype('float32')
+    ys = rng.integers(2, size=64)
+    arch = _get_model()
+    model = CnnModel(inputs=arch.inputs, outputs=arch.outputs)
+    model.compile(loss='sparse_categorical_crossentropy', metrics=['acc', ExactAUC(1, name='auroc')])
+
+    # Training steps don't update or log the exact AUC
+    history = model.fit(xs, ys, batch_size=16, epochs=2, verbose=0)
+    assert 'acc' in history.history and 'auroc' not in history.history
+    exact_auc = [metric for metric in model.metrics if isinstance(metric, ExactAUC)][0]
+    assert int(tf.size(exact_auc.scores)) == 0
+
+    # Evaluation does
+    results = model.evaluate(xs, ys, batch_size=16, verbose=0, return_dict=True)
+    assert np.isclose(results['auroc'], auroc(ys, model.predict(xs, verbose=0)[:, 1]), atol=1e-6)
+
+
+if __name__ == '__main__':
+    test_get_activations_layer_lists()
+    test_token_model_onehot_inputs()
+    test_exact_auc_evaluation_only()
@@ -0,0 +1,69 @@
+# allow importing from one directory up
+import sys
+sys.path.append('..')
+
+import numpy as np
+
+from scoring import auprc, auroc, bootstrap_metrics, get_metrics
+
+
+def test_auroc():
+    rng = np.random.default_rng(0)
+    y_true = rng.integers(2, size=200)
+    # Round scores so that there are ties
+    y_score = np.round(rng.random(200) + 0.3 * y_true, 1)
+
+    # Fraction of (positive, negative) pairs ranked correctly, with ties counting as half
+    pos, neg = y_score[y_true == 1], y_score[y_true == 0]
+    diffs = pos[:, np.newaxis] - neg[np.newaxis, :]
+    expected = np.mean(diffs > 0) + 0.5 * np.mean(diffs == 0)
+    assert np.isclose(auroc(y_true, y_score), expected)
+
+    assert auroc([0, 0, 1, 1], [0.1, 0.2, 0.3, 0.4]) == 1.0
+    assert auroc([0, 0, 1, 1], [0.5, 0.5, 0.5, 0.5]) == 0.5
+
+
+def test_auprc():
+    # Precision at each distinct score, weighted by the increase in recall. The tied scores form one step.
+    assert np.isclose(auprc([1, 0, 1, 0], [0.9, 0.9, 0.5, 0.1]), 0.5 * 0.5 + 0.5 * 2 / 3)
+    assert auprc([0, 0, 1, 1], [0.1, 0.2, 0.3, 0.4]) == 1.0
+
+
+def test_get_metrics():
+    y_true = np.array([0, 0, 1, 1])
+    y_pred = np.array([[0.8, 0.2], [0.4, 0.6], [0.3, 0.7], [0.6, 0.4]])
+    res = get_metrics(y_true, y_pred, 2, pos_label=1, neg_label=0)
+    assert np.isclose(res['loss'], -np.mean(np.log([0.8, 0.4, 0.7, 0.4])))
+    assert res['acc'] == 0.5
+    assert res['precision'] == 0.5 and res['sensitivity'] == 0.5 and res['f1'] == 0.5
+    assert res['npv'] == 0.5 and res['specificity'] == 0.5
+    assert res['auroc'] == 0.75
+
+    # Undefined metrics are 0
+    res = get_metrics(np.array([1, 1]), y_pred[2:], 2, pos_label=1, neg_label=0)
+    assert res['auroc'] == 0. and res['npvsc'] == 0. and res['npv'] == 0.
+
+
+def test_bootstrap_metrics():
+    rng = np.random.default_rng(0)
+    y_true = rng.integers(2, size=300)
+    # Round scores so that there are ties
+    pos_score = np.round(np.clip(rng.random(300) * 0.7 + 0.3 * y_true, 0, 1), 2)
+    y_pred = np.stack([1 - pos_score, pos_score], axis=1)
+    # Several replicates per chunk, and several chunks
+    res = bootstrap_metrics(y_true, y_pred, 2, pos_label=1, neg_label=0, num_replicates=10, seed=1, max_chunk_elements=1000)
+
+    # Same replicates, resampled one at a time
+    idx_rng = np.random.default_rng(1)
+    for replicate in range(10):
+        idxs = idx_rng.integers(300, size=300)
+        expected = get_metrics(y_true[idxs], y_pred[idxs], 2, pos_label=1, neg_label=0)
+        for name in ['acc', 'auroc', 'auprc', 'npvsc']:
+            assert np.isclose(res[name][replicate], expected[name]), name
+
+
+if __name__ == '__main__':
+    test_auroc()
+    test_auprc()
+    test_get_metrics()
+    test_bootstrap_metrics()
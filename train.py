@@ -3,11 +3,17 @@
 Usage:
 - Single training run, from interactive session: python train.py -config config-base.yaml
 - Single training run, on slurm: sbatch train.sb config-base.yaml
-- Hyperparameter sweep, on slurm: see README.md
+- Hyperparameter sweep, on slurm: see README.md. To run many sweep trials in one process, see sweep_agent.py.
+- Resumable training run: python train.py -config config-base.yaml -checkpoint-dir <dir> --resume
 """
 
+import os
+
+import tensorflow as tf
+
+import benchmarking
 import callbacks
-import dataset
+import dataset_server
 import models
 import lr_schedules
 import utils
@@ -16,62 +22,174 @@ import wandb
 from wandb.keras import WandbCallback
 
 
+# Number of training steps to time, to plan a time budget
+BUDGET_TIMING_STEPS = 50
+# Fraction of a time budget to plan training steps for. The rest is for validation and saving.
+BUDGET_TIME_FRACTION = 0.85
+
+
 def train(args):
 	# Start `wandb`
 	config, project = utils.get_config(args.config)
-	wandb.init(config=config, project=project, mode=args.wandb_mode)
+	checkpoint_state = None
+	if args.resume:
+		if args.checkpoint_dir is None:
+			raise ValueError("-checkpoint-dir is required with --resume")
+		checkpoint_state = callbacks.read_checkpoint_state(args.checkpoint_dir)
+	# Continue logging to the same wandb run when resuming
+	run_id = checkpoint_state['wandb_run_id'] if checkpoint_state is not None else None
+	wandb.init(config=config, project=project, mode=args.wandb_mode, id=run_id, resume='allow' if run_id else None)
 	utils.validate_config(wandb.config)
+	utils.set_threads(wandb.config.get('intra_op_threads'), wandb.config.get('inter_op_threads'))
 
-	# Get datasets
-	train_data = dataset.SequenceTfDataset(
-		wandb.config.train_data_paths, wandb.config.train_targets,
-		targets_are_classes=wandb.config.targets_are_classes, endless=True,
-		batch_size=wandb.config.batch_size,
-		reverse_complement=wandb.config.use_reverse_complement)
-	val_data = dataset.SequenceTfDataset(
-		wandb.config.val_data_paths, wandb.config.val_targets,
-		targets_are_classes=wandb.config.targets_are_classes,
-		endless=not wandb.config.use_exact_val_metrics,
-		batch_size=wandb.config.batch_size,
-		reverse_complement=wandb.config.use_reverse_complement)
+	train_data, val_data = get_datasets(wandb.config)
+	train_model(wandb.config, train_data, val_data,
+		checkpoint_dir=get_checkpoint_dir(args), checkpoint_state=checkpoint_state)
+
+def get_datasets(config):
+	"""Get training and validation datasets. These only depend on the data-related config values,
+	so they can be reused across runs, see sweep_agent.py."""
+	# Datasets are read from a dataset server if configured and available, see dataset_server.py
+	load_dataset = dataset_server.get_dataset_loader(config)
+	train_data = load_dataset(
+		config.train_data_paths, config.train_targets,
+		targets_are_classes=config.targets_are_classes, endless=True,
+		batch_size=utils.get_micro_batch_size(config),
+		reverse_complement=config.use_reverse_complement,
+		encoding=config.get('input_encoding', 'onehot'))
+	val_data = load_dataset(
+		config.val_data_paths, config.val_targets,
+		targets_are_classes=config.targets_are_classes,
+		endless=not config.use_exact_val_metrics,
+		batch_size=utils.get_micro_batch_size(config),
+		reverse_complement=config.use_reverse_complement,
+		encoding=config.get('input_encoding', 'onehot'))
 
 	utils.validate_datasets([train_data, val_data])
+	return train_data, val_data
+
+def train_model(config, train_data, val_data, additional_val_datasets=None, checkpoint_dir=None, checkpoint_state=None):
+	"""Build a model and train it on the given datasets, logging to the current wandb run.
 
+	Args:
+		config (wandb.config)
+		train_data (dataset.SequenceTfDataset): endless training data
+		val_data (dataset.SequenceTfDataset): validation data
+		additional_val_datasets (list of dataset.SequenceTfDataset): (Optional) prebuilt additional
+			validation sets, see models.get_additional_val_datasets(). If None, they are built from config.
+		checkpoint_dir (str): (Optional) directory for resumable checkpoints
+		checkpoint_state (dict): (Optional) checkpoint to resume from, see callbacks.read_checkpoint_state()
+
+	Returns:
+		model (keras model): trained model
+	"""
 	# Get model
-	steps_per_epoch_train, steps_per_epoch_val = utils.get_step_size(
-		wandb.config, train_data, val_data)
-	lr_schedule = lr_schedules.get_lr_schedule(steps_per_epoch_train, wandb.config)
+	steps_per_epoch_train, steps_per_epoch_val = get_steps_per_epoch(
+		config, train_data, val_data, checkpoint_state=checkpoint_state)
+	# The learning rate schedule counts optimizer updates, which is fewer than steps when accumulating gradients
+	lr_schedule = lr_schedules.get_lr_schedule(
+		steps_per_epoch_train // utils.get_accum_steps(config), config)
+	momentum_schedule = lr_schedules.get_momentum_schedule(
+		steps_per_epoch_train // utils.get_accum_steps(config), config)
 	model = models.get_model(
-		train_data.seq_shape, train_data.num_classes, train_data.class_to_idx_mapping, lr_schedule, wandb.config)
+		train_data.seq_shape, train_data.num_classes, train_data.class_to_idx_mapping, lr_schedule, config,
+		momentum_schedule=momentum_schedule)
 
 	# Get callbacks
-	callback_fns = callbacks.get_early_stopping_callbacks(wandb.config) + [
+	callback_fns = callbacks.get_early_stopping_callbacks(config) + [
 		WandbCallback(),
 		callbacks.OptimizerLogger(model.optimizer),
-		callbacks.get_additional_validation_callback(wandb.config, model),
+		callbacks.get_additional_validation_callback(config, model, val_datasets=additional_val_datasets),
 		callbacks.get_model_checkpoint_callback(),
-		callbacks.get_momentum_callback(steps_per_epoch_train, wandb.config)
+		callbacks.get_momentum_history_callback(config, model.optimizer),
+		callbacks.get_resumable_checkpoint_callback(checkpoint_dir, sequence_collection=train_data.sc),
+		callbacks.get_asha_callback(config),
+		callbacks.get_time_budget_callback(config)
 	]
 	callback_fns = [cb for cb in callback_fns if cb is not None]
 
+	# Resume from checkpoint
+	initial_epoch = 0
+	if checkpoint_state is not None:
+		initial_epoch = callbacks.restore_checkpoint(checkpoint_state, model, sequence_collection=train_data.sc)
+
 	# Get class weights
-	class_weight = utils.get_class_weight(wandb.config, train_data)
+	class_weight = utils.get_class_weight(config, train_data)
 
 	# Train
 	model.fit(
 		train_data.dataset,
-		epochs=wandb.config.num_epochs,
+		epochs=config.num_epochs,
 		steps_per_epoch=steps_per_epoch_train,
 		validation_data=val_data.dataset,
 		validation_steps=steps_per_epoch_val,
 		callbacks=callback_fns,
-		class_weight=class_weight)
+		class_weight=class_weight,
+		initial_epoch=initial_epoch)
+	return model
+
+def get_steps_per_epoch(config, train_data, val_data, checkpoint_state=None):
+	"""Get the number of training and validation steps per epoch, see utils.get_step_size().
+
+	If config has a training budget, `budget_examples` and/or `budget_hours`, then the budget is spread
+	over num_epochs epochs. A time budget is converted to a number of examples by timing training steps.
+	When resuming, the epoch length of the checkpoint is used, so that schedules continue where they stopped.
+	"""
+	if checkpoint_state is not None and checkpoint_state.get('steps_per_epoch'):
+		_, steps_per_epoch_val = utils.get_step_size(config, train_data, val_data)
+		return checkpoint_state['steps_per_epoch'], steps_per_epoch_val
+
+	budgets = []
+	if config.get('budget_examples'):
+		budgets.append(config.budget_examples)
+	if config.get('budget_hours'):
+		budgets.append(get_time_budget_examples(config, train_data))
+	budget_examples = min(budgets) if budgets else None
+	if budget_examples is not None:
+		print(f"Training budget: {budget_examples} examples over {config.num_epochs} epochs")
+	return utils.get_step_size(config, train_data, val_data, budget_examples=budget_examples)
+
+def get_time_budget_examples(config, train_data):
+	"""Estimate the number of training examples that fit in config.budget_hours.
+
+	Training throughput is timed on a separate copy of the model, with real training batches.
+	Only BUDGET_TIME_FRACTION of the budget is planned for, to leave time for validation and saving.
+	Training also stops if it runs out of time anyway, see callbacks.TimeBudget.
+
+	The sampling state of train_data is restored after timing, so training starts from the same examples
+	as without a time budget. The keras session is cleared, so that the trained model's layers get the
+	default names, e.g. conv1d and dense_1, rather than names numbered after the timing model's layers.
+	"""
+	sampling_state = train_data.sc.get_state()
+	model = models.get_model(
+		train_data.seq_shape, train_data.num_classes, train_data.class_to_idx_mapping, config.lr_init, config)
+	examples_per_sec = benchmarking.time_train_steps(
+		model, train_data.dataset, BUDGET_TIMING_STEPS, utils.get_micro_batch_size(config))
+	del model
+	tf.keras.backend.clear_session()
+	train_data.sc.set_state(sampling_state)
+	print(f"Training throughput: {examples_per_sec:.1f} examples/sec")
+	return int(examples_per_sec * config.budget_hours * 3600 * BUDGET_TIME_FRACTION)
+
+def get_checkpoint_dir(args):
+	"""Get the directory for resumable checkpoints: -checkpoint-dir if given, otherwise the wandb run dir.
+	Returns None if neither is available.
+	"""
+	if args.checkpoint_dir is not None:
+		return args.checkpoint_dir
+	if wandb.run.dir == callbacks.WANDB_RUN_DIR_DISABLED:
+		return None
+	return os.path.join(wandb.run.dir, 'checkpoints')
 
 def get_args():
 	import argparse
 	parser = argparse.ArgumentParser()
 	parser.add_argument('-config', type=str, required=True)
 	parser.add_argument('-wandb-mode', type=str)
+	parser.add_argument('-checkpoint-dir', type=str,
+		help='Directory for resumable checkpoints. Default is the wandb run dir, or no checkpoints if wandb is disabled.')
+	parser.add_argument('--resume', action='store_true',
+		help='Resume from the latest checkpoint in -checkpoint-dir, if there is one')
 	# parse_known_args() allows hyperparameters to be passed in during sweeps
 	args, _ = parser.parse_known_args()
 	return args
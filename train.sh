@@ -1,6 +1,6 @@
 #!/bin/bash
 #
-# Usage: bash train.sh <path to config>
+# Usage: bash train.sh <path to config> [<checkpoint dir>]
 
 # Activate environment
 source activate /ocean/projects/bio200034p/csestili/02319-hw-cnn/env/keras2-tf27
@@ -18,8 +18,8 @@ config_path=$1
 if [ -z $config_path ];
 then
     echo "Error: Missing arguments"
-    echo "Usage: bash train.sh <path to config>"
+    echo "Usage: bash train.sh <path to config> [<checkpoint dir>]"
     exit 1
 fi
 
-sbatch -p $PARTITION_GPU -t 08:00:00 scripts/train_main.sb $config_path
+sbatch -p $PARTITION_GPU -t 08:00:00 scripts/train_main.sb $config_path $2
@@ -0,0 +1,201 @@
+"""train_packed.py: Train several models at once, on the same batches.
+
+Small models can't use all the cores of a node, and separate training processes each run their own
+input pipeline. This builds one model per config, and trains them together as a PackedModel: each
+training step reads one batch, and updates every model with its own loss, optimizer and learning rate
+schedule. The configs must agree on everything that affects the batches, see PACKED_CONFIG_KEYS,
+and may differ in architecture and optimization, e.g. conv_filters or lr_max.
+
+Each model gets its own wandb run, in a shared group. The models train in one process, and wandb
+only allows one active run per process, so each model's metrics are logged to its run after training,
+epoch by epoch, along with the trained model.
+
+Usage:
+- From interactive session: python train_packed.py -configs <config 1 .yaml> <config 2 .yaml> ...
+"""
+
+import os
+
+import tensorflow as tf
+from tensorflow import keras
+import wandb
+
+import callbacks
+import lr_schedules
+import models
+import sweep_agent
+import train
+import utils
+
+
+# Config values that must be the same for all packed models: the datasets, and the length of training
+PACKED_CONFIG_KEYS = sweep_agent.DATA_CONFIG_KEYS + ['class_weight', 'num_epochs']
+
+
+def train_packed(args):
+	configs = [get_config(path) for path in args.configs]
+	project = configs[0].project
+	validate_packed_configs(configs)
+
+	# Get datasets, once for all models
+	train_data, val_data = train.get_datasets(configs[0])
+	additional_val_datasets = models.get_additional_val_datasets(configs[0], encoding=train_data.encoding)
+
+	# Get models
+	steps_per_epoch_train, steps_per_epoch_val = utils.get_step_size(configs[0], train_data, val_data)
+	packed_models = []
+	for config in configs:
+		lr_schedule = lr_schedules.get_lr_schedule(steps_per_epoch_train, config)
+		momentum_schedule = lr_schedules.get_momentum_schedule(steps_per_epoch_train, config)
+		packed_models.append(models.get_model(
+			train_data.seq_shape, train_data.num_classes, train_data.class_to_idx_mapping, lr_schedule, config,
+			momentum_schedule=momentum_schedule))
+	model = PackedModel(packed_models)
+	model.compile()
+
+	# Train
+	history = PackedHistory(configs, packed_models, additional_val_datasets)
+	model.fit(
+		train_data.dataset,
+		epochs=configs[0].num_epochs,
+		steps_per_epoch=steps_per_epoch_train,
+		validation_data=val_data.dataset,
+		validation_steps=steps_per_epoch_val,
+		callbacks=[history],
+		class_weight=utils.get_class_weight(configs[0], train_data))
+
+	# Log each model to its own run
+	group = f"packed-{wandb.util.generate_id()}"
+	for path, packed_model, model_history in zip(args.configs, packed_models, history.history):
+		config, _ = utils.get_config(path)
+		wandb.init(config=config, project=project, group=group, mode=args.wandb_mode, reinit=True)
+		for logs in model_history:
+			wandb.log(logs)
+		if wandb.run.dir != callbacks.WANDB_RUN_DIR_DISABLED:
+			packed_model.save(os.path.join(wandb.run.dir, 'model-latest.h5'))
+		wandb.finish()
+	return packed_models
+
+def get_config(path):
+	"""Read a config .yaml as a wandb.Config, which is what training expects, without starting a run."""
+	config_dict, _ = utils.get_config(path)
+	utils.validate_config(config_dict)
+	config = wandb.Config()
+	config.update(config_dict)
+	return config
+
+def validate_packed_configs(configs):
+	for key in PACKED_CONFIG_KEYS:
+		values = [config.get(key) for config in configs]
+		if any(value != values[0] for value in values):
+			raise ValueError(f"All packed configs must have the same `{key}`, got {values}")
+	for config in configs:
+		# Each model is called directly by PackedModel, so CnnModel's train_step is not used
+		if (config.get('grad_accum_steps') or 1) > 1 or config.get('use_xla'):
+			raise ValueError("grad_accum_steps and use_xla are not supported for packed models")
+		if config.get('early_stopping_callbacks'):
+			print("Warning: early_stopping_callbacks are not used for packed models")
+
+class PackedModel(keras.Model):
+	"""Several compiled models, trained together on the same inputs and targets.
+
+	Each training step runs all the models on the batch, and does one backward pass through the
+	sum of their losses. The models share no weights, so each one gets the same gradients as if it were
+	trained alone, and each one is updated by its own optimizer. Metrics are reported per model, as
+	`m<index>/<metric name>`, see split_logs().
+
+	Compile with no arguments: the loss, metrics, and optimizer of each model are used instead.
+
+	Args:
+		packed_models (list of keras models): compiled models, with the same inputs and outputs
+	"""
+	def __init__(self, packed_models, **kwargs):
+		super().__init__(**kwargs)
+		self.packed_models = packed_models
+
+	def call(self, x, training=False):
+		return [model(x, training=training) for model in self.packed_models]
+
+	def train_step(self, data):
+		x, y, sample_weight = keras.utils.unpack_x_y_sample_weight(data)
+		with tf.GradientTape() as tape:
+			y_preds = self(x, training=True)
+			losses = [
+				model.compiled_loss(y, y_pred, sample_weight, regularization_losses=model.losses)
+				for model, y_pred in zip(self.packed_models, y_preds)]
+			loss = tf.add_n(losses)
+		gradients = tape.gradient(loss, [model.trainable_variables for model in self.packed_models])
+		for model, model_gradients in zip(self.packed_models, gradients):
+			model.optimizer.apply_gradients(zip(model_gradients, model.trainable_variables))
+		for model, y_pred in zip(self.packed_models, y_preds):
+			models.update_training_metrics(model, y, y_pred, sample_weight)
+		return self._get_metric_results(training=True)
+
+	def test_step(self, data):
+		x, y, sample_weight = keras.utils.unpack_x_y_sample_weight(data)
+		y_preds = self(x, training=False)
+		for model, y_pred in zip(self.packed_models, y_preds):
+			model.compiled_loss(y, y_pred, sample_weight, regularization_losses=model.losses)
+			model.compiled_metrics.update_state(y, y_pred, sample_weight)
+		return self._get_metric_results()
+
+	@property
+	def metrics(self):
+		# Keras resets these at the start of each epoch and evaluation
+		return [metric for model in self.packed_models for metric in model.metrics]
+
+	def _get_metric_results(self, training=False):
+		results = {}
+		for idx, model in enumerate(self.packed_models):
+			for metric in models.get_logged_metrics(model.metrics, training=training):
+				result = metric.result()
+				if not isinstance(result, dict):
+					result = {metric.name: result}
+				results.update({f"m{idx}/{name}": value for name, value in result.items()})
+		return results
+
+def split_logs(logs, num_models):
+	"""Split PackedModel logs into one dict per model, with the usual metric names,
+	e.g. {'m1/acc': 0.8, 'val_m1/acc': 0.7} -> [{}, {'acc': 0.8, 'val_acc': 0.7}] for 2 models."""
+	model_logs = [{} for _ in range(num_models)]
+	for key, value in logs.items():
+		prefix, name = key.split('/', 1)
+		val_prefix = 'val_' if prefix.startswith('val_') else ''
+		idx = int(prefix[len(val_prefix) + 1:])
+		model_logs[idx][val_prefix + name] = value
+	return model_logs
+
+class PackedHistory(keras.callbacks.Callback):
+	"""Record each packed model's metrics, learning rate, and additional validation results after each epoch.
+
+	Attributes:
+		history (list of list of dict): for each model, the logs of each epoch
+	"""
+	def __init__(self, configs, packed_models, additional_val_datasets=None):
+		super().__init__()
+		self.packed_models = packed_models
+		self.history = [[] for _ in packed_models]
+		self.additional_vals = [
+			models.get_additional_validation(config, model, val_datasets=additional_val_datasets)
+			for config, model in zip(configs, packed_models)
+		] if additional_val_datasets is not None else [None] * len(packed_models)
+
+	def on_epoch_end(self, epoch, logs=None):
+		model_logs = split_logs(logs, len(self.packed_models))
+		for idx, model in enumerate(self.packed_models):
+			optimizer = model.optimizer
+			model_logs[idx]['lr'] = float(keras.backend.get_value(optimizer.learning_rate(optimizer.iterations)))
+			if self.additional_vals[idx] is not None:
+				model_logs[idx].update(self.additional_vals[idx].evaluate())
+			self.history[idx].append({k: float(v) for k, v in model_logs[idx].items()})
+
+def get_args():
+	import argparse
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-configs', type=str, nargs='+', required=True, help='Config .yaml for each model')
+	parser.add_argument('-wandb-mode', type=str)
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	train_packed(get_args())
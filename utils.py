@@ -58,6 +58,11 @@ def validate_config(config_dict):
 		(config_dict['val_data_paths'], config_dict['val_targets'])]:
 		assert len(paths) == len(targets)
 
+	# check gradient accumulation
+	accum_steps = config_dict.get('grad_accum_steps') or 1
+	if config_dict['batch_size'] % accum_steps != 0:
+		raise ValueError(f"batch_size must be divisible by grad_accum_steps, got {config_dict['batch_size']} and {accum_steps}")
+
 	# check layer-wise parameters
 	check_layerwise_params(config_dict, 'num_conv_layers', LAYERWISE_PARAMS_CONV)
 	check_layerwise_params(config_dict, 'num_dense_layers', LAYERWISE_PARAMS_DENSE)
@@ -78,9 +83,45 @@ def get_config(yaml_path):
 	project = config['project']
 	return config, project
 
-def get_step_size(config, train_data, val_data):
-	batch_size = config.batch_size
-	steps_per_epoch_train = len(train_data) // batch_size
+def get_accum_steps(config):
+	"""Number of batches to accumulate gradients over, for each optimizer update."""
+	return config.get('grad_accum_steps') or 1
+
+def get_micro_batch_size(config):
+	"""Number of examples in each batch that passes through the model.
+	This is smaller than config.batch_size when accumulating gradients."""
+	return config.batch_size // get_accum_steps(config)
+
+def set_threads(intra_op_threads=None, inter_op_threads=None):
+	"""Set the sizes of tensorflow's thread pools, e.g. from scripts/autotune.py. None or 0 keeps the default.
+
+	Thread pools can only be set before tensorflow runs anything, so call this first. Later calls with
+	the same values, e.g. from the next trial in sweep_agent.py, do nothing.
+	"""
+	import tensorflow as tf
+	for value, get_fn, set_fn in [
+		(intra_op_threads, tf.config.threading.get_intra_op_parallelism_threads,
+			tf.config.threading.set_intra_op_parallelism_threads),
+		(inter_op_threads, tf.config.threading.get_inter_op_parallelism_threads,
+			tf.config.threading.set_inter_op_parallelism_threads)]:
+		if value and get_fn() != value:
+			set_fn(value)
+
+def get_step_size(config, train_data, val_data, budget_examples=None):
+	"""Get the number of batches per epoch, of size get_micro_batch_size(config).
+
+	When accumulating gradients, the number of optimizer updates per epoch is
+	steps_per_epoch_train // get_accum_steps(config).
+
+	Args:
+		budget_examples (int): (Optional) total number of training examples to train on. If given, then
+			it is spread over config.num_epochs epochs, instead of each epoch being len(train_data) examples.
+			Learning rate and momentum schedules are based on epochs, so they still finish their cycles.
+	"""
+	batch_size = get_micro_batch_size(config)
+	examples_per_epoch = len(train_data) if budget_examples is None else budget_examples // config.num_epochs
+	# Round down to whole optimizer updates
+	steps_per_epoch_train = max(1, examples_per_epoch // config.batch_size) * get_accum_steps(config)
 	steps_per_epoch_val = len(val_data) // batch_size
 	return steps_per_epoch_train, steps_per_epoch_val
 